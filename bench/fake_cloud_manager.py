@@ -0,0 +1,142 @@
+"""A local stand-in for the Cloud Manager /groups/{id}/hosts endpoint.
+
+Serves a fixed host list with the real API's pagination (pageNum,
+itemsPerPage, totalCount) behind HTTP Digest authentication, with injected
+per-request latency and a rate of 503 responses carrying Retry-After.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+REALM = 'MMS Public API'
+MAX_ITEMS_PER_PAGE = 500
+
+
+def _md5(value: str) -> str:
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+class FakeCloudManager:
+    """Serve `hosts` for `project_id` on 127.0.0.1 from a daemon thread."""
+
+    def __init__(self, hosts: List[Dict], project_id: str, public_key: str, private_key: str,
+                 latency_ms: float = 0.0, error_rate: float = 0.0, retry_after: float = 0.0,
+                 seed: Optional[int] = None):
+        self.hosts = hosts
+        self.project_id = project_id
+        self.public_key = public_key
+        self.private_key = private_key
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.nonces = set()
+        self.requests = 0
+        self.challenges = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/public/v1.0"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-cloud-manager', daemon=True).start()
+        logger.info(f"Fake Cloud Manager serving {len(self.hosts)} hosts at {self.base_url}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _authorized(self, handler: BaseHTTPRequestHandler) -> bool:
+        header = handler.headers.get('Authorization', '')
+        if not header.startswith('Digest '):
+            return False
+        fields = dict(re.findall(r'(\w+)="?([^",]*)"?', header[len('Digest '):]))
+        with self._lock:
+            known_nonce = fields.get('nonce') in self.nonces
+        if fields.get('username') != self.public_key or not known_nonce:
+            return False
+
+        ha1 = _md5(f"{self.public_key}:{REALM}:{self.private_key}")
+        ha2 = _md5(f"{handler.command}:{fields.get('uri')}")
+        expected = _md5(f"{ha1}:{fields['nonce']}:{fields.get('nc')}:{fields.get('cnonce')}:{fields.get('qop')}:{ha2}")
+        return fields.get('response') == expected
+
+    def _send(self, handler: BaseHTTPRequestHandler, status: int, body: Dict, headers: Optional[Dict] = None):
+        payload = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def handle(self, handler: BaseHTTPRequestHandler):
+        with self._lock:
+            self.requests += 1
+
+        if not self._authorized(handler):
+            nonce = os.urandom(16).hex()
+            with self._lock:
+                self.nonces.add(nonce)
+                self.challenges += 1
+            self._send(handler, 401, {'error': 401, 'reason': 'Unauthorized'}, {
+                'WWW-Authenticate': f'Digest realm="{REALM}", domain="", nonce="{nonce}", '
+                                    f'algorithm=MD5, qop="auth", stale=false'})
+            return
+
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+        with self._lock:
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if fail:
+            self._send(handler, 503, {'error': 503, 'reason': 'Service Unavailable'},
+                       {'Retry-After': f"{self.retry_after:g}"})
+            return
+
+        url = urlparse(handler.path)
+        if url.path.rstrip('/') != f"/api/public/v1.0/groups/{self.project_id}/hosts":
+            self._send(handler, 404, {'error': 404, 'reason': 'Not Found'})
+            return
+
+        query = parse_qs(url.query)
+        page_num = max(int(query.get('pageNum', ['1'])[0]), 1)
+        items_per_page = min(max(int(query.get('itemsPerPage', ['100'])[0]), 1), MAX_ITEMS_PER_PAGE)
+        cluster_id = query.get('clusterId', [None])[0]
+        hosts = [host for host in self.hosts if cluster_id is None or host.get('clusterId') == cluster_id]
+
+        start = (page_num - 1) * items_per_page
+        self._send(handler, 200, {
+            'results': hosts[start:start + items_per_page],
+            'totalCount': len(hosts),
+            'links': []
+        })
@@ -0,0 +1,770 @@
+"""A small in-process MongoDB wire-protocol stand-in for benchmarking.
+
+Every simulated node (mongos, shard primaries and secondaries, config server)
+listens on its own 127.0.0.1 port, all served by one asyncio event loop on a
+background thread. It speaks just enough of the protocol for PyMongo: the
+OP_QUERY handshake, OP_MSG, SCRAM-SHA-1/SCRAM-SHA-256 (including speculative
+authentication) and the commands used by mongo-cache-flush.py and test-env.py.
+"""
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import bson
+from bson import Binary
+
+logger = logging.getLogger(__name__)
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+MORE_TO_COME = 1 << 1
+CHECKSUM_PRESENT = 1
+
+MAX_WIRE_VERSION = 21  # MongoDB 7.0
+SCRAM_ITERATIONS = {'SCRAM-SHA-1': 10000, 'SCRAM-SHA-256': 15000}
+
+FLUSH_COMMANDS = ('_flushRoutingTableCacheUpdatesWithWriteConcern', '_flushRoutingTableCacheUpdates')
+
+# Handshake and authentication are never slowed down beyond the base latency or failed on purpose
+HANDSHAKE_COMMANDS = {'hello', 'ismaster', 'saslstart', 'saslcontinue', 'endsessions'}
+
+BUILTIN_ROLES = {'root', 'clusterAdmin', 'clusterManager', 'clusterMonitor', 'userAdmin', 'userAdminAnyDatabase'}
+
+# Commands a shard member only accepts while it is primary
+WRITE_COMMANDS = {'createuser', 'updateuser', 'createrole', 'grantrolestouser', 'revokerolesfromuser', 'dropuser',
+                  'droprole'}
+
+
+class FaultProfile:
+    """Injected latency and failure rates, shared by every node of a cluster."""
+
+    def __init__(self, latency_ms: float = 1.0, jitter_ms: float = 0.5, flush_latency_ms: float = 5.0,
+                 error_rate: float = 0.0, lagging_rate: float = 0.0, lag_seconds: float = 30.0,
+                 lag_duration: float = 5.0, failover_rate: float = 0.0, slow_rate: float = 0.0,
+                 slow_flush_ms: float = 3000.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.flush_latency_ms = flush_latency_ms
+        self.error_rate = error_rate
+        # Share of shard primaries whose secondaries trail by lag_seconds, for
+        # lag_duration seconds after replSetGetStatus is first run on them
+        self.lagging_rate = lagging_rate
+        self.lag_seconds = lag_seconds
+        self.lag_duration = lag_duration
+        # Share of shard primaries that step down, handing over to their next
+        # member, when the first user is created on them
+        self.failover_rate = failover_rate
+        # Share of shard primaries whose flush takes slow_flush_ms longer, like a
+        # w: majority wait on a lagging secondary
+        self.slow_rate = slow_rate
+        self.slow_flush_ms = slow_flush_ms
+        self.random = random.Random(seed)
+
+    def delay(self, command: str, slow: bool = False) -> float:
+        """Seconds to wait before replying to `command`."""
+        millis = self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        if command in FLUSH_COMMANDS:
+            millis += self.flush_latency_ms + (self.slow_flush_ms if slow else 0.0)
+        return max(millis, 0.0) / 1000
+
+    def should_fail(self, command: str) -> bool:
+        return command.lower() not in HANDSHAKE_COMMANDS and self.random.random() < self.error_rate
+
+
+class FakeNode:
+    """State of one simulated mongod or mongos."""
+
+    def __init__(self, cluster: 'FakeCluster', role: str, set_name: Optional[str] = None, primary: bool = False):
+        self.cluster = cluster
+        self.role = role  # 'mongos', 'shard' or 'config'
+        self.set_name = set_name
+        self.primary = primary
+        self.port = None
+        self.server = None
+        self.members = []
+        self.users = {}
+        self.user_details = {}  # name -> {'roles': [...], 'customData': {...}}
+        self.roles = set()
+        self.counters = {}
+        self.flushed_at = []  # Wall-clock times of successful flushes
+        self.connections = 0
+        self.lagging = False
+        self.lag_until = None
+        self.fails_over = False
+        self.slow = False
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def host_entry(self) -> Dict:
+        """This node as a Cloud Manager /hosts result."""
+        if self.role == 'mongos':
+            type_name = 'SHARD_MONGOS'
+        else:
+            prefix = 'SHARD_CONFIG_' if self.role == 'config' else 'SHARD_'
+            type_name = prefix + ('PRIMARY' if self.primary else 'SECONDARY')
+        entry = {'hostname': '127.0.0.1', 'port': self.port, 'typeName': type_name,
+                 'clusterId': self.cluster.cluster_id}
+        if self.set_name:
+            entry['replicaSetName'] = self.set_name
+        return entry
+
+    def count(self, command: str, failed: bool):
+        counter = self.counters.setdefault(command, {'total': 0, 'failed': 0})
+        counter['total'] += 1
+        if failed:
+            counter['failed'] += 1
+
+    def flush_total(self) -> int:
+        return sum(self.counters.get(command, {}).get('total', 0) for command in FLUSH_COMMANDS)
+
+    def auth_writes(self) -> int:
+        """User and role changes this node accepted or rejected."""
+        return sum(counter['total'] for command, counter in self.counters.items() if command.lower() in WRITE_COMMANDS)
+
+
+class FakeCluster:
+    """A sharded cluster of FakeNodes plus the config database its mongos serve.
+
+    `chunks_per_namespace` chunks of each namespace are spread round-robin over
+    the first `owning_shards` shards (all shards by default).
+    """
+
+    def __init__(self, shards: int, mongos: int = 2, secondaries: int = 2,
+                 namespaces: Optional[List[str]] = None, chunks_per_namespace: int = 0,
+                 owning_shards: Optional[int] = None, faults: Optional[FaultProfile] = None,
+                 users: Optional[Dict[str, str]] = None, cluster_id: str = 'bench-cluster'):
+        self.cluster_id = cluster_id
+        self.faults = faults or FaultProfile()
+        self.namespaces = namespaces or []
+        self.chunks_per_namespace = chunks_per_namespace or shards
+        self.owning_shards = min(owning_shards or shards, shards)
+        self.users = users or {}
+        self.mongos = [FakeNode(self, 'mongos') for _ in range(mongos)]
+        self.config_servers = [FakeNode(self, 'config', 'configRS', primary=True)]
+        self.shards = {}
+        for index in range(shards):
+            set_name = f"shard-{index:04d}"
+            self.shards[set_name] = [FakeNode(self, 'shard', set_name, primary=(member == 0))
+                                     for member in range(1 + secondaries)]
+        self.config = {}
+        self._loop = None
+        self._thread = None
+
+    def nodes(self) -> List[FakeNode]:
+        return self.mongos + self.config_servers + [node for members in self.shards.values() for node in members]
+
+    def primaries(self) -> Dict[str, FakeNode]:
+        return {set_name: next(node for node in members if node.primary) for set_name, members in self.shards.items()}
+
+    def step_down(self, set_name: str):
+        """Hand the primary role of a shard to its next member, which takes over the replicated users and roles."""
+        members = self.shards[set_name]
+        old = next(index for index, node in enumerate(members) if node.primary)
+        new = members[(old + 1) % len(members)]
+        members[old].primary = False
+        new.primary = True
+        new.users, new.roles = dict(members[old].users), set(members[old].roles)
+        new.user_details = {name: dict(details) for name, details in members[old].user_details.items()}
+        logger.info(f"{set_name} failed over from {members[old].address} to {new.address}")
+
+    def host_entries(self) -> List[Dict]:
+        return [node.host_entry() for node in self.nodes()]
+
+    def migrate(self) -> Dict:
+        """Move a random chunk to another shard and log it in config.changelog, as the balancer would.
+
+        Returns the changelog event.
+        """
+        chunk = self.faults.random.choice(self.config['chunks'])
+        donor = chunk['shard']
+        recipient = self.faults.random.choice([set_name for set_name in self.shards if set_name != donor])
+        chunk['shard'] = recipient
+        namespace = next(collection['_id'] for collection in self.config['collections']
+                         if collection['uuid'] == chunk['uuid'])
+        event = {'_id': f"{self.shards[donor][0].address}-{uuid.uuid4().hex}", 'server': self.shards[donor][0].address,
+                 'shard': donor, 'clientAddr': '', 'time': datetime.now(timezone.utc), 'what': 'moveChunk.commit',
+                 'ns': namespace, 'details': {'min': chunk['min'], 'max': chunk['max'], 'from': donor, 'to': recipient}}
+        self.config['changelog'].append(event)
+        return event
+
+    def start(self):
+        """Bind every node's port and serve them from a daemon thread."""
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._bind())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='fake-mongod', daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._build_config()
+        for node in self.nodes():
+            node.users = {name: _scram_credentials(name, password) for name, password in self.users.items()}
+        for node in self.primaries().values():
+            node.lagging = self.faults.random.random() < self.faults.lagging_rate
+            node.fails_over = len(self.shards[node.set_name]) > 1 and \
+                self.faults.random.random() < self.faults.failover_rate
+            node.slow = self.faults.random.random() < self.faults.slow_rate
+        logger.info(f"Fake cluster serving {len(self.nodes())} nodes "
+                    f"({len(self.shards)} shards, {len(self.mongos)} mongos)")
+
+    def stop(self):
+        async def close():
+            for node in self.nodes():
+                node.server.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _bind(self):
+        for node in self.nodes():
+            node.server = await asyncio.start_server(
+                lambda reader, writer, node=node: serve_connection(node, reader, writer), '127.0.0.1', 0)
+            node.port = node.server.sockets[0].getsockname()[1]
+        for members in list(self.shards.values()) + [self.config_servers]:
+            for node in members:
+                node.members = [member.address for member in members]
+
+    def _build_config(self):
+        shard_ids = list(self.shards)
+        now = datetime.now(timezone.utc)
+        collections, chunks = [], []
+        for namespace in self.namespaces:
+            collection_uuid = Binary.from_uuid(uuid.uuid4())
+            collections.append({'_id': namespace, 'uuid': collection_uuid, 'key': {'_id': 'hashed'},
+                                'lastmodEpoch': bson.ObjectId(), 'lastmod': now})
+            for index in range(self.chunks_per_namespace):
+                chunks.append({'_id': bson.ObjectId(), 'uuid': collection_uuid, 'min': {'_id': index},
+                               'max': {'_id': index + 1}, 'shard': shard_ids[index % self.owning_shards]})
+
+        self.config = {
+            'shards': [{'_id': set_name, 'state': 1,
+                        'host': f"{set_name}/{','.join(member.address for member in members)}"}
+                       for set_name, members in self.shards.items()],
+            'mongos': [{'_id': node.address, 'ping': now, 'up': 0, 'waiting': True, 'mongoVersion': '7.0.0'}
+                       for node in self.mongos],
+            'databases': [{'_id': db_name, 'primary': shard_ids[0], 'partitioned': True}
+                          for db_name in sorted({namespace.split('.', 1)[0] for namespace in self.namespaces})],
+            'collections': collections,
+            'chunks': chunks,
+            'changelog': []
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def _scram_credentials(username: str, password: str) -> Dict[str, Dict]:
+    """Precompute the stored and server keys of both SCRAM mechanisms, as mongod does.
+
+    Cached, so the same user on a thousand nodes costs one key derivation
+    rather than stalling the shared event loop.
+    """
+    credentials = {}
+    for mechanism, iterations in SCRAM_ITERATIONS.items():
+        if mechanism == 'SCRAM-SHA-1':
+            digest, secret = 'sha1', hashlib.md5(f"{username}:mongo:{password}".encode()).hexdigest().encode()
+        else:
+            digest, secret = 'sha256', password.encode()
+        salt = os.urandom(16 if digest == 'sha1' else 28)
+        salted = hashlib.pbkdf2_hmac(digest, secret, salt, iterations)
+        client_key = hmac.new(salted, b'Client Key', digest).digest()
+        credentials[mechanism] = {
+            'digest': digest,
+            'salt': salt,
+            'iterations': iterations,
+            'stored_key': hashlib.new(digest, client_key).digest(),
+            'server_key': hmac.new(salted, b'Server Key', digest).digest()
+        }
+    return credentials
+
+
+class Connection:
+    """Per-socket state: the SASL conversation in progress and the authenticated user."""
+
+    def __init__(self, node: FakeNode):
+        node.connections += 1
+        self.node = node
+        self.connection_id = node.connections
+        self.user = None
+        self.conversation = None
+
+
+async def serve_connection(node: FakeNode, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    connection = Connection(node)
+    try:
+        while True:
+            header = await reader.readexactly(16)
+            length, request_id, _, op_code = struct.unpack('<iiii', header)
+            body = await reader.readexactly(length - 16)
+
+            if op_code == OP_MSG:
+                flags, command = parse_op_msg(body)
+            elif op_code == OP_QUERY:
+                flags, command = 0, parse_op_query(body)
+            else:
+                logger.warning(f"Unsupported opcode {op_code} on {node.address}")
+                break
+
+            name = next(iter(command))
+            reply = dispatch(connection, name, command)
+            reply, delay = apply_time_limits(command, reply, node.cluster.faults.delay(name, node.slow))
+            await asyncio.sleep(delay)
+
+            if flags & MORE_TO_COME:
+                continue
+            if op_code == OP_MSG:
+                payload = struct.pack('<i', 0) + b'\x00' + bson.encode(reply)
+                reply_code = OP_MSG
+            else:
+                payload = struct.pack('<iqii', 0, 0, 0, 1) + bson.encode(reply)
+                reply_code = OP_REPLY
+            writer.write(struct.pack('<iiii', 16 + len(payload), random.getrandbits(31), request_id, reply_code)
+                         + payload)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def apply_time_limits(command: Dict, reply: Dict, delay: float):
+    """Cut a reply short, like mongod, when it would outlast maxTimeMS or the write concern's wtimeout.
+
+    Returns (reply, seconds to wait before sending it).
+    """
+    max_time = command.get('maxTimeMS') or 0
+    wtimeout = (command.get('writeConcern') or {}).get('wtimeout') or 0
+    if wtimeout and delay > wtimeout / 1000 and (not max_time or wtimeout <= max_time) and reply.get('ok') == 1.0:
+        return {**reply, 'writeConcernError': {'code': 64, 'codeName': 'WriteConcernFailed',
+                                               'errmsg': 'waiting for replication timed out',
+                                               'errInfo': {'wtimeout': True}}}, wtimeout / 1000
+    if max_time and delay > max_time / 1000:
+        return error('operation exceeded time limit', 50, 'MaxTimeMSExpired'), max_time / 1000
+    return reply, delay
+
+
+def parse_op_msg(body: bytes):
+    """Return (flagBits, command) with any document sequences folded into the command."""
+    flags = struct.unpack_from('<I', body)[0]
+    end = len(body) - (4 if flags & CHECKSUM_PRESENT else 0)
+    offset, command, sequences = 4, None, {}
+    while offset < end:
+        kind = body[offset]
+        offset += 1
+        if kind == 0:
+            size = struct.unpack_from('<i', body, offset)[0]
+            command = bson.decode(body[offset:offset + size])
+            offset += size
+        else:
+            size = struct.unpack_from('<i', body, offset)[0]
+            section_end = offset + size
+            name_end = body.index(b'\x00', offset + 4)
+            identifier = body[offset + 4:name_end].decode()
+            sequences[identifier] = bson.decode_all(body[name_end + 1:section_end])
+            offset = section_end
+    command.update(sequences)
+    return flags, command
+
+
+def parse_op_query(body: bytes) -> Dict:
+    name_end = body.index(b'\x00', 4)
+    offset = name_end + 1 + 8
+    size = struct.unpack_from('<i', body, offset)[0]
+    query = bson.decode(body[offset:offset + size])
+    # Legacy drivers may wrap the command in $query
+    return query.get('$query', query)
+
+
+def error(message: str, code: int, code_name: str) -> Dict:
+    return {'ok': 0.0, 'errmsg': message, 'code': code, 'codeName': code_name}
+
+
+def dispatch(connection: Connection, name: str, command: Dict) -> Dict:
+    node = connection.node
+    key = name.lower()
+    if node.cluster.faults.should_fail(name):
+        reply = error(f"injected failure of {name}", 1, 'InternalError')
+    elif node.fails_over and key == 'createuser':
+        node.fails_over = False
+        node.cluster.step_down(node.set_name)
+        reply = error('not primary', 10107, 'NotWritablePrimary')
+    elif node.role == 'shard' and not node.primary and key in WRITE_COMMANDS:
+        reply = error('not primary', 10107, 'NotWritablePrimary')
+    elif key in ('hello', 'ismaster'):
+        reply = hello(connection, command, legacy=(key == 'ismaster'))
+    elif key == 'saslstart':
+        reply = sasl_start(connection, command)
+    elif key == 'saslcontinue':
+        reply = sasl_continue(connection, command)
+    elif key in ('ping', 'endsessions', 'killcursors', 'logout'):
+        reply = {'ok': 1.0}
+    elif key == 'buildinfo':
+        reply = {'version': '7.0.0', 'versionArray': [7, 0, 0, 0], 'ok': 1.0}
+    elif connection.user is None:
+        reply = error(f"command {name} requires authentication", 13, 'Unauthorized')
+    else:
+        handler = COMMANDS.get(name)
+        reply = handler(node, command) if handler else error(f"no such command: '{name}'", 59, 'CommandNotFound')
+    node.count(name, reply.get('ok') != 1.0)
+    return reply
+
+
+def hello(connection: Connection, command: Dict, legacy: bool) -> Dict:
+    node = connection.node
+    # No topologyVersion, so PyMongo polls instead of using the streaming (exhaust) protocol
+    reply = {
+        'ismaster' if legacy else 'isWritablePrimary': node.role == 'mongos' or node.primary,
+        'helloOk': True,
+        'maxBsonObjectSize': 16 * 1024 * 1024,
+        'maxMessageSizeBytes': 48000000,
+        'maxWriteBatchSize': 100000,
+        'localTime': datetime.now(timezone.utc),
+        'logicalSessionTimeoutMinutes': 30,
+        'connectionId': connection.connection_id,
+        'minWireVersion': 0,
+        'maxWireVersion': MAX_WIRE_VERSION,
+        'readOnly': False,
+        'ok': 1.0
+    }
+    if node.role == 'mongos':
+        reply['msg'] = 'isdbgrid'
+    else:
+        reply.update({'setName': node.set_name, 'setVersion': 1, 'hosts': node.members, 'me': node.address,
+                      'primary': node.cluster.primaries()[node.set_name].address if node.role == 'shard'
+                      else node.members[0], 'secondary': not node.primary})
+
+    if 'saslSupportedMechs' in command:
+        user = command['saslSupportedMechs'].split('.', 1)[-1]
+        if user in node.users:
+            reply['saslSupportedMechs'] = list(SCRAM_ITERATIONS)
+    if 'speculativeAuthenticate' in command:
+        speculative = sasl_start(connection, command['speculativeAuthenticate'])
+        if speculative.get('ok') == 1.0:
+            reply['speculativeAuthenticate'] = speculative
+    return reply
+
+
+def _scram_fields(payload: bytes) -> Dict[str, str]:
+    return dict(field.split('=', 1) for field in payload.decode().split(',') if '=' in field)
+
+
+def sasl_start(connection: Connection, command: Dict) -> Dict:
+    mechanism = command.get('mechanism')
+    if mechanism not in SCRAM_ITERATIONS:
+        return error(f"Unsupported mechanism {mechanism}", 2, 'BadValue')
+
+    client_first_bare = bytes(command['payload']).split(b',', 2)[2]
+    fields = _scram_fields(client_first_bare)
+    username = fields['n'].replace('=2C', ',').replace('=3D', '=')
+    credentials = connection.node.users.get(username, {}).get(mechanism)
+    if credentials is None:
+        return error('Authentication failed.', 18, 'AuthenticationFailed')
+
+    nonce = fields['r'] + base64.b64encode(os.urandom(24)).decode()
+    server_first = (f"r={nonce},s={base64.b64encode(credentials['salt']).decode()},"
+                    f"i={credentials['iterations']}").encode()
+    connection.conversation = {'username': username, 'credentials': credentials, 'nonce': nonce,
+                               'auth_prefix': client_first_bare + b',' + server_first,
+                               'skip_empty': command.get('options', {}).get('skipEmptyExchange', False)}
+    return {'conversationId': 1, 'done': False, 'payload': Binary(server_first), 'ok': 1.0}
+
+
+def sasl_continue(connection: Connection, command: Dict) -> Dict:
+    conversation = connection.conversation
+    payload = bytes(command.get('payload', b''))
+    if conversation is None:
+        return error('No SASL session state found', 17, 'ProtocolError')
+    if not payload:
+        # The optional empty third step, when the client did not ask to skip it
+        connection.conversation = None
+        return {'conversationId': 1, 'done': True, 'payload': Binary(b''), 'ok': 1.0}
+
+    fields = _scram_fields(payload)
+    credentials = conversation['credentials']
+    digest = credentials['digest']
+    without_proof = payload[:payload.rindex(b',p=')]
+    auth_message = conversation['auth_prefix'] + b',' + without_proof
+    client_signature = hmac.new(credentials['stored_key'], auth_message, digest).digest()
+    client_key = bytes(a ^ b for a, b in zip(base64.b64decode(fields['p']), client_signature))
+    if fields.get('r') != conversation['nonce'] or \
+            not hmac.compare_digest(hashlib.new(digest, client_key).digest(), credentials['stored_key']):
+        connection.conversation = None
+        return error('Authentication failed.', 18, 'AuthenticationFailed')
+
+    connection.user = conversation['username']
+    server_signature = hmac.new(credentials['server_key'], auth_message, digest).digest()
+    connection.conversation = None if conversation['skip_empty'] else conversation
+    return {'conversationId': 1, 'done': conversation['skip_empty'],
+            'payload': Binary(b'v=' + base64.b64encode(server_signature)), 'ok': 1.0}
+
+
+def server_status(node: FakeNode, command: Dict) -> Dict:
+    sections = {
+        'metrics': {'commands': {name: dict(counter) for name, counter in node.counters.items()}},
+        'globalLock': {'totalTime': 1, 'currentQueue': {'total': 0, 'readers': 0, 'writers': 0},
+                       'activeClients': {'total': 0, 'readers': 0, 'writers': 0}},
+        'connections': {'current': node.connections, 'available': 50000}
+    }
+    reply = {'host': node.address, 'version': '7.0.0', 'process': 'mongos' if node.role == 'mongos' else 'mongod',
+             'uptime': 1.0, 'localTime': datetime.now(timezone.utc), 'ok': 1.0}
+    # Like mongod, a section is left out when the command sets it to 0
+    reply.update({name: section for name, section in sections.items() if command.get(name, 1)})
+    return reply
+
+
+def role_names(roles: List) -> List[str]:
+    return [role if isinstance(role, str) else role['role'] for role in roles]
+
+
+def create_user(node: FakeNode, command: Dict) -> Dict:
+    username = command['createUser']
+    if username in node.users:
+        return error(f'User "{username}@admin" already exists', 51003, 'Location51003')
+    unknown = [role for role in role_names(command.get('roles', [])) if role not in BUILTIN_ROLES | node.roles]
+    if unknown:
+        return error(f"Could not find role: {unknown[0]}@admin", 31, 'RoleNotFound')
+    node.users[username] = _scram_credentials(username, command['pwd'])
+    node.user_details[username] = {'roles': role_names(command.get('roles', [])),
+                                   'customData': command.get('customData', {})}
+    return {'ok': 1.0}
+
+
+def update_user(node: FakeNode, command: Dict) -> Dict:
+    username = command['updateUser']
+    if username not in node.users:
+        return error(f"Could not find user \"{username}\" for db \"admin\"", 11, 'UserNotFound')
+    if 'pwd' in command:
+        node.users[username] = _scram_credentials(username, command['pwd'])
+    if 'customData' in command:
+        node.user_details.setdefault(username, {'roles': []})['customData'] = command['customData']
+    return {'ok': 1.0}
+
+
+def create_role(node: FakeNode, command: Dict) -> Dict:
+    role = command['createRole']
+    if role in node.roles:
+        return error(f'Role "{role}@admin" already exists', 51002, 'Location51002')
+    node.roles.add(role)
+    return {'ok': 1.0}
+
+
+def change_user_roles(node: FakeNode, command: Dict) -> Dict:
+    username = command.get('grantRolesToUser') or command.get('revokeRolesFromUser')
+    if username not in node.users:
+        return error(f"Could not find user \"{username}\" for db \"admin\"", 11, 'UserNotFound')
+    details = node.user_details.setdefault(username, {'roles': [], 'customData': {}})
+    changed = role_names(command.get('roles', []))
+    if 'grantRolesToUser' in command:
+        details['roles'] = details['roles'] + [role for role in changed if role not in details['roles']]
+    else:
+        details['roles'] = [role for role in details['roles'] if role not in changed]
+    return {'ok': 1.0}
+
+
+def drop_user(node: FakeNode, command: Dict) -> Dict:
+    node.user_details.pop(command['dropUser'], None)
+    if node.users.pop(command['dropUser'], None) is None:
+        return error(f"User '{command['dropUser']}@admin' not found", 11, 'UserNotFound')
+    return {'ok': 1.0}
+
+
+def drop_role(node: FakeNode, command: Dict) -> Dict:
+    if command['dropRole'] not in node.roles:
+        return error(f"Role '{command['dropRole']}@admin' not found", 31, 'RoleNotFound')
+    node.roles.discard(command['dropRole'])
+    return {'ok': 1.0}
+
+
+def users_info(node: FakeNode, command: Dict) -> Dict:
+    wanted = command['usersInfo']
+    if isinstance(wanted, dict):
+        wanted = wanted.get('user')
+    names = [wanted] if isinstance(wanted, str) else list(node.users)
+    return {'users': [{'_id': f'admin.{name}', 'user': name, 'db': 'admin',
+                       'roles': [{'role': role, 'db': 'admin'}
+                                 for role in node.user_details.get(name, {}).get('roles', [])],
+                       'customData': node.user_details.get(name, {}).get('customData', {})}
+                      for name in names if name in node.users], 'ok': 1.0}
+
+
+def roles_info(node: FakeNode, command: Dict) -> Dict:
+    wanted = command['rolesInfo']
+    if isinstance(wanted, dict):
+        wanted = wanted.get('role')
+    roles = [wanted] if isinstance(wanted, str) else sorted(node.roles)
+    return {'roles': [{'_id': f'admin.{role}', 'role': role, 'db': 'admin'} for role in roles if role in node.roles],
+            'ok': 1.0}
+
+
+def flush_routing_table(node: FakeNode, command: Dict) -> Dict:
+    if node.role != 'shard' or not node.primary:
+        return error('not primary', 10107, 'NotWritablePrimary')
+    node.flushed_at.append(time.time())
+    return {'ok': 1.0}
+
+
+def flush_router_config(node: FakeNode, command: Dict) -> Dict:
+    if node.role != 'mongos':
+        return error('flushRouterConfig may only be run on mongos', 59, 'CommandNotFound')
+    return {'flushed': True, 'ok': 1.0}
+
+
+def repl_set_get_status(node: FakeNode, command: Dict) -> Dict:
+    if node.role == 'mongos':
+        return error('replSetGetStatus is not supported through mongos', 59, 'CommandNotFound')
+    now = datetime.now(timezone.utc)
+    lag = 0.0
+    if node.lagging:
+        faults = node.cluster.faults
+        node.lag_until = node.lag_until or time.monotonic() + faults.lag_duration
+        lag = faults.lag_seconds if time.monotonic() < node.lag_until else 0.0
+    return {'set': node.set_name, 'date': now, 'ok': 1.0,
+            'members': [{'_id': index, 'name': address, 'stateStr': 'PRIMARY' if index == 0 else 'SECONDARY',
+                         'health': 1, 'optimeDate': now if index == 0 else now - timedelta(seconds=lag),
+                         'self': address == node.address}
+                        for index, address in enumerate(node.members)]}
+
+
+def list_shards(node: FakeNode, command: Dict) -> Dict:
+    if node.role != 'mongos':
+        return error('no such command: listShards', 59, 'CommandNotFound')
+    return {'shards': node.cluster.config['shards'], 'ok': 1.0}
+
+
+def _documents(node: FakeNode, db_name: str, collection: str) -> List[Dict]:
+    if node.role == 'mongos' and db_name == 'config':
+        return node.cluster.config.get(collection, [])
+    if f'{db_name}.{collection}' in node.cluster.namespaces:
+        return [{'_id': 1}]
+    return []
+
+
+def find(node: FakeNode, command: Dict) -> Dict:
+    docs = [doc for doc in _documents(node, command['$db'], command['find']) if matches(doc, command.get('filter', {}))]
+    for field, direction in reversed(list(command.get('sort', {}).items())):
+        docs = sorted(docs, key=lambda doc: lookup(doc, field), reverse=direction < 0)
+    if command.get('limit'):
+        docs = docs[:abs(command['limit'])]
+    return cursor_reply(command['$db'], command['find'], docs)
+
+
+def aggregate(node: FakeNode, command: Dict) -> Dict:
+    docs = _documents(node, command['$db'], command['aggregate'])
+    for stage in command.get('pipeline', []):
+        if '$match' in stage:
+            docs = [doc for doc in docs if matches(doc, stage['$match'])]
+        elif '$group' in stage:
+            docs = group(docs, stage['$group'])
+        elif '$limit' in stage:
+            docs = docs[:stage['$limit']]
+        elif '$sort' in stage:
+            for field, direction in reversed(list(stage['$sort'].items())):
+                docs = sorted(docs, key=lambda doc: lookup(doc, field), reverse=direction < 0)
+    return cursor_reply(command['$db'], command['aggregate'], docs)
+
+
+def cursor_reply(db_name: str, collection: str, docs: List[Dict]) -> Dict:
+    return {'cursor': {'id': 0, 'ns': f'{db_name}.{collection}', 'firstBatch': docs}, 'ok': 1.0}
+
+
+def lookup(doc: Dict, path: str):
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def matches(doc: Dict, query: Dict) -> bool:
+    """Evaluate the subset of the query language the tools use."""
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif field == '$and':
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            value = lookup(doc, field)
+            for op, operand in condition.items():
+                if not _compare(value, op, operand):
+                    return False
+        elif lookup(doc, field) != condition:
+            return False
+    return True
+
+
+def _compare(value, op: str, operand) -> bool:
+    if op == '$in':
+        return value in operand
+    if op == '$nin':
+        return value not in operand
+    if op == '$ne':
+        return value != operand
+    if op == '$exists':
+        return (value is not None) == bool(operand)
+    if op == '$regex':
+        return isinstance(value, str) and re.search(operand.pattern if hasattr(operand, 'pattern') else operand,
+                                                    value) is not None
+    if value is None:
+        return False
+    if isinstance(value, datetime) and isinstance(operand, datetime):
+        value, operand = value.replace(tzinfo=None), operand.replace(tzinfo=None)
+    return {'$gt': value > operand, '$gte': value >= operand,
+            '$lt': value < operand, '$lte': value <= operand}.get(op, False)
+
+
+def group(docs: List[Dict], spec: Dict) -> List[Dict]:
+    key_path = spec['_id'][1:] if isinstance(spec['_id'], str) else None
+    groups = {}
+    for doc in docs:
+        key = lookup(doc, key_path) if key_path else spec['_id']
+        result = groups.setdefault(key, {'_id': key})
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            operand = accumulator['$sum']
+            increment = lookup(doc, operand[1:]) if isinstance(operand, str) else operand
+            result[field] = result.get(field, 0) + (increment or 0)
+    return list(groups.values())
+
+
+COMMANDS = {
+    'serverStatus': server_status,
+    'createUser': create_user,
+    'updateUser': update_user,
+    'createRole': create_role,
+    'grantRolesToUser': change_user_roles,
+    'revokeRolesFromUser': change_user_roles,
+    'dropUser': drop_user,
+    'dropRole': drop_role,
+    'usersInfo': users_info,
+    'rolesInfo': roles_info,
+    '_flushRoutingTableCacheUpdatesWithWriteConcern': flush_routing_table,
+    '_flushRoutingTableCacheUpdates': flush_routing_table,
+    'flushRouterConfig': flush_router_config,
+    'replSetGetStatus': repl_set_get_status,
+    'listShards': list_shards,
+    'find': find,
+    'aggregate': aggregate
+}
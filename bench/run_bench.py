@@ -0,0 +1,310 @@
+"""Offline end-to-end benchmark for mongo-cache-flush.py and test-env.py.
+
+Starts a fake sharded cluster (bench/fake_mongod.py) and a fake Cloud Manager
+API (bench/fake_cloud_manager.py) on 127.0.0.1, runs each script against them
+as a subprocess, and reports wall time and node throughput per topology size.
+
+Example:
+    python bench/run_bench.py --shards 10,100,1000 --latency-ms 2 \
+        --variant "" --variant "--concurrency 32 --rate 0" --variant "--async --concurrency 64 --rate 0"
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fake_cloud_manager import FakeCloudManager
+from fake_mongod import FakeCluster, FaultProfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {'flush': 'mongo-cache-flush.py', 'test-env': 'test-env.py'}
+
+PUBLIC_KEY = 'bench-public-key'
+PRIVATE_KEY = 'bench-private-key'
+PROJECT_ID = 'bench-project'
+CLUSTER_ID = 'bench-cluster'
+ADMIN_USER = 'binoymdb'  # Hard-coded in both scripts
+ADMIN_PASSWORD = 'bench-admin-password'
+FLUSH_USER_PASSWORD = 'bench-flush-password'
+NAMESPACE = 'fortnite-service-prod11.profile_v2'  # mongo-cache-flush.py's default namespace
+
+# Lines the scripts print in their final summaries: (succeeded, attempted)
+RESULT_PATTERNS = {
+    'flush': (r'Successful operations: (\d+)', r'Total operations attempted: (\d+)'),
+    'test-env': (r'Successful connections: (\d+)', r'Total nodes tested: (\d+)')
+}
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def raise_file_limit():
+    """Every fake node holds a listening socket, so 1000 shards need a few thousand descriptors."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def run_script(script: str, variant: str, base_url: str, workdir: str, timeout: float,
+               seed_mongos: str = None, stop_after: float = None) -> Dict:
+    """Run one script to completion, feeding its prompts on stdin, and parse its summary.
+
+    With `stop_after`, the script is sent SIGTERM after that many seconds, which is how --daemon runs end.
+    """
+    if script == 'flush':
+        stdin = f"{ADMIN_PASSWORD}\n{FLUSH_USER_PASSWORD}\nC\n"
+    else:
+        stdin = f"{ADMIN_PASSWORD}\n\n"
+
+    env = dict(os.environ, PUBLIC_KEY=PUBLIC_KEY, PRIVATE_KEY=PRIVATE_KEY, PROJECT_ID=PROJECT_ID,
+               CLUSTER_ID=CLUSTER_ID, CM_BASE_URL=base_url)
+    env.setdefault('TOPOLOGY_CACHE_TTL', '0')  # Measure discovery on every run unless asked not to
+    if seed_mongos:
+        env['SEED_MONGOS'] = seed_mongos
+    command = [sys.executable, os.path.join(REPO_DIR, SCRIPTS[script])] + shlex.split(variant)
+
+    # A new session has no controlling terminal, so getpass() reads the passwords from stdin
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, cwd=workdir, env=env, start_new_session=True)
+    try:
+        try:
+            stdout, stderr = process.communicate(stdin, timeout=stop_after or timeout)
+        except subprocess.TimeoutExpired:
+            if not stop_after:
+                raise
+            process.terminate()
+            stdout, stderr = process.communicate(timeout=timeout)
+        output, returncode = stdout + stderr, process.returncode
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+        output, returncode = stdout + stderr, None
+    wall = time.monotonic() - start
+
+    with open(os.path.join(workdir, f"{script}.log"), 'a') as f:
+        f.write(output)
+
+    succeeded_pattern, attempted_pattern = RESULT_PATTERNS[script]
+    succeeded = re.search(succeeded_pattern, output)
+    attempted = re.search(attempted_pattern, output)
+    return {
+        'returncode': returncode,
+        'wall_seconds': wall,
+        'succeeded': int(succeeded.group(1)) if succeeded else 0,
+        'attempted': int(attempted.group(1)) if attempted else 0
+    }
+
+
+def inject_migrations(cluster: FakeCluster, count: int, interval: float, events: List[Dict]):
+    """Migrate `count` random chunks, one every `interval` seconds, appending each changelog event to `events`."""
+    for _ in range(count):
+        events.append(cluster.migrate())
+        time.sleep(interval)
+
+
+def flush_staleness(cluster: FakeCluster, events: List[Dict]) -> List[Optional[float]]:
+    """Seconds from each migration until both its donor and recipient were flushed (None if one never was)."""
+    staleness = []
+    for event in events:
+        migrated_at = event['time'].timestamp()
+        waits = []
+        for set_name in (event['details']['from'], event['details']['to']):
+            flushes = [flushed for node in cluster.shards[set_name] for flushed in node.flushed_at
+                       if flushed >= migrated_at]
+            waits.append(min(flushes) - migrated_at if flushes else None)
+        staleness.append(None if None in waits else max(waits))
+    return staleness
+
+
+def bench_topology(shards: int, args) -> List[Dict]:
+    faults = FaultProfile(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                          flush_latency_ms=args.flush_latency_ms, error_rate=args.error_rate,
+                          lagging_rate=args.lagging_shards, lag_seconds=args.lag_seconds,
+                          lag_duration=args.lag_duration, failover_rate=args.failover_shards,
+                          slow_rate=args.slow_shards, slow_flush_ms=args.slow_flush_ms, seed=args.seed)
+    # With --clusters, the first cluster has `shards` shards and each further one half as many as the previous
+    clusters = [FakeCluster(max(shards >> index, 1), mongos=args.mongos, secondaries=args.secondaries,
+                            namespaces=[NAMESPACE], owning_shards=args.owning_shards, faults=faults,
+                            users={ADMIN_USER: ADMIN_PASSWORD},
+                            cluster_id=CLUSTER_ID if index == 0 else f"{CLUSTER_ID}-{index}")
+                for index in range(args.clusters)]
+    for cluster in clusters:
+        cluster.start()
+    cloud_manager = FakeCloudManager([host for cluster in clusters for host in cluster.host_entries()], PROJECT_ID,
+                                     PUBLIC_KEY, PRIVATE_KEY, latency_ms=args.cm_latency_ms,
+                                     error_rate=args.cm_error_rate, seed=args.seed)
+    cloud_manager.start()
+    # Every shard member, since a failover moves the flushes and users to another one
+    shard_nodes = [node for cluster in clusters for members in cluster.shards.values() for node in members]
+    targets = [{'project': PROJECT_ID, 'cluster': cluster.cluster_id, 'namespaces': [NAMESPACE]}
+               for cluster in clusters]
+    seed_mongos = clusters[0].mongos[0].address if args.seed_mongos else None
+
+    results = []
+    try:
+        for script in args.scripts:
+            for variant in (args.variant if script == 'flush' else [args.test_env_args]):
+                for repeat in range(args.repeat):
+                    flushes_before = sum(node.flush_total() for node in shard_nodes)
+                    auth_writes_before = sum(node.auth_writes() for node in shard_nodes)
+                    # Migrations happen while a flush run is in progress, for --daemon variants
+                    events = []
+                    migrations = threading.Thread(target=inject_migrations, daemon=True,
+                                                  args=(clusters[0], args.migrations, args.migration_interval, events))
+                    if script == 'flush' and args.migrations:
+                        migrations.start()
+                    with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+                        if script == 'flush' and len(clusters) > 1:
+                            with open(os.path.join(workdir, 'targets.json'), 'w') as f:
+                                json.dump(targets, f)
+                            variant_args = f"{variant} --targets targets.json"
+                        else:
+                            variant_args = variant
+                        result = run_script(script, variant_args, cloud_manager.base_url, workdir, args.timeout,
+                                            seed_mongos, args.stop_after if script == 'flush' else None)
+                        if args.keep_logs:
+                            os.makedirs(args.keep_logs, exist_ok=True)
+                            os.replace(os.path.join(workdir, f"{script}.log"),
+                                       os.path.join(args.keep_logs, f"{script}-{shards}-{len(results)}.log"))
+
+                    if migrations.is_alive():
+                        migrations.join()
+                    staleness = flush_staleness(clusters[0], events)
+                    settled = sorted(wait for wait in staleness if wait is not None)
+                    leftover_users = sum(1 for cluster in clusters for node in cluster.primaries().values()
+                                         if len(node.users) > 1)
+                    result.update({
+                        'script': script,
+                        'variant': variant,
+                        'shards': shards,
+                        'repeat': repeat,
+                        'flushes': sum(node.flush_total() for node in shard_nodes) - flushes_before,
+                        'leftover_users': leftover_users,
+                        'auth_writes': sum(node.auth_writes() for node in shard_nodes) - auth_writes_before,
+                        'migrations': len(events),
+                        'unflushed_migrations': len(staleness) - len(settled),
+                        'staleness_p50': settled[len(settled) // 2] if settled else None,
+                        'staleness_max': settled[-1] if settled else None,
+                        'throughput': result['attempted'] / result['wall_seconds'] if result['wall_seconds'] else 0.0
+                    })
+                    results.append(result)
+                    logger.info(f"{script} [{variant or 'defaults'}] {shards} shards: {result['wall_seconds']:.2f}s, "
+                                f"{result['succeeded']}/{result['attempted']} ok")
+    finally:
+        cloud_manager.stop()
+        for cluster in clusters:
+            cluster.stop()
+    return results
+
+
+def print_report(results: List[Dict]):
+    print("\n=== Benchmark Results ===")
+    print(f"{'script':<9} {'variant':<40} {'shards':>6} {'wall s':>8} {'ok/total':>11} {'nodes/s':>8} "
+          f"{'flushes':>8} {'leftover':>8} {'auth wr':>8}")
+    for result in results:
+        status = f"{result['succeeded']}/{result['attempted']}"
+        if result['returncode'] is None:
+            status = 'timeout'
+        print(f"{result['script']:<9} {(result['variant'] or 'defaults')[:40]:<40} {result['shards']:>6} "
+              f"{result['wall_seconds']:>8.2f} {status:>11} {result['throughput']:>8.1f} "
+              f"{result['flushes']:>8} {result['leftover_users']:>8} {result['auth_writes']:>8}")
+
+    migrated = [result for result in results if result['migrations']]
+    if migrated:
+        print("\n=== Migrations ===")
+        print(f"{'variant':<40} {'shards':>6} {'moves':>6} {'unflushed':>9} {'stale p50':>9} {'stale max':>9}")
+        for result in migrated:
+            p50, worst = (f"{result[key]:.2f}" if result[key] is not None else '-'
+                          for key in ('staleness_p50', 'staleness_max'))
+            print(f"{(result['variant'] or 'defaults')[:40]:<40} {result['shards']:>6} {result['migrations']:>6} "
+                  f"{result['unflushed_migrations']:>9} {p50:>9} {worst:>9}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark mongo-cache-flush.py and test-env.py against a "
+                                                 "local fake cluster and Cloud Manager API.")
+    parser.add_argument('--shards', default='10,100',
+                        help="Comma-separated topology sizes to benchmark (default: 10,100)")
+    parser.add_argument('--clusters', type=int, default=1,
+                        help="Fake clusters; with more than one, mongo-cache-flush.py runs with --targets over all of "
+                             "them, and each cluster has half the shards of the previous one")
+    parser.add_argument('--mongos', type=int, default=4, help="Mongos routers per cluster")
+    parser.add_argument('--secondaries', type=int, default=2, help="Secondaries per shard")
+    parser.add_argument('--owning-shards', type=int,
+                        help="Shards that own chunks of the namespace, for --targeted (default: all)")
+    parser.add_argument('--latency-ms', type=float, default=1.0, help="Base reply latency of every command")
+    parser.add_argument('--jitter-ms', type=float, default=0.5, help="Uniform jitter added to the base latency")
+    parser.add_argument('--flush-latency-ms', type=float, default=5.0,
+                        help="Extra latency of the flush command (the w: majority wait)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Probability that any non-handshake command fails")
+    parser.add_argument('--lagging-shards', type=float, default=0.0,
+                        help="Share of shard primaries that report replication lag (for --adaptive)")
+    parser.add_argument('--lag-seconds', type=float, default=30.0, help="Replication lag of a lagging shard")
+    parser.add_argument('--lag-duration', type=float, default=5.0,
+                        help="Seconds a lagging shard stays behind after it is first checked")
+    parser.add_argument('--failover-shards', type=float, default=0.0,
+                        help="Share of shard primaries that step down when the flush user is first created on them")
+    parser.add_argument('--slow-shards', type=float, default=0.0,
+                        help="Share of shard primaries whose flush is slow (for --shard-budget)")
+    parser.add_argument('--slow-flush-ms', type=float, default=3000.0, help="Extra flush latency of a slow shard")
+    parser.add_argument('--cm-latency-ms', type=float, default=50.0, help="Latency of each Cloud Manager page")
+    parser.add_argument('--cm-error-rate', type=float, default=0.0,
+                        help="Probability that a Cloud Manager request returns 503")
+    parser.add_argument('--seed-mongos', action='store_true',
+                        help="Discover through the first fake mongos (SEED_MONGOS) instead of the fake Cloud Manager")
+    parser.add_argument('--migrations', type=int, default=0,
+                        help="Chunk migrations to log in config.changelog during each flush run, for --daemon variants")
+    parser.add_argument('--migration-interval', type=float, default=0.5, help="Seconds between injected migrations")
+    parser.add_argument('--stop-after', type=float, metavar='SECONDS',
+                        help="Send SIGTERM to each flush run after SECONDS, which is how --daemon variants end")
+    parser.add_argument('--scripts', default='flush,test-env',
+                        help="Comma-separated scripts to run: flush, test-env (default: both)")
+    parser.add_argument('--variant', action='append',
+                        help="Arguments for one mongo-cache-flush.py run; repeat to compare (default: none)")
+    parser.add_argument('--test-env-args', default='', help="Arguments for test-env.py")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per script, variant and size")
+    parser.add_argument('--timeout', type=float, default=1800, help="Seconds before a run is abandoned")
+    parser.add_argument('--seed', type=int, help="Seed for injected latency and failures")
+    parser.add_argument('--json', metavar='PATH', help="Also write the results to a JSON file")
+    parser.add_argument('--keep-logs', metavar='DIR', help="Keep each run's output in DIR")
+    args = parser.parse_args()
+    args.shards = [int(size) for size in args.shards.split(',') if size]
+    args.scripts = [script for script in args.scripts.split(',') if script]
+    args.variant = args.variant or ['']
+    unknown = set(args.scripts) - set(SCRIPTS)
+    if unknown:
+        parser.error(f"unknown script(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(args) -> bool:
+    raise_file_limit()
+    results = []
+    for shards in args.shards:
+        results.extend(bench_topology(shards, args))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.json}")
+
+    return all(result['returncode'] is not None for result in results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(parse_args()) else 1)
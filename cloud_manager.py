@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def create_session(public_key: str, private_key: str, pool_size: int = 8,
+                   max_retries: int = 5, backoff_factor: float = 0.5) -> requests.Session:
+    """Create a keep-alive session for the Cloud Manager API.
+
+    The digest auth object lives on the session, so each worker thread answers
+    the Digest challenge once and reuses the nonce for every later page.
+    Responses with status 429 or 5xx are retried with exponential backoff,
+    honouring Retry-After when the API sends it.
+    """
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=['GET'],
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.auth = HTTPDigestAuth(public_key, private_key)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_hosts_page(session: requests.Session, base_url: str, project_id: str, cluster_id: str,
+                     page_num: int, items_per_page: int) -> Dict:
+    """Fetch a single page of /groups/{project_id}/hosts."""
+    host_response = session.get(f'{base_url}/groups/{project_id}/hosts',
+                                params={'clusterId': cluster_id,
+                                        'pageNum': page_num,
+                                        'itemsPerPage': items_per_page},
+                                timeout=30)
+    host_response.raise_for_status()
+    return host_response.json()
+
+
+def iter_host_pages(session: requests.Session, base_url: str, project_id: str, cluster_id: str,
+                    items_per_page: int = 200, max_workers: int = 8,
+                    on_page: Optional[Callable[[int, float], None]] = None) -> Iterator[Tuple[int, List[Dict]]]:
+    """Yield (page_num, hosts) as each page arrives: page 1 first to learn totalCount, then the rest in parallel.
+
+    Pages after the first are yielded in completion order, so a consumer can
+    start work on the hosts of fast pages while slow ones are still in flight.
+    `on_page(page_num, seconds)` is called with each page's latency, retries included.
+    Raises requests.exceptions.RequestException on failure.
+    """
+    def fetch_page(page_num: int) -> Dict:
+        start = time.monotonic()
+        response_data = fetch_hosts_page(session, base_url, project_id, cluster_id, page_num, items_per_page)
+        if on_page:
+            on_page(page_num, time.monotonic() - start)
+        return response_data
+
+    first_page = fetch_page(1)
+    total_count = first_page.get('totalCount', 0)
+    fetched = len(first_page['results'])
+    logger.info(f"Fetched page 1, got {fetched} hosts (Total: {fetched}/{total_count})")
+    yield 1, first_page['results']
+
+    total_pages = -(-total_count // items_per_page)
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            futures = {executor.submit(fetch_page, page_num): page_num for page_num in range(2, total_pages + 1)}
+            for future in as_completed(futures):
+                response_data = future.result()
+                fetched += len(response_data['results'])
+                logger.info(f"Fetched page {futures[future]}, got {len(response_data['results'])} hosts "
+                            f"(Total: {fetched}/{total_count})")
+                yield futures[future], response_data['results']
+
+
+def fetch_all_hosts(session: requests.Session, base_url: str, project_id: str, cluster_id: str,
+                    items_per_page: int = 200, max_workers: int = 8,
+                    on_page: Optional[Callable[[int, float], None]] = None) -> List[Dict]:
+    """Fetch every host of a cluster, in page order.
+
+    Raises requests.exceptions.RequestException on failure.
+    """
+    pages = dict(iter_host_pages(session, base_url, project_id, cluster_id, items_per_page, max_workers, on_page))
+    return [host for page_num in sorted(pages) for host in pages[page_num]]
+
+
+async def fetch_all_hosts_async(base_url: str, project_id: str, cluster_id: str,
+                                public_key: str, private_key: str,
+                                items_per_page: int = 200, max_workers: int = 8,
+                                max_retries: int = 5, backoff_factor: float = 0.5,
+                                on_page: Optional[Callable[[int, float], None]] = None) -> List[Dict]:
+    """Async variant of fetch_all_hosts on a single pooled httpx client.
+
+    Raises httpx.HTTPError on failure.
+    """
+    limits = httpx.Limits(max_connections=max(max_workers, 1), max_keepalive_connections=max(max_workers, 1))
+    semaphore = asyncio.Semaphore(max(max_workers, 1))
+
+    async with httpx.AsyncClient(auth=httpx.DigestAuth(public_key, private_key),
+                                 limits=limits, timeout=30) as http:
+        async def fetch_page(page_num: int) -> Dict:
+            async with semaphore:
+                start = time.monotonic()
+                for attempt in range(max_retries + 1):
+                    host_response = await http.get(f'{base_url}/groups/{project_id}/hosts',
+                                                   params={'clusterId': cluster_id,
+                                                           'pageNum': page_num,
+                                                           'itemsPerPage': items_per_page})
+                    if host_response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                        break
+                    delay = retry_after_seconds(host_response.headers.get('Retry-After'))
+                    if delay is None:
+                        delay = backoff_factor * (2 ** attempt) * (1 + random.random())
+                    logger.warning(f"Page {page_num} returned {host_response.status_code}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                host_response.raise_for_status()
+                if on_page:
+                    on_page(page_num, time.monotonic() - start)
+                return host_response.json()
+
+        first_page = await fetch_page(1)
+        all_hosts = list(first_page['results'])
+        total_count = first_page.get('totalCount', 0)
+        logger.info(f"Fetched page 1, got {len(all_hosts)} hosts (Total: {len(all_hosts)}/{total_count})")
+
+        total_pages = -(-total_count // items_per_page)
+        pages = await asyncio.gather(*(fetch_page(page_num) for page_num in range(2, total_pages + 1)))
+        for page_num, response_data in enumerate(pages, 2):
+            all_hosts.extend(response_data['results'])
+            logger.info(f"Fetched page {page_num}, got {len(response_data['results'])} hosts "
+                        f"(Total: {len(all_hosts)}/{total_count})")
+
+    return all_hosts
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse a numeric Retry-After header; HTTP-date values fall back to normal backoff."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,105 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from connection_registry import ClientRegistry
+from topology_cache import hello, split_host
+
+logger = logging.getLogger(__name__)
+
+# config.mongos keeps every router that ever connected; only recently pinging ones are used
+MONGOS_MAX_PING_AGE = 600
+
+
+def parse_shard_host(host: str) -> Tuple[str, List[str]]:
+    """Split a listShards host string ('rs/h1:p,h2:p') into the replica set name and its seed list."""
+    set_name, _, seeds = host.partition('/')
+    if not seeds:
+        # A standalone shard has no replica set prefix
+        return set_name, [set_name]
+    return set_name, [seed for seed in seeds.split(',') if seed]
+
+
+def active_mongos(client: MongoClient, max_ping_age: float = MONGOS_MAX_PING_AGE) -> List[Dict]:
+    """Routers in config.mongos that pinged in the last `max_ping_age` seconds."""
+    since = datetime.now(timezone.utc) - timedelta(seconds=max_ping_age)
+    return [split_host(doc['_id']) for doc in client.config.mongos.find({'ping': {'$gte': since}}, {'_id': 1})]
+
+
+def find_primary(set_name: str, seeds: List[str], timeout_ms: int = 2000) -> Optional[Dict]:
+    """Ask the seeds of a replica set for its current primary with `hello`, stopping at the first answer."""
+    for seed in seeds:
+        node = split_host(seed)
+        reply = hello(node['hostname'], node['port'], timeout_ms)
+        if reply is None:
+            continue
+        if reply.get('setName') not in (None, set_name):
+            logger.warning(f"{seed} belongs to {reply.get('setName')}, not {set_name}")
+            continue
+        if reply.get('isWritablePrimary') or reply.get('ismaster'):
+            return node
+        if reply.get('primary'):
+            return split_host(reply['primary'])
+    return None
+
+
+def discover_from_mongos(client: MongoClient, timeout_ms: int = 2000, max_workers: int = 32,
+                         max_ping_age: float = MONGOS_MAX_PING_AGE) -> Tuple[List[Dict], Dict, Dict[str, List[str]]]:
+    """Discover the cluster through a mongos instead of Cloud Manager.
+
+    Reads the shards from `listShards` and the routers from config.mongos,
+    then resolves every shard's current primary with parallel `hello` calls
+    against its seed list. `client` must be connected to a mongos as a user
+    allowed to run listShards. Returns (mongos_nodes, shard_primaries,
+    shard_members) keyed by replica set name, like the Cloud Manager
+    discovery; shards with no reachable primary are left out and logged.
+    """
+    shard_members = dict(parse_shard_host(shard['host'])
+                         for shard in client.admin.command('listShards')['shards'])
+    mongos_nodes = active_mongos(client, max_ping_age)
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(shard_members)), 1)) as executor:
+        primaries = list(executor.map(lambda item: find_primary(item[0], item[1], timeout_ms),
+                                      shard_members.items()))
+
+    shard_primaries = {}
+    for set_name, primary in zip(shard_members, primaries):
+        if primary is None:
+            logger.warning(f"No primary found for shard {set_name}")
+            continue
+        shard_primaries[set_name] = primary
+
+    return mongos_nodes, shard_primaries, shard_members
+
+
+def discover_from_seed(seed: str, registry: ClientRegistry, username: Optional[str], password: Optional[str],
+                       timeout_ms: int = 2000, max_workers: int = 32) -> Optional[Tuple[List[Dict], Dict, Dict]]:
+    """Discover (mongos_nodes, shard_primaries, shard_members) through a seed mongos.
+
+    Connects to `seed` through `registry` and runs discover_from_mongos.
+    Returns None when the seed cannot be used or any shard has no reachable
+    primary, so the caller falls back to Cloud Manager.
+    """
+    try:
+        node = split_host(seed)
+        logger.info(f"Discovering the cluster through mongos {seed}...")
+        with registry.client(node['hostname'], node['port'], username, password) as client:
+            mongos_nodes, shard_primaries, shard_members = discover_from_mongos(
+                client, timeout_ms=timeout_ms, max_workers=max_workers)
+    except Exception as e:
+        logger.warning(f"Discovery through mongos {seed} failed, falling back to Cloud Manager: {e}")
+        return None
+
+    if len(shard_primaries) < len(shard_members) or not shard_primaries:
+        logger.warning(f"Resolved {len(shard_primaries)}/{len(shard_members)} shard primaries through mongos {seed}, "
+                       "falling back to Cloud Manager")
+        return None
+
+    # Routers that have not pinged config.mongos recently are left out; the seed is known to be up
+    if not mongos_nodes:
+        mongos_nodes = [node]
+    logger.info(f"Found {len(mongos_nodes)} mongos and {len(shard_primaries)} shards through mongos {seed}")
+    return mongos_nodes, shard_primaries, shard_members
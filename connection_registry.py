@@ -0,0 +1,125 @@
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """Keeps one authenticated client per (host, port, user) warm for the whole run.
+
+    Every phase that talks to the same node with the same credential reuses the
+    client, so the TCP, TLS and SCRAM handshakes happen once per node instead of
+    once per phase. At most `max_clients` clients are kept; when the limit is
+    reached the least recently used idle client is closed. Each client holds at
+    most `maxPoolSize` sockets, which bounds the total socket count.
+
+    `client_class` may be MongoClient or an async client (AsyncMongoClient or
+    Motor); use client()/close_all() for the former and aclient()/aclose_all()
+    for the latter.
+    """
+
+    def __init__(self, max_clients: int = 256, client_class=MongoClient, **client_options):
+        self.max_clients = max_clients
+        self.client_class = client_class
+        self.client_options = {
+            'directConnection': True,
+            'connectTimeoutMS': 5000,
+            'serverSelectionTimeoutMS': 5000,
+            'maxPoolSize': 2,
+            **client_options
+        }
+        self._clients = OrderedDict()
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def _lease(self, hostname: str, port: int, username: Optional[str], password: Optional[str]):
+        """Return (key, client, evicted_clients) and mark the client as in use."""
+        key = (hostname, int(port), username)
+        evicted = []
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                evicted = self._evict_idle(len(self._clients) + 1 - self.max_clients)
+                credentials = {'username': username, 'password': password, 'authSource': 'admin'} if username else {}
+                client = self.client_class(host=hostname, port=int(port), **credentials, **self.client_options)
+                self._clients[key] = client
+            self._clients.move_to_end(key)
+            self._leases[key] = self._leases.get(key, 0) + 1
+        return key, client, evicted
+
+    def _release(self, key):
+        with self._lock:
+            if key in self._leases:
+                self._leases[key] -= 1
+
+    def _evict_idle(self, count: int) -> list:
+        """Remove up to `count` idle clients, least recently used first. Caller holds the lock."""
+        evicted = []
+        for key in list(self._clients):
+            if len(evicted) >= count:
+                break
+            if self._leases.get(key, 0) == 0:
+                evicted.append(self._clients.pop(key))
+                self._leases.pop(key, None)
+        if len(evicted) < count:
+            logger.debug(f"Client registry over capacity ({len(self._clients) + 1}/{self.max_clients}), all clients in use")
+        return evicted
+
+    @contextmanager
+    def client(self, hostname: str, port: int, username: Optional[str] = None, password: Optional[str] = None):
+        """Lease the shared MongoClient for a node and credential."""
+        key, client, evicted = self._lease(hostname, port, username, password)
+        for old_client in evicted:
+            old_client.close()
+        try:
+            yield client
+        finally:
+            self._release(key)
+
+    @asynccontextmanager
+    async def aclient(self, hostname: str, port: int, username: Optional[str] = None, password: Optional[str] = None):
+        """Async variant of client() for async client classes."""
+        key, client, evicted = self._lease(hostname, port, username, password)
+        for old_client in evicted:
+            await close_client(old_client)
+        try:
+            yield client
+        finally:
+            self._release(key)
+
+    def discard(self, hostname: str, port: int, username: Optional[str] = None):
+        """Remove a client (e.g. after its user was dropped) and return it so the caller can close it."""
+        with self._lock:
+            client = self._clients.pop((hostname, int(port), username), None)
+            self._leases.pop((hostname, int(port), username), None)
+        return client
+
+    def _drain(self) -> list:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._leases.clear()
+        return clients
+
+    def close_all(self):
+        """Close every client held by the registry."""
+        for client in self._drain():
+            client.close()
+
+    async def aclose_all(self):
+        """Async variant of close_all()."""
+        for client in self._drain():
+            await close_client(client)
+
+
+async def close_client(client):
+    """PyMongo's AsyncMongoClient.close() is a coroutine, Motor's is not."""
+    result = client.close()
+    if inspect.isawaitable(result):
+        await result
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import json
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+
+from rate_limit import RetryLater
+
+
+def load_targets(path: str, default_namespaces: List[str]) -> List[Dict]:
+    """Read the clusters to flush from a JSON list of targets.
+
+    Each target needs 'project' and 'cluster' (the Cloud Manager ids).
+    'namespaces' defaults to `default_namespaces` and 'name' to the cluster
+    id; 'seed_mongos' and 'concurrency' are optional per-cluster overrides.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a non-empty JSON list of targets")
+
+    targets = []
+    for idx, entry in enumerate(entries, 1):
+        missing = [key for key in ('project', 'cluster') if not entry.get(key)]
+        if missing:
+            raise ValueError(f"Target {idx} in {path} is missing {', '.join(missing)}")
+        name = entry.get('name') or entry['cluster']
+        if '/' in name or any(target['name'] == name for target in targets):
+            # Shards are journaled as <name>/<shard>, so names must be unique and slash-free
+            raise ValueError(f"Target name {name!r} in {path} is duplicated or contains '/'")
+        targets.append({
+            'name': name,
+            'project': entry['project'],
+            'cluster': entry['cluster'],
+            'namespaces': entry.get('namespaces') or default_namespaces,
+            'seed_mongos': entry.get('seed_mongos'),
+            'concurrency': entry.get('concurrency')
+        })
+    return targets
+
+
+def run_with_budgets(tasks: Dict[str, List], run: Callable, global_limit: int,
+                     group_limits: Dict[str, int]) -> Dict[str, List]:
+    """Call run(group, task) for every task of every group and return group -> results.
+
+    At most `global_limit` calls are in flight overall and `group_limits[group]`
+    per group. Free slots are handed to the groups round-robin, so one large
+    group cannot hold the whole global budget while the others wait. A call
+    that raises RetryLater frees its slot, and its task is queued again once
+    the delay has passed.
+    """
+    global_limit = max(global_limit, 1)
+    queues = {group: deque(items) for group, items in tasks.items()}
+    limits = {group: max(group_limits.get(group) or global_limit, 1) for group in tasks}
+    in_flight = {group: 0 for group in tasks}
+    results = {group: [] for group in tasks}
+    order = deque(tasks)
+    futures = {}
+    delayed = []
+    sequence = itertools.count()
+
+    def next_group():
+        for _ in range(len(order)):
+            group = order[0]
+            order.rotate(-1)
+            if queues[group] and in_flight[group] < limits[group]:
+                return group
+        return None
+
+    with ThreadPoolExecutor(max_workers=global_limit) as executor:
+        while futures or delayed or any(queues.values()):
+            while delayed and delayed[0][0] <= time.monotonic():
+                _, _, group, task = heapq.heappop(delayed)
+                queues[group].append(task)
+
+            while len(futures) < global_limit:
+                group = next_group()
+                if group is None:
+                    break
+                in_flight[group] += 1
+                task = queues[group].popleft()
+                futures[executor.submit(run, group, task)] = (group, task)
+
+            timeout = max(delayed[0][0] - time.monotonic(), 0) if delayed else None
+            if not futures:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                group, task = futures.pop(future)
+                in_flight[group] -= 1
+                try:
+                    results[group].append(future.result())
+                except RetryLater as e:
+                    heapq.heappush(delayed, (time.monotonic() + e.delay, next(sequence), group, task))
+
+    return results
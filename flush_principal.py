@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import hmac
+import time
+
+from step_runner import Command, Steps
+
+# Role of the per-run flush user, created and dropped on every shard
+FLUSH_ROLE = 'flush_routing_table_cache_updates'
+FLUSH_PRIVILEGES = [{'resource': {'cluster': True}, 'actions': ['internal']}]
+
+
+def derive_password(secret: str, period: int) -> str:
+    """Password of the persistent flush user for one rotation period.
+
+    Derived from the operator's secret, so every run computes the same
+    password without it being stored anywhere.
+    """
+    digest = hmac.new(secret.encode(), f"flush-user:{period}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def password_fingerprint(password: str) -> str:
+    """Short hash of a derived password, safe to keep in customData: the password itself has 256 random bits."""
+    return hashlib.sha256(password.encode()).hexdigest()[:16]
+
+
+class PersistentFlushUser:
+    """A long-lived flush user that holds only its own flush role and is reused across runs.
+
+    The role has the same privileges as FLUSH_ROLE but a separate name, since
+    per-run cleanup drops FLUSH_ROLE. Any other role the user holds is revoked.
+
+    Its password rotates every `rotation_interval` seconds. The period it was
+    last set for and a fingerprint of the password are kept in the user's
+    customData, so a single usersInfo round trip shows whether anything needs
+    writing, including after the secret itself changed. Disabled until
+    `enabled` is set.
+    """
+
+    def __init__(self, username: str, role: str, secret: str, rotation_interval: float):
+        self.username = username
+        self.role = role
+        self.secret = secret
+        self.rotation_interval = rotation_interval
+        self.enabled = False
+
+    def ensure(self, admin_db) -> Steps:
+        """Create, repair or rotate the user as needed. Returns (password, names of the commands run)."""
+        period = int(time.time() // self.rotation_interval)
+        password = derive_password(self.secret, period)
+        custom_data = {'passwordPeriod': period, 'passwordFingerprint': password_fingerprint(password)}
+
+        users = (yield Command(admin_db, 'usersInfo', self.username))['users']
+        user = users[0] if users else None
+        if user is None:
+            commands = [('createUser', {'pwd': password, 'roles': [self.role], 'customData': custom_data})]
+            role_missing = True
+        else:
+            commands = []
+            roles = user.get('roles', [])
+            role_missing = self.role not in {role['role'] for role in roles}
+            if role_missing:
+                commands.append(('grantRolesToUser', {'roles': [self.role]}))
+            extra_roles = [{'role': role['role'], 'db': role['db']} for role in roles if role['role'] != self.role]
+            if extra_roles:
+                commands.append(('revokeRolesFromUser', {'roles': extra_roles}))
+            if user.get('customData', {}).get('passwordFingerprint') != custom_data['passwordFingerprint']:
+                commands.append(('updateUser', {'pwd': password, 'customData': custom_data}))
+
+        run = [command for command, _ in commands]
+        if role_missing and not (yield Command(admin_db, 'rolesInfo', self.role))['roles']:
+            yield Command(admin_db, 'createRole', self.role, privileges=FLUSH_PRIVILEGES, roles=[])
+            run.insert(0, 'createRole')
+        for command, options in commands:
+            yield Command(admin_db, command, self.username, **options)
+        return password, run
@@ -0,0 +1,64 @@
+import logging
+import time
+from typing import Dict
+
+from step_runner import Command, Sleep, Steps
+
+logger = logging.getLogger(__name__)
+
+FLUSH_COMMAND = '_flushRoutingTableCacheUpdatesWithWriteConcern'
+
+# serverStatus sections excluded when reading the flush counters; only
+# metrics.commands is needed, so everything else is switched off.
+EXCLUDED_SECTIONS = {section: 0 for section in [
+    'asserts', 'batchedDeletes', 'catalogStats', 'collectionCatalog', 'connections', 'defaultRWConcern',
+    'electionMetrics', 'extra_info', 'featureCompatibilityVersion', 'flowControl', 'globalLock', 'health',
+    'indexBuilds', 'indexBulkBuilder', 'locks', 'logicalSessionRecordCache', 'mirroredReads', 'network',
+    'opLatencies', 'opReadConcernCounters', 'opWriteConcernCounters', 'opcounters', 'opcountersRepl',
+    'oplogTruncation', 'queryAnalyzers', 'readConcernCounters', 'recordStats', 'repl', 'scramCache',
+    'security', 'sharding', 'shardingStatistics', 'shardedIndexConsistency', 'storageEngine', 'tcmalloc',
+    'tenantMigrations', 'trafficRecording', 'transactions', 'transportSecurity',
+    'twoPhaseCommitCoordinator', 'watchdog', 'wiredTiger'
+]}
+
+
+def flush_counters(status: Dict) -> Dict[str, int]:
+    """Extract the flush command counters from a serverStatus reply."""
+    metrics = status.get('metrics', {}).get('commands', {}).get(FLUSH_COMMAND, {})
+    return {'total': int(metrics.get('total', 0)), 'failed': int(metrics.get('failed', 0))}
+
+
+def read_flush_counters(admin_db) -> Steps:
+    """Read only the flush counters, with every other serverStatus section excluded."""
+    return flush_counters((yield Command(admin_db, 'serverStatus', 1, **EXCLUDED_SECTIONS)))
+
+
+def delta_ok(before: Dict[str, int], after: Dict[str, int], expected: int) -> bool:
+    """True when at least `expected` flushes were counted and none of them failed."""
+    return after['total'] - before['total'] >= expected and after['failed'] - before['failed'] == 0
+
+
+def backoff_delays(deadline: float, initial: float = 0.01, maximum: float = 0.25):
+    """Yield sleep intervals that double up to `maximum` until `deadline` seconds have passed."""
+    end = time.monotonic() + deadline
+    delay = initial
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, maximum)
+
+
+def wait_for_flush_delta(admin_db, before: Dict[str, int], expected: int, deadline: float = 2.0) -> Steps:
+    """Poll the flush counters until the expected delta shows up or `deadline` seconds pass.
+
+    Returns (verified, last_counters). A failed flush ends the wait early.
+    """
+    after = yield from read_flush_counters(admin_db)
+    for delay in backoff_delays(deadline):
+        if delta_ok(before, after, expected) or after['failed'] > before['failed']:
+            break
+        yield Sleep(delay)
+        after = yield from read_flush_counters(admin_db)
+    return delta_ok(before, after, expected), after
@@ -0,0 +1,104 @@
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, List
+
+from phase_metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+LATENCY_MAP_FILE = 'latency_map.json'
+
+# Connection phases measured per node by test-env.py, in seconds
+PHASES = ['connect', 'auth', 'rtt']
+
+# A node is an outlier when a phase takes this many times the cluster median
+OUTLIER_FACTOR = 3.0
+
+
+def phase_percentiles(nodes: Dict[str, Dict]) -> Dict[str, Dict[str, float]]:
+    """p50/p95/p99/max of each phase over the nodes that answered."""
+    stats = {}
+    for phase in PHASES + ['total']:
+        values = sorted(node[phase] for node in nodes.values() if node['ok'])
+        stats[phase] = {'p50': percentile(values, 0.50), 'p95': percentile(values, 0.95),
+                        'p99': percentile(values, 0.99), 'max': values[-1] if values else 0.0}
+    return stats
+
+
+def find_outliers(nodes: Dict[str, Dict], stats: Dict[str, Dict[str, float]]) -> List[Dict]:
+    """Nodes with a phase above OUTLIER_FACTOR x its median and the cluster's p95, slowest first."""
+    outliers = []
+    for address, node in nodes.items():
+        if not node['ok']:
+            continue
+        slow = [phase for phase in PHASES
+                if node[phase] > OUTLIER_FACTOR * stats[phase]['p50'] and node[phase] >= stats[phase]['p95']]
+        if slow:
+            outliers.append({'node': address, 'name': node['name'], 'phases': slow, 'total': node['total']})
+    return sorted(outliers, key=lambda outlier: outlier['total'], reverse=True)
+
+
+def recommend(nodes: Dict[str, Dict], stats: Dict[str, Dict[str, float]], sweep_concurrency: int) -> Dict:
+    """Derive a concurrency and per-node timeout for mongo-cache-flush.py from the sweep.
+
+    The sweep ran with `sweep_concurrency` nodes in flight. That level is kept
+    while the RTT tail stays within twice the median, scaled down as the tail
+    widens, and halved again if more than 1% of nodes failed. The timeout is
+    four times the slowest-percentile connect + auth + RTT, between 1 and 30s.
+    """
+    failed = sum(1 for node in nodes.values() if not node['ok'])
+    rtt = stats['rtt']
+    tail_ratio = rtt['p99'] / rtt['p50'] if rtt['p50'] > 0 else 1.0
+
+    concurrency = sweep_concurrency * min(1.0, 2.0 / tail_ratio)
+    if nodes and failed / len(nodes) > 0.01:
+        concurrency /= 2
+    concurrency = max(1, min(int(concurrency), len(nodes) or 1))
+
+    node_timeout = min(max(math.ceil(stats['total']['p99'] * 4 * 10) / 10, 1.0), 30.0)
+    return {'concurrency': concurrency, 'node_timeout': node_timeout}
+
+
+def build_latency_map(nodes: Dict[str, Dict], sweep_concurrency: int) -> Dict:
+    """Assemble the latency map written by test-env.py.
+
+    `nodes` maps host:port to {'name', 'role', 'ok', 'error', 'connect', 'auth', 'rtt'}.
+    """
+    for node in nodes.values():
+        node['total'] = sum(node[phase] for phase in PHASES) if node['ok'] else 0.0
+
+    stats = phase_percentiles(nodes)
+    return {
+        'generated_at': time.time(),
+        'sweep_concurrency': sweep_concurrency,
+        'nodes': nodes,
+        'percentiles': stats,
+        'outliers': find_outliers(nodes, stats),
+        'failed': sorted(address for address, node in nodes.items() if not node['ok']),
+        'recommendation': recommend(nodes, stats, sweep_concurrency)
+    }
+
+
+def save_latency_map(latency_map: Dict, path: str = LATENCY_MAP_FILE):
+    with open(path, 'w') as f:
+        json.dump(latency_map, f, indent=2)
+
+
+def load_recommendation(max_age: float, path: str = LATENCY_MAP_FILE) -> Dict:
+    """Return the recommendation of a latency map younger than `max_age` seconds, or {}."""
+    if max_age <= 0 or not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path) as f:
+            latency_map = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable latency map {path}: {e}")
+        return {}
+
+    if time.time() - latency_map.get('generated_at', 0) > max_age:
+        return {}
+    return latency_map.get('recommendation', {})
@@ -0,0 +1,98 @@
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
+
+from pymongo import MongoClient
+
+# config.changelog events after which the shards involved hold stale routing metadata
+CHUNK_EVENTS = ['moveChunk.commit', 'split', 'multi-split', 'merge']
+
+
+def involved_shards(event: Dict) -> Set[str]:
+    """Shard ids an event changed: the donor and recipient of a migration, or the shard that split or merged."""
+    details = event.get('details') or {}
+    return {shard for shard in (details.get('from'), details.get('to'), event.get('shard'))
+            if shard and shard != 'config'}
+
+
+def namespace_selected(namespace: str, patterns: List[str]) -> bool:
+    """Whether `namespace` matches one of the --namespace values ('db.coll' or 'db.*'); no patterns match all."""
+    if not patterns:
+        return True
+    return any(namespace == pattern or (pattern.endswith('.*') and namespace.startswith(pattern[:-1]))
+               for pattern in patterns)
+
+
+class ChangelogTail:
+    """Reads new chunk events from config.changelog, polling by event time.
+
+    Change streams cannot be opened on the config database, so the changelog
+    is queried for events at or after the newest time already seen. The ids
+    seen at that time are excluded, so events sharing a timestamp are neither
+    skipped nor read twice.
+    """
+
+    def __init__(self, lookback: float = 60, batch_size: int = 1000):
+        self.since = datetime.now(timezone.utc) - timedelta(seconds=lookback)
+        self.batch_size = batch_size
+        self._seen_at_since = set()
+
+    def poll(self, client: MongoClient) -> List[Dict]:
+        """Return the events logged since the last poll, oldest first. `client` must be connected to a mongos."""
+        events = list(client.config.changelog.find(
+            {'what': {'$in': CHUNK_EVENTS}, 'time': {'$gte': self.since},
+             '_id': {'$nin': list(self._seen_at_since)}},
+            {'what': 1, 'ns': 1, 'time': 1, 'shard': 1, 'details.from': 1, 'details.to': 1}
+        ).sort('time', 1).limit(self.batch_size))
+
+        for event in events:
+            # Dates come back naive unless the client is tz_aware
+            event_time = event['time'] if event['time'].tzinfo else event['time'].replace(tzinfo=timezone.utc)
+            if event_time > self.since:
+                self.since = event_time
+                self._seen_at_since = set()
+            self._seen_at_since.add(event['_id'])
+        return events
+
+
+class ChangeQueue:
+    """Shards waiting to be flushed, coalesced and debounced per namespace.
+
+    Each event for a namespace adds its shards to that namespace's entry and
+    moves the entry's flush time to `debounce` seconds later, but never past
+    `max_delay` after the entry's first event, so a namespace that keeps
+    changing is still flushed regularly. At most `max_pending` namespaces
+    wait; one more makes the oldest due at once instead of growing the queue.
+    """
+
+    def __init__(self, debounce: float, max_delay: float, max_pending: int):
+        self.debounce = debounce
+        self.max_delay = max(max_delay, debounce)
+        self.max_pending = max(max_pending, 1)
+        self._entries: Dict[str, Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, namespace: str, shards: Set[str], now: float = None):
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(namespace)
+        if entry is None:
+            if len(self._entries) >= self.max_pending:
+                oldest = min(self._entries.values(), key=lambda item: item['first'])
+                oldest['due'] = now
+            entry = self._entries[namespace] = {'shards': set(), 'first': now, 'due': now}
+        entry['shards'] |= shards
+        entry['due'] = max(entry['due'], min(now + self.debounce, entry['first'] + self.max_delay))
+
+    def next_due(self) -> Optional[float]:
+        return min((entry['due'] for entry in self._entries.values()), default=None)
+
+    def take_due(self, now: float = None, everything: bool = False) -> Dict[str, List[str]]:
+        """Remove the namespaces that are due (or all of them) and return shard -> namespaces to flush."""
+        now = time.monotonic() if now is None else now
+        batch = {}
+        for namespace in [namespace for namespace, entry in self._entries.items() if everything or entry['due'] <= now]:
+            for shard in self._entries.pop(namespace)['shards']:
+                batch.setdefault(shard, []).append(namespace)
+        return batch
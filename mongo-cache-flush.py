@@ -1,12 +1,55 @@
 from getpass import getpass
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import signal
+import sys
+import threading
 import time
-from requests.auth import HTTPDigestAuth
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import pymongo
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, NotPrimaryError, WriteConcernError, WTimeoutError
 import requests
-from pymongo import MongoClient
 import logging
-from typing import List, Dict
-import json
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 import os
+import re
+
+from cloud_manager import create_session, fetch_all_hosts, fetch_all_hosts_async, iter_host_pages
+from cluster_discovery import discover_from_seed
+from connection_registry import ClientRegistry
+from fleet import load_targets, run_with_budgets
+from flush_principal import FLUSH_ROLE, PersistentFlushUser
+from flush_verify import read_flush_counters, wait_for_flush_delta
+from latency_map import LATENCY_MAP_FILE, load_recommendation
+from migration_watch import ChangelogTail, ChangeQueue, involved_shards, namespace_selected
+from phase_metrics import CommandTimingListener, PhaseMetrics
+from rate_limit import AIMDLimiter, RetryLater, TokenBucket, jittered_backoff
+from result_stream import ResultStream
+from run_journal import (CLEANED_UP, FAILED, FLUSHED, JOURNAL_FILE, PLANNED, PROVISIONED, VERIFIED, RunJournal,
+                         load_run, mongos_to_redo, shards_needing_cleanup, shards_to_redo)
+from shard_health import HealthGate
+from shard_ownership import plan_targeted_flush, shard_replica_sets
+from step_runner import Blocking, Command, Discard, Lease, Parallel, Sleep, Steps, run_steps, run_steps_async
+from stragglers import StragglerQueue
+from topology_cache import (TOPOLOGY_FILE, get_cached_topology, load_shard_members, resolve_primary, save_topology,
+                            shard_members_from_hosts, split_host)
+
+# Optional dependencies for the asyncio run mode
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
 
 # Configuration
 PUBLIC_KEY = os.environ.get('PUBLIC_KEY')
@@ -21,9 +64,70 @@ NEW_USER = 'mongops'
 NEW_USER_PASSWORD = getpass("Enter flush user password: ")
 NAMESPACE='fortnite-service-prod11.profile_v2'
 
+# Persistent flush user (--persistent-user); its password is derived from the flush user password above
+PERSISTENT_FLUSH_USER = os.environ.get('PERSISTENT_FLUSH_USER', 'mongops_flush')  # Kept between runs, holds only the flush role
+PERSISTENT_FLUSH_ROLE = os.environ.get('PERSISTENT_FLUSH_ROLE', 'mongops_flush_routing_table_cache_updates')  # Its role, never dropped by per-run cleanup
+FLUSH_USER_ROTATION_DAYS = float(os.environ.get('FLUSH_USER_ROTATION_DAYS', '30'))  # Days before its password is rotated
+
+# Recommended concurrency and per-node timeout from a recent test-env.py sweep, if any
+LATENCY_MAP_MAX_AGE = float(os.environ.get('LATENCY_MAP_MAX_AGE', '3600'))  # Seconds a sweep is trusted (0 = ignore)
+RECOMMENDED = load_recommendation(LATENCY_MAP_MAX_AGE, LATENCY_MAP_FILE)
+
+# Concurrency config
+FLUSH_CONCURRENCY = int(os.environ.get('FLUSH_CONCURRENCY', RECOMMENDED.get('concurrency', 1)))  # Max shards in flight
+FLUSH_RATE = float(os.environ.get('FLUSH_RATE', '5'))  # Shards started per second (0 = unlimited)
+CLUSTER_CONCURRENCY = int(os.environ.get('CLUSTER_CONCURRENCY', '0'))  # Max shards in flight per cluster with --targets (0 = no extra cap)
+
+# Adaptive concurrency config (--adaptive)
+ADAPTIVE_MAX_LAG = float(os.environ.get('ADAPTIVE_MAX_LAG', '10'))  # Seconds of replication lag before a shard is paused
+ADAPTIVE_MAX_QUEUED = int(os.environ.get('ADAPTIVE_MAX_QUEUED', '50'))  # Queued operations before a shard is paused
+ADAPTIVE_MAX_FLUSH_LATENCY = float(os.environ.get('ADAPTIVE_MAX_FLUSH_LATENCY', '2'))  # Seconds per namespace
+ADAPTIVE_MAX_PAUSE = float(os.environ.get('ADAPTIVE_MAX_PAUSE', '60'))  # Seconds a shard may wait before it is skipped
+
+# Per-shard deadlines
+SHARD_BUDGET = float(os.environ.get('SHARD_BUDGET', '0'))  # Seconds a shard may take before it is retried at the end (0 = no limit)
+STRAGGLER_ROUNDS = int(os.environ.get('STRAGGLER_ROUNDS', '2'))  # End-of-run retries of shards that ran out of budget
+STRAGGLER_BUDGET_FACTOR = float(os.environ.get('STRAGGLER_BUDGET_FACTOR', '4'))  # Budget multiplier per retry round
+
+# Failover handling
+FAILOVER_RETRIES = int(os.environ.get('FAILOVER_RETRIES', '3'))  # Retries of a shard whose primary stepped down
+FAILOVER_BACKOFF = float(os.environ.get('FAILOVER_BACKOFF', '1'))  # Seconds before the first retry, doubled each time
+FAILOVER_MAX_BACKOFF = float(os.environ.get('FAILOVER_MAX_BACKOFF', '15'))  # Cap on the retry delay
+FAILOVER_HELLO_TIMEOUT = float(os.environ.get('FAILOVER_HELLO_TIMEOUT', '1'))  # Seconds per member when re-resolving the primary
+
+# Mongos warm-up config
+MONGOS_FANOUT = int(os.environ.get('MONGOS_FANOUT', '8'))  # Mongos probed at the same time
+MONGOS_PROBE_TIMEOUT = float(os.environ.get('MONGOS_PROBE_TIMEOUT', RECOMMENDED.get('node_timeout', 5)))  # Seconds before a probe is cancelled
+
 # API Setup
-BASE_URL = 'https://cloud.mongodb.com/api/public/v1.0'
-DIGEST_AUTH = HTTPDigestAuth(PUBLIC_KEY, PRIVATE_KEY)
+BASE_URL = os.environ.get('CM_BASE_URL', 'https://cloud.mongodb.com/api/public/v1.0')  # Overridden by the offline benchmark
+CM_PAGE_SIZE = int(os.environ.get('CM_PAGE_SIZE', '200'))  # Hosts per page (Cloud Manager allows up to 500)
+CM_MAX_WORKERS = int(os.environ.get('CM_MAX_WORKERS', '8'))  # Pages fetched in parallel
+CM_MAX_RETRIES = int(os.environ.get('CM_MAX_RETRIES', '5'))  # Retries for 429/5xx responses
+
+# Discovery through a mongos (Cloud Manager is then only the fallback)
+SEED_MONGOS = os.environ.get('SEED_MONGOS')  # host:port of any mongos in the cluster
+
+# Daemon mode (--daemon)
+DAEMON_POLL_INTERVAL = float(os.environ.get('DAEMON_POLL_INTERVAL', '5'))  # Seconds between config.changelog reads
+DAEMON_DEBOUNCE = float(os.environ.get('DAEMON_DEBOUNCE', '10'))  # Quiet seconds before a changed namespace is flushed
+DAEMON_MAX_DELAY = float(os.environ.get('DAEMON_MAX_DELAY', '60'))  # Longest a change waits while its namespace keeps changing
+DAEMON_MAX_PENDING = int(os.environ.get('DAEMON_MAX_PENDING', '1000'))  # Queued namespaces before the oldest is flushed early
+DAEMON_LOOKBACK = float(os.environ.get('DAEMON_LOOKBACK', '60'))  # Seconds of changelog read at startup
+DAEMON_TOPOLOGY_REFRESH = float(os.environ.get('DAEMON_TOPOLOGY_REFRESH', '900'))  # Seconds between topology refreshes
+DAEMON_METRICS_INTERVAL = float(os.environ.get('DAEMON_METRICS_INTERVAL', '300'))  # Seconds of phase metrics kept before they are exported and reset
+
+# Flush verification config
+VERIFY_DEADLINE = float(os.environ.get('VERIFY_DEADLINE', '2'))  # Seconds to wait for the flush counters to move
+
+# Connection registry config
+MAX_CLIENTS = int(os.environ.get('MAX_CLIENTS', '256'))  # Warm clients kept across phases
+MAX_POOL_SIZE = int(os.environ.get('MAX_POOL_SIZE', '2'))  # Sockets per client
+NODE_TIMEOUT = float(os.environ.get('NODE_TIMEOUT', RECOMMENDED.get('node_timeout', 5)))  # Seconds to connect to a node
+
+# Topology cache config
+TOPOLOGY_CACHE_TTL = float(os.environ.get('TOPOLOGY_CACHE_TTL', '900'))  # Seconds (0 = always rediscover)
+TOPOLOGY_MAX_INVALID_RATIO = float(os.environ.get('TOPOLOGY_MAX_INVALID_RATIO', '0.25'))  # Stale primaries tolerated
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,31 +135,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_all_hosts() -> List[Dict]:
+# Per-phase latency samples, fed by the shard/mongos code and by every client's command listener
+METRICS = PhaseMetrics()
+COMMAND_LISTENER = CommandTimingListener(METRICS)
+
+# Shared clients, keyed by host:port and user, closed at the end of main()
+CLIENTS = ClientRegistry(max_clients=MAX_CLIENTS, maxPoolSize=MAX_POOL_SIZE,
+                         connectTimeoutMS=int(NODE_TIMEOUT * 1000),
+                         serverSelectionTimeoutMS=int(NODE_TIMEOUT * 1000),
+                         event_listeners=[COMMAND_LISTENER])
+ASYNC_CLIENTS = ClientRegistry(max_clients=MAX_CLIENTS, client_class=AsyncMongoClient, maxPoolSize=MAX_POOL_SIZE,
+                               connectTimeoutMS=int(NODE_TIMEOUT * 1000),
+                               serverSelectionTimeoutMS=int(NODE_TIMEOUT * 1000),
+                               event_listeners=[COMMAND_LISTENER]) if AsyncMongoClient else None
+
+# Per-shard and per-mongos outcomes of this run, used by --resume
+JOURNAL = RunJournal(JOURNAL_FILE)
+
+# Per-node results streamed as NDJSON while the run progresses (--ndjson)
+RESULTS = ResultStream()
+
+# Shards that ran out of their --shard-budget, retried at the end of the run
+STRAGGLERS = StragglerQueue()
+
+# Flush user reused across runs instead of being created and dropped per shard (--persistent-user)
+FLUSH_USER = PersistentFlushUser(PERSISTENT_FLUSH_USER, PERSISTENT_FLUSH_ROLE, NEW_USER_PASSWORD,
+                                 FLUSH_USER_ROTATION_DAYS * 86400)
+
+def record_page_latency(page_num: int, seconds: float):
+    METRICS.record('cm_page', f'page {page_num}', seconds)
+
+def get_all_hosts(project_id: str = PROJECT_ID, cluster_id: str = CLUSTER_ID) -> List[Dict]:
     """Get MongoDB hosts from the specified project and cluster with pagination."""
     try:
         logger.info("Fetching all the hosts...")
-        all_hosts = []
-        page_num = 1
-        items_per_page = 200
-        
-        while True:
-            host_url = f'{BASE_URL}/groups/{PROJECT_ID}/hosts?clusterId={CLUSTER_ID}&pageNum={page_num}&itemsPerPage={items_per_page}'
-            host_response = requests.get(host_url, auth=DIGEST_AUTH)
-            host_response.raise_for_status()
-            
-            response_data = host_response.json()
-            hosts = response_data['results']
-            all_hosts.extend(hosts)
-            
-            total_count = response_data.get('totalCount', 0)
-            logger.info(f"Fetched page {page_num}, got {len(hosts)} hosts (Total: {len(all_hosts)}/{total_count})")
-            
-            if len(all_hosts) >= total_count:
-                break
-                
-            page_num += 1
-            
+        with create_session(PUBLIC_KEY, PRIVATE_KEY, pool_size=CM_MAX_WORKERS, max_retries=CM_MAX_RETRIES) as session:
+            all_hosts = fetch_all_hosts(session, BASE_URL, project_id, cluster_id,
+                                        items_per_page=CM_PAGE_SIZE, max_workers=CM_MAX_WORKERS,
+                                        on_page=record_page_latency)
+
         logger.info(f"Found total of {len(all_hosts)} hosts in project")
         return all_hosts
 
@@ -63,45 +181,67 @@ def get_all_hosts() -> List[Dict]:
         logger.error(f"API connection error: {e}")
         return []
 
+def iter_discovered_hosts(shard_members: Dict[str, List[str]], errors: List[str]) -> Iterator[Dict]:
+    """Yield hosts as soon as their Cloud Manager page arrives, collecting replica set members into `shard_members`.
+
+    A failed page ends the listing early; its error is appended to `errors`,
+    so the caller knows the hosts it got are not the whole cluster.
+    """
+    try:
+        logger.info("Fetching all the hosts...")
+        with create_session(PUBLIC_KEY, PRIVATE_KEY, pool_size=CM_MAX_WORKERS, max_retries=CM_MAX_RETRIES) as session:
+            for _, hosts in iter_host_pages(session, BASE_URL, PROJECT_ID, CLUSTER_ID,
+                                            items_per_page=CM_PAGE_SIZE, max_workers=CM_MAX_WORKERS,
+                                            on_page=record_page_latency):
+                for replica_set, members in shard_members_from_hosts(hosts).items():
+                    shard_members.setdefault(replica_set, []).extend(members)
+                yield from hosts
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"API connection error, discovery is incomplete: {e}")
+        errors.append(f"Cloud Manager host listing failed: {e}")
+
+def seed_topology(seed: str) -> Optional[Tuple[List[Dict], Dict, Dict]]:
+    """Seed-mongos discovery with this script's clients and timeouts; None means fall back to Cloud Manager."""
+    with METRICS.timed('discovery', 'mongos'):
+        return discover_from_seed(
+            seed, CLIENTS, MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD,
+            timeout_ms=int(NODE_TIMEOUT * 1000), max_workers=max(CM_MAX_WORKERS * 4, 32))
+
+def classify_host(host: Dict) -> Tuple[str, str, Dict]:
+    """Return ('mongos', None, node) for a router, ('primary', shard_name, node) for a shard primary,
+    or (None, None, None) for any other host."""
+    hostname = host['hostname']
+    port = host['port']
+
+    # Handle mongos routers
+    if 'MONGOS' in host['typeName']:
+        return 'mongos', None, {'hostname': hostname, 'port': port}
+    # Handle shard primaries (excluding config servers)
+    if 'PRIMARY' in host['typeName'] and 'CONFIG' not in host['typeName']:
+        # Extract shard name from the hostname or replicaSetName if available
+        shard_name = host.get('replicaSetName', hostname.split('-')[0])
+        return 'primary', shard_name, {'hostname': hostname, 'port': port}
+    return None, None, None
+
 def get_cluster_topology(hosts: List[Dict]) -> tuple:
     """Extract detailed cluster topology including shard names and their primaries."""
     mongos_nodes = []
     shard_primaries = {}  # Dictionary to store shard name -> primary node mapping
     
     for host in hosts:
-        hostname = host['hostname']
-        port = host['port']
-        
-        # Handle mongos routers
-        if 'MONGOS' in host['typeName']:
-            mongos_nodes.append({
-                'hostname': hostname,
-                'port': port
-            })
-        # Handle shard primaries (excluding config servers)
-        elif 'PRIMARY' in host['typeName'] and 'CONFIG' not in host['typeName']:
-            # Extract shard name from the hostname or replicaSetName if available
-            shard_name = host.get('replicaSetName', hostname.split('-')[0])
-            shard_primaries[shard_name] = {
-                'hostname': hostname,
-                'port': port
-            }
+        kind, shard_name, node = classify_host(host)
+        if kind == 'mongos':
+            mongos_nodes.append(node)
+        elif kind == 'primary':
+            shard_primaries[shard_name] = node
     
     return mongos_nodes, shard_primaries
 
-def save_topology_info(mongos_nodes: List[Dict], shard_primaries: Dict):
+def save_topology_info(mongos_nodes: List[Dict], shard_primaries: Dict, shard_members: Dict = None):
     """Save cluster topology information to a file."""
-    topology = {
-        'mongos_routers': mongos_nodes,
-        'shard_primaries': shard_primaries
-    }
-    
-    # Write the file and set permissions to 640
-    with open('cluster_topology.json', 'w') as f:
-        json.dump(topology, f, indent=2)
-    os.chmod('cluster_topology.json', 0o640)
-    
-    logger.info("Cluster topology has been saved to cluster_topology.json")
+    save_topology(mongos_nodes, shard_primaries, shard_members)
+    logger.info(f"Cluster topology has been saved to {TOPOLOGY_FILE}")
 
 def display_topology(mongos_nodes: List[Dict], shard_primaries: Dict):
     """Display cluster topology in a readable format."""
@@ -128,217 +268,1279 @@ def wait_for_confirmation():
         else:
             print("Invalid input. Please press 'C' to continue or 'Q' to quit.")
 
-def perform_findAll_on_allMongos(mongos_nodes: List[Dict], namespace: str) -> bool:
-    """Run a findOne command on all mongos nodes using admin credentials."""
-    # Split namespace into database and collection
-    db_name, collection_name = namespace.split('.')
-    
+def perform_findAll_on_mongos(mongos_node: Dict, namespaces: List[str], flush_router_config: bool = False,
+                              timeout: float = MONGOS_PROBE_TIMEOUT) -> Steps:
+    """Warm up one mongos: read a single _id from every namespace using admin credentials.
+
+    The probe is bounded by a client-side timeout that also sets maxTimeMS, so a slow
+    router is abandoned instead of stalling the run. With `flush_router_config` the
+    mongos also drops its cached routing info for each namespace. Returns success.
+    """
+    stopwatch = METRICS.stopwatch(f"{mongos_node['hostname']}:{mongos_node['port']}")
+    try:
+        # Use admin credentials instead of the new mongops user
+        client = yield Lease(mongos_node['hostname'], mongos_node['port'], MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD)
+        with pymongo.timeout(timeout):
+            for namespace in namespaces:
+                if flush_router_config:
+                    yield Command(client.admin, 'flushRouterConfig', namespace)
+
+                # Split namespace into database and collection
+                db_name, collection_name = namespace.split('.', 1)
+
+                # Fetch only the _id of one document
+                reply = yield Command(client[db_name], 'find', collection_name, filter={}, projection={'_id': 1},
+                                      limit=1, singleBatch=True)
+
+                if reply['cursor']['firstBatch']:
+                    logger.info(f"Successfully queried one document from {namespace} via mongos {mongos_node['hostname']}")
+                else:
+                    logger.info(f"Collection {namespace} is empty on mongos {mongos_node['hostname']}")
+        JOURNAL.record('mongos', f"{mongos_node['hostname']}:{mongos_node['port']}", VERIFIED)
+        return True
+
+    except Exception as e:
+        logger.error(f"Error querying collection via mongos {mongos_node['hostname']}: {e}")
+        JOURNAL.record('mongos', f"{mongos_node['hostname']}:{mongos_node['port']}", FAILED, reason=str(e))
+        return False
+    finally:
+        stopwatch.total('mongos_probe')
+
+def warm_up_all_mongos(mongos_nodes: List[Dict], namespaces: List[str], args) -> int:
+    """Probe every mongos with at most `args.mongos_fanout` in flight. Returns success count."""
+    logger.info(f"Verifying {len(mongos_nodes)} mongos nodes ({args.mongos_fanout} at a time)...")
+    successes = 0
+    with ThreadPoolExecutor(max_workers=max(args.mongos_fanout, 1)) as executor:
+        futures = {executor.submit(run_steps, perform_findAll_on_mongos(mongos, namespaces, args.flush_router_config,
+                                                                        args.probe_timeout), CLIENTS): mongos
+                   for mongos in mongos_nodes}
+        for done, future in enumerate(as_completed(futures), 1):
+            mongos = futures[future]
+            ok = future.result()
+            RESULTS.emit('mongos', f"{mongos['hostname']}:{mongos['port']}", ok=ok)
+            if ok:
+                successes += 1
+
+            if done % 10 == 0:
+                logger.info(f"Completed mongos verification: {done}/{len(mongos_nodes)}")
+
+    return successes
+
+def run_on_any_mongos(mongos_nodes: List[Dict], operation, description: str):
+    """Run operation(client) against the first reachable mongos and return its result."""
     for mongos_node in mongos_nodes:
         try:
-            # Use admin credentials instead of the new mongops user
-            client_url = f'mongodb://{MONGO_ADMIN_USER}:{MONGO_ADMIN_PASSWORD}@{mongos_node["hostname"]}:{mongos_node["port"]}/admin'
-            client = MongoClient(client_url, 
-                               directConnection=True,
-                               connectTimeoutMS=5000, 
-                               serverSelectionTimeoutMS=5000)
-            
-            db = client[db_name]
-            collection = db[collection_name]
-            
-            # Try to find one document
-            #doc = collection.find_one()
-            doc = next(collection.find().limit(1), None)
-
-            if doc is not None:
-                logger.info(f"Successfully queried one document from {namespace} via mongos {mongos_node['hostname']}")
-            else:
-                logger.info(f"Collection {namespace} is empty on mongos {mongos_node['hostname']}")
-                
+            with CLIENTS.client(mongos_node['hostname'], mongos_node['port'],
+                                MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD) as client:
+                return operation(client)
         except Exception as e:
-            logger.error(f"Error querying collection via mongos {mongos_node['hostname']}: {e}")
+            logger.warning(f"Could not {description} via mongos {mongos_node['hostname']}: {e}")
+    raise RuntimeError(f"No mongos reachable to {description}")
+
+def resolve_namespaces(patterns: List[str], mongos_nodes: List[Dict]) -> List[str]:
+    """Expand 'db.*' patterns to every sharded collection of that database.
+
+    Sharded collections are read from config.collections through the first
+    reachable mongos. Plain namespaces are passed through unchanged.
+    """
+    namespaces = []
+    for pattern in patterns:
+        if not pattern.endswith('.*'):
+            namespaces.append(pattern)
+            continue
+
+        db_name = pattern[:-2]
+        matched = run_on_any_mongos(mongos_nodes, lambda client: sorted(
+            doc['_id'] for doc in client.config.collections.find(
+                {'_id': {'$regex': f'^{re.escape(db_name)}\\.'}, 'dropped': {'$ne': True}},
+                {'_id': 1})), f"expand {pattern}")
+
+        logger.info(f"Expanded {pattern} to {len(matched)} sharded collections")
+        namespaces.extend(matched)
+
+    # Drop duplicates, keep order
+    return list(dict.fromkeys(namespaces))
+
+def plan_targeted_shards(mongos_nodes: List[Dict], shard_primaries: Dict, namespaces: List[str],
+                         donor_window: float) -> Dict[str, List[str]]:
+    """Map each shard that owns chunks of the batch to the namespaces it should flush.
+
+    Falls back to every shard and every namespace if config.chunks cannot be read.
+    """
+    try:
+        plan = run_on_any_mongos(mongos_nodes,
+                                 lambda client: plan_targeted_flush(client, namespaces, donor_window),
+                                 "read chunk ownership")
+    except RuntimeError as e:
+        logger.warning(f"{e}, flushing every shard")
+        return {shard_name: namespaces for shard_name in shard_primaries}
+
+    unknown = sorted(set(plan) - set(shard_primaries))
+    if unknown:
+        logger.error(f"Shards owning chunks have no known primary and will not be flushed: {', '.join(unknown)}")
+
+    return {shard_name: plan[shard_name] for shard_name in shard_primaries if shard_name in plan}
+
+def refresh_primary(shard_name: str, primary: Dict) -> Dict:
+    """Learn the current primary of one shard with `hello` after a failover.
+
+    The old primary is asked first; if it is down, the members recorded at
+    discovery are. Returns the old entry while no new primary is elected.
+
+    Each `hello` gets FAILOVER_HELLO_TIMEOUT instead of the shard's deadline,
+    which a failover has often used up: it runs in an empty context, so no
+    pymongo.timeout() of the caller applies.
+    """
+    cluster, _, set_name = shard_name.rpartition('/')
+    members = load_shard_members(f"cluster_topology.{cluster}.json" if cluster else TOPOLOGY_FILE).get(set_name, [])
+    current, changed = contextvars.Context().run(resolve_primary, set_name, primary, members,
+                                                 int(FAILOVER_HELLO_TIMEOUT * 1000))
+    if current is None:
+        logger.warning(f"No primary found for shard {shard_name} yet")
+        return primary
+    if changed:
+        logger.info(f"Shard {shard_name} failed over to {current['hostname']}:{current['port']}")
+        RESULTS.emit('failover', shard_name, old=f"{primary['hostname']}:{primary['port']}",
+                     new=f"{current['hostname']}:{current['port']}")
+    return current
+
+def process_shard(shard_name: str, primary: Dict, namespaces: List[str], pending: List = None,
+                  gate: HealthGate = None, budget: float = 0) -> Steps:
+    """Process all operations for a shard using the shared admin client for its primary.
+
+    The flush user and role are provisioned once and every namespace in the batch is
+    flushed before a single before/after metrics check. When `pending` is a list the
+    check is deferred: the pre-flush counters are appended to it for verify_deferred().
+    With a `gate` the shard is paused (RetryLater is raised for the caller to
+    requeue it) while its primary is unhealthy, and its flush latency is fed
+    back to the adaptive concurrency limit. If the primary steps
+    down or becomes unreachable, only this shard's primary is re-resolved and the
+    shard is retried, up to FAILOVER_RETRIES times with jittered exponential backoff.
+
+    A `budget` in seconds bounds the whole shard: every command gets a
+    maxTimeMS and the flush a wtimeout from what is left of it. A shard that
+    runs out, or whose failover retry would not fit in what is left, is
+    queued in STRAGGLERS for retry_stragglers().
+
+    Written as steps, so the same sequence runs threaded with run_steps(..., CLIENTS)
+    and on an event loop with run_steps_async(..., ASYNC_CLIENTS). Returns success.
+    """
+    stopwatch = METRICS.stopwatch(shard_name)
+    retries = jittered_backoff(FAILOVER_RETRIES, FAILOVER_BACKOFF, FAILOVER_MAX_BACKOFF)
+    start = time.monotonic()
+    outcome = 'failed'
+    try:
+        # The deadline is a context variable, so it covers this shard only, also on an event loop
+        with pymongo.timeout(budget or None):
+            while True:
+                try:
+                    ok = yield from flush_shard(shard_name, primary, namespaces, pending, gate, stopwatch,
+                                                start + budget if budget else None)
+                    outcome = 'ok' if ok else 'failed'
+                    return ok
+                except ConnectionFailure as e:
+                    delay = next(retries, None)
+                    if delay is None or (budget and e.timeout):
+                        raise
+                    if budget and time.monotonic() + delay >= start + budget:
+                        # Retrying now would only fail on the deadline; leave the shard to the straggler rounds
+                        raise ExecutionTimeout(f"lost primary {primary['hostname']}:{primary['port']} ({e}) "
+                                               f"and a {delay:.1f}s retry does not fit the budget", 50) from e
+                    logger.warning(f"Lost primary {primary['hostname']}:{primary['port']} of shard {shard_name} ({e}), "
+                                   f"retrying in {delay:.1f}s")
+                    yield Sleep(delay)
+                    primary = yield Blocking(refresh_primary, shard_name, primary)
+
+    except RetryLater:
+        # Paused by the health gate; the attempt is not an outcome of the shard
+        outcome = 'paused'
+        raise
+    except Exception as e:
+        if budget and getattr(e, 'timeout', False):
+            outcome = 'timeout'
+            logger.warning(f"Shard {shard_name} ran out of its {budget:.0f}s budget ({e}), queued as a straggler")
+            JOURNAL.record('shard', shard_name, FAILED, reason=f"exceeded {budget:.0f}s budget")
+            STRAGGLERS.add(shard_name, primary, namespaces)
             return False
-        finally:
-            if client:
-                client.close()
-    
-    return True
+        logger.error(f"Error processing shard {shard_name} on {primary['hostname']}: {e}")
+        JOURNAL.record('shard', shard_name, FAILED, reason=str(e))
+        return False
+    finally:
+        if outcome != 'paused':
+            stopwatch.total('shard')
+            STRAGGLERS.record(shard_name, budget, time.monotonic() - start, outcome)
 
-def process_shard(shard_name: str, primary: Dict) -> bool:
-    """Process all operations for a shard using a single admin client connection."""
-    admin_client = None
+def flush_write_concern(deadline: float = None) -> Dict:
+    """w: majority, with a wtimeout of whatever is left until the shard's `deadline`."""
+    if deadline is None:
+        return {'w': 'majority'}
+    return {'w': 'majority', 'wtimeout': max(int((deadline - time.monotonic()) * 1000), 1)}
+
+def check_write_concern(result: Dict):
+    """Raise on a writeConcernError, which mongod reports next to ok: 1 and db.command() does not raise."""
+    wc_error = result.get('writeConcernError')
+    if wc_error:
+        error_class = WTimeoutError if wc_error.get('errInfo', {}).get('wtimeout') else WriteConcernError
+        raise error_class(wc_error.get('errmsg'), wc_error.get('code'), wc_error)
+
+def flush_shard(shard_name: str, primary: Dict, namespaces: List[str], pending: List,
+                gate: HealthGate, stopwatch, deadline: float = None) -> Steps:
+    """One attempt of process_shard against `primary`.
+
+    Raises ConnectionFailure (including NotPrimaryError) when the node is no
+    longer the primary or cannot be reached, so process_shard can follow the
+    failover, and lets timeouts through so a shard out of budget becomes a straggler.
+    """
     try:
-        # Create single admin client for all operations
-        client_url = f'mongodb://{MONGO_ADMIN_USER}:{MONGO_ADMIN_PASSWORD}@{primary["hostname"]}:{primary["port"]}/admin'
-        admin_client = MongoClient(client_url, 
-                                 directConnection=True,
-                                 connectTimeoutMS=5000, 
-                                 serverSelectionTimeoutMS=5000)
-        
+        admin_client = yield Lease(primary['hostname'], primary['port'], MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD)
         admin_db = admin_client.admin
 
         # Verify we're on primary
-        if not admin_client.is_primary:
-            logger.error(f"Node {primary['hostname']} is not primary, skipping")
-            return False
+        if not (yield Command(admin_db, 'hello')).get('isWritablePrimary'):
+            raise NotPrimaryError(f"{primary['hostname']}:{primary['port']} is not primary")
+
+        # Hold the shard back while its primary is lagging or queueing
+        if gate:
+            problem = yield from gate.check(admin_db, shard_name)
+            if problem:
+                logger.error(f"Shard {shard_name} still unhealthy after {gate.max_pause:.0f}s ({problem}), skipping")
+                JOURNAL.record('shard', shard_name, FAILED, reason=f"unhealthy: {problem}")
+                return False
+            stopwatch.lap('health')
 
         # 1. Get pre-flush metrics
-        status = admin_db.command('serverStatus')
-        before_metrics = status.get('metrics', {}).get('commands', {}).get('_flushRoutingTableCacheUpdatesWithWriteConcern', {})
+        before_metrics = yield from read_flush_counters(admin_db)
         logger.info(f"Pre-flush metrics on {primary['hostname']}: {before_metrics}")
+        stopwatch.lap('prepare')
+
+        # 2. Setup user and role, or only top up the persistent flush user
+        if FLUSH_USER.enabled:
+            flush_user = FLUSH_USER.username
+            flush_password, changes = yield from FLUSH_USER.ensure(admin_db)
+            logger.info(f"Persistent user {flush_user} on {primary['hostname']}: "
+                        f"{', '.join(changes) if changes else 'up to date'}")
+        else:
+            logger.info(f"Setting up user and role on {primary['hostname']}...")
+            try:
+                # Create user
+                yield Command(admin_db, 'createUser', NEW_USER,
+                              pwd=NEW_USER_PASSWORD,
+                              roles=[{'role': 'clusterManager', 'db': 'admin'}])
+                logger.info(f"Created user {NEW_USER}")
+            except Exception as e:
+                if 'already exists' not in str(e):
+                    raise
+                logger.info(f"User {NEW_USER} already exists")
+
+            try:
+                # Create role
+                yield Command(admin_db, 'createRole', 'flush_routing_table_cache_updates',
+                              privileges=[{
+                                  'resource': {'cluster': True},
+                                  'actions': ['internal']
+                              }],
+                              roles=[])
+                logger.info(f"Created role flush_routing_table_cache_updates")
+            except Exception as e:
+                if 'already exists' not in str(e):
+                    raise
+                logger.info(f"Role already exists")
+
+            # Grant role
+            yield Command(admin_db, 'grantRolesToUser', NEW_USER,
+                          roles=['flush_routing_table_cache_updates'])
+            logger.info(f"Granted role to user {NEW_USER}")
+            flush_user, flush_password = NEW_USER, NEW_USER_PASSWORD
+        JOURNAL.record('shard', shard_name, PROVISIONED, host=f"{primary['hostname']}:{primary['port']}")
+        stopwatch.lap('provision')
+
+        # 3. Flush every namespace in the batch using new user over one connection
+        flush_ok = True
+        flush_client = yield Lease(primary['hostname'], primary['port'], flush_user, flush_password)
+        for namespace in namespaces:
+            try:
+                result = yield Command(flush_client.admin, {
+                    '_flushRoutingTableCacheUpdatesWithWriteConcern': namespace,
+                    'writeConcern': flush_write_concern(deadline)
+                })
+                check_write_concern(result)
+                flush_ok = flush_ok and result.get('ok') == 1
+            except (ConnectionFailure, ExecutionTimeout, WTimeoutError):
+                raise
+            except Exception as e:
+                logger.error(f"Flush of {namespace} failed on {primary['hostname']}: {e}")
+                flush_ok = False
+        logger.info(f"Flushed {len(namespaces)} namespace(s) on {primary['hostname']}")
+        flush_seconds = stopwatch.lap('flush')
+        if gate:
+            gate.flushed(flush_seconds, len(namespaces))
+
+        # 4. Verify flush success using metrics, or leave it for the end-of-run batch
+        if not flush_ok:
+            logger.error(f"Flush verification failed on {primary['hostname']}")
+            JOURNAL.record('shard', shard_name, FAILED, reason='flush command failed')
+            return False
+        JOURNAL.record('shard', shard_name, FLUSHED)
+
+        if pending is not None:
+            pending.append((shard_name, primary, before_metrics, len(namespaces)))
+        else:
+            verified, after_metrics = yield from wait_for_flush_delta(
+                admin_db, before_metrics, len(namespaces), VERIFY_DEADLINE)
+            logger.info(f"Post-flush metrics on {primary['hostname']}: {after_metrics}")
+            if not verified:
+                logger.error(f"Flush verification failed on {primary['hostname']}")
+                JOURNAL.record('shard', shard_name, FAILED, reason=f"metrics delta {before_metrics} -> {after_metrics}")
+                return False
+            JOURNAL.record('shard', shard_name, VERIFIED)
+            stopwatch.lap('verify')
+
+        # 5. Cleanup (the persistent flush user stays for the next run)
+        if not FLUSH_USER.enabled:
+            yield Command(admin_db, 'revokeRolesFromUser', NEW_USER,
+                          roles=['flush_routing_table_cache_updates'])
+            yield Command(admin_db, 'dropUser', NEW_USER)
+            yield Command(admin_db, 'dropRole', 'flush_routing_table_cache_updates')
+            logger.info(f"Cleaned up user and role on {primary['hostname']}")
+            JOURNAL.record('shard', shard_name, CLEANED_UP)
+            stopwatch.lap('cleanup')
+
+        return True
+
+    finally:
+        # The flush user is dropped at the end of every shard (and the persistent one's
+        # password may rotate before the next run), so its client is never reused
+        yield Discard(primary['hostname'], primary['port'], FLUSH_USER.username if FLUSH_USER.enabled else NEW_USER)
+
+def cleanup_shard(shard_name: str, primary: Dict, username: str = NEW_USER, role: str = FLUSH_ROLE) -> bool:
+    """Drop a flush user and role left behind on a shard, e.g. by a crashed run or --drop-flush-user."""
+    try:
+        with CLIENTS.client(primary['hostname'], primary['port'],
+                            MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD) as admin_client:
+            admin_db = admin_client.admin
+            for command, name in [('dropUser', username), ('dropRole', role)]:
+                try:
+                    admin_db.command(command, name)
+                except Exception as e:
+                    if 'not found' not in str(e):
+                        raise
+
+        logger.info(f"Cleaned up leftover user and role on {primary['hostname']}")
+        JOURNAL.record('shard', shard_name, CLEANED_UP)
+        return True
+
+    except Exception as e:
+        logger.error(f"Error cleaning up shard {shard_name} on {primary['hostname']}: {e}")
+        JOURNAL.record('shard', shard_name, FAILED, reason=str(e))
+        return False
+
+async def get_all_hosts_async() -> List[Dict]:
+    """Async variant of get_all_hosts."""
+    try:
+        logger.info("Fetching all the hosts...")
+        all_hosts = await fetch_all_hosts_async(BASE_URL, PROJECT_ID, CLUSTER_ID, PUBLIC_KEY, PRIVATE_KEY,
+                                                items_per_page=CM_PAGE_SIZE, max_workers=CM_MAX_WORKERS,
+                                                max_retries=CM_MAX_RETRIES, on_page=record_page_latency)
+
+        logger.info(f"Found total of {len(all_hosts)} hosts in project")
+        return all_hosts
+
+    except httpx.HTTPError as e:
+        logger.error(f"API connection error: {e}")
+        return []
+
+async def process_all_async(shard_primaries: Dict, mongos_nodes: List[Dict], shard_namespaces: Dict[str, List[str]],
+                            namespaces: List[str], args) -> Tuple[int, int]:
+    """Flush every shard with at most `args.concurrency` in flight, then verify every mongos
+    with at most `args.mongos_fanout` in flight.
+
+    Each shard flushes the namespaces listed for it in `shard_namespaces`; every
+    mongos is probed for the whole batch in `namespaces`.
+
+    Returns (shard_successes, mongos_successes).
+    """
+    bucket = TokenBucket(args.rate, capacity=max(args.concurrency, 1))
+    semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+    gate = make_health_gate(args)
+    mongos_semaphore = asyncio.Semaphore(max(args.mongos_fanout, 1))
+    total_shards = len(shard_primaries)
+    pending = [] if args.defer_verify else None
 
-        # 2. Setup user and role
-        logger.info(f"Setting up user and role on {primary['hostname']}...")
+    async def run_shard(idx: int, shard_name: str, primary: Dict) -> bool:
+        while True:
+            if gate:
+                await gate.limiter.acquire_async()
+            else:
+                await semaphore.acquire()
+            try:
+                await bucket.acquire_async()
+                logger.info(f"Processing shard: {shard_name} ({idx}/{total_shards})")
+                ok = await run_steps_async(process_shard(shard_name, primary, shard_namespaces[shard_name], pending,
+                                                         gate, args.shard_budget), ASYNC_CLIENTS)
+                RESULTS.emit('shard', shard_name, ok=ok, host=f"{primary['hostname']}:{primary['port']}",
+                             namespaces=len(shard_namespaces[shard_name]), verify_deferred=pending is not None)
+                return ok
+            except RetryLater as e:
+                delay = e.delay
+            finally:
+                if gate:
+                    gate.limiter.release()
+                else:
+                    semaphore.release()
+            # Paused: the slot goes to other shards until the backoff has passed
+            await asyncio.sleep(delay)
+
+    async def run_mongos(mongos: Dict) -> bool:
+        async with mongos_semaphore:
+            ok = await run_steps_async(perform_findAll_on_mongos(mongos, namespaces, args.flush_router_config,
+                                                                 args.probe_timeout), ASYNC_CLIENTS)
+            RESULTS.emit('mongos', f"{mongos['hostname']}:{mongos['port']}", ok=ok)
+            return ok
+
+    shard_successes = 0
+    tasks = [asyncio.create_task(run_shard(idx, shard_name, primary))
+             for idx, (shard_name, primary) in enumerate(shard_primaries.items(), 1)]
+    for done, task in enumerate(asyncio.as_completed(tasks), 1):
+        if await task:
+            shard_successes += 1
+
+        if done % 10 == 0:
+            completion_rate = (done / total_shards) * 100
+            logger.info(f"Progress: {completion_rate:.1f}% ({done}/{total_shards} shards)")
+
+    if gate:
+        logger.info(f"Adaptive concurrency finished at {int(gate.limiter.limit)} shard(s) in flight")
+    shard_successes += len(await run_steps_async(retry_stragglers(pending, args), ASYNC_CLIENTS))
+    if pending:
+        shard_successes -= len(pending) - await run_steps_async(verify_deferred(pending, args.concurrency),
+                                                                ASYNC_CLIENTS)
+
+    mongos_successes = 0
+    if mongos_nodes:
+        logger.info(f"Verifying {len(mongos_nodes)} mongos nodes ({args.mongos_fanout} at a time)...")
+        results = await asyncio.gather(*(run_mongos(mongos) for mongos in mongos_nodes))
+        mongos_successes = sum(1 for ok in results if ok)
+        logger.info(f"Completed mongos verification: {len(mongos_nodes)}/{len(mongos_nodes)}")
+
+    await ASYNC_CLIENTS.aclose_all()
+    return shard_successes, mongos_successes
+
+def make_health_gate(args) -> HealthGate:
+    """The health gate for an --adaptive run, starting at a quarter of --concurrency; None otherwise."""
+    if not args.adaptive:
+        return None
+    limiter = AIMDLimiter(maximum=max(args.concurrency, 1), initial=max(args.concurrency // 4, 1))
+    return HealthGate(limiter, max_lag=ADAPTIVE_MAX_LAG, max_queued=ADAPTIVE_MAX_QUEUED,
+                      max_flush_latency=ADAPTIVE_MAX_FLUSH_LATENCY, max_pause=ADAPTIVE_MAX_PAUSE)
+
+def verify_deferred(pending: List, concurrency: int) -> Steps:
+    """Check the flush counters of every deferred shard in one parallel pass. Returns the verified count."""
+    def verify(shard_name: str, primary: Dict, before_metrics: Dict, expected: int) -> Steps:
+        stopwatch = METRICS.stopwatch(shard_name)
         try:
-            # Create user
-            admin_db.command('createUser', NEW_USER, 
-                           pwd=NEW_USER_PASSWORD,
-                           roles=[{'role': 'clusterManager', 'db': 'admin'}])
-            logger.info(f"Created user {NEW_USER}")
+            admin_client = yield Lease(primary['hostname'], primary['port'], MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD)
+            verified, after_metrics = yield from wait_for_flush_delta(
+                admin_client.admin, before_metrics, expected, VERIFY_DEADLINE)
+            stopwatch.total('verify')
         except Exception as e:
-            if 'already exists' not in str(e):
-                raise
-            logger.info(f"User {NEW_USER} already exists")
+            logger.error(f"Error verifying shard {shard_name} on {primary['hostname']}: {e}")
+            JOURNAL.record('shard', shard_name, FAILED, reason=str(e))
+            return False
+        if not verified:
+            logger.error(f"Flush verification failed on {primary['hostname']}: {before_metrics} -> {after_metrics}")
+        JOURNAL.record('shard', shard_name, VERIFIED if verified else FAILED,
+                       reason=None if verified else f"metrics delta {before_metrics} -> {after_metrics}")
+        RESULTS.emit('shard_verify', shard_name, ok=verified)
+        return verified
+
+    logger.info(f"Verifying {len(pending)} deferred shard flushes...")
+    results = yield Parallel([verify(*entry) for entry in pending], concurrency)
+    return sum(1 for ok in results if ok)
+
+def straggler_rounds(args) -> Iterator[Tuple[int, float, List[Tuple[str, Dict, List[str]]]]]:
+    """Yield (round, budget, stragglers) for each end-of-run retry round that has stragglers to retry."""
+    budget = args.shard_budget
+    for round_num in range(1, args.straggler_rounds + 1):
+        queue = STRAGGLERS.take()
+        if not queue:
+            return
+        budget *= STRAGGLER_BUDGET_FACTOR
+        logger.info(f"Retrying {len(queue)} straggler(s) with a {budget:.0f}s budget "
+                    f"(round {round_num}/{args.straggler_rounds})")
+        yield round_num, budget, queue
+
+def retry_stragglers(pending: List, args) -> Steps:
+    """Retry the shards that ran out of budget, with a longer budget each round. Returns the ones that finished."""
+    recovered = []
+
+    def retry(shard_name: str, primary: Dict, namespaces: List[str], budget: float) -> Steps:
+        ok = yield from process_shard(shard_name, primary, namespaces, pending, budget=budget)
+        RESULTS.emit('shard', shard_name, ok=ok, host=f"{primary['hostname']}:{primary['port']}",
+                     namespaces=len(namespaces), verify_deferred=pending is not None, straggler=True)
+        if ok:
+            recovered.append(shard_name)
+        return ok
+
+    for _, budget, queue in straggler_rounds(args):
+        yield Parallel([retry(*entry, budget) for entry in queue], args.concurrency)
+    return recovered
+
+def process_all_shards(shards: Iterable[Tuple[str, Dict]], shard_namespaces: Dict[str, List[str]], args) -> int:
+    """Run process_shard on every (shard_name, primary) with at most `args.concurrency` in flight.
+
+    `shards` may be a generator that is still discovering shards; each one is
+    submitted as soon as it is yielded. A shard paused by the health gate gives
+    its worker back and is submitted again once its backoff has passed.
+    Returns success count.
+    """
+    bucket = TokenBucket(args.rate, capacity=max(args.concurrency, 1))
+    gate = make_health_gate(args)
+    total_shards = len(shards) if hasattr(shards, '__len__') else None
+    successes = 0
+    pending = [] if args.defer_verify else None
+
+    def run(idx: int, shard_name: str, primary: Dict) -> bool:
+        # The pool caps shards in flight at --concurrency; the adaptive limiter may hold it lower
+        if gate:
+            gate.limiter.acquire()
+        try:
+            bucket.acquire()
+            logger.info(f"Processing shard: {shard_name} ({idx}/{total_shards or '?'})")
+            ok = run_steps(process_shard(shard_name, primary, shard_namespaces[shard_name], pending, gate,
+                                         args.shard_budget), CLIENTS)
+            RESULTS.emit('shard', shard_name, ok=ok, host=f"{primary['hostname']}:{primary['port']}",
+                         namespaces=len(shard_namespaces[shard_name]), verify_deferred=pending is not None)
+            return ok
+        finally:
+            if gate:
+                gate.limiter.release()
+
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        futures = {executor.submit(run, idx, shard_name, primary): (idx, shard_name, primary)
+                   for idx, (shard_name, primary) in enumerate(shards, 1)}
+        total_shards = len(futures)
+
+        # (resume time, idx, shard_name, primary) of the paused shards
+        paused = []
+        done = 0
+        while futures or paused:
+            while paused and paused[0][0] <= time.monotonic():
+                entry = heapq.heappop(paused)[1:]
+                futures[executor.submit(run, *entry)] = entry
+
+            timeout = max(paused[0][0] - time.monotonic(), 0) if paused else None
+            if not futures:
+                time.sleep(timeout)
+                continue
+            finished, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                entry = futures.pop(future)
+                try:
+                    ok = future.result()
+                except RetryLater as e:
+                    heapq.heappush(paused, (time.monotonic() + e.delay, *entry))
+                    continue
+                if ok:
+                    successes += 1
+
+                done += 1
+                if done % 10 == 0:
+                    completion_rate = (done / total_shards) * 100
+                    logger.info(f"Progress: {completion_rate:.1f}% ({done}/{total_shards} shards)")
+
+    if gate:
+        logger.info(f"Adaptive concurrency finished at {int(gate.limiter.limit)} shard(s) in flight")
+    successes += len(run_steps(retry_stragglers(pending, args), CLIENTS))
+    if pending:
+        successes -= len(pending) - run_steps(verify_deferred(pending, args.concurrency), CLIENTS)
+
+    return successes
+
+def run_streaming(args) -> bool:
+    """Flush shards while the cluster is still being discovered.
+
+    Each Cloud Manager page is classified as it arrives and its shard primaries
+    go straight to the flush pool, so discovery overlaps with shard work and no
+    full host list is kept. 'db.*' patterns and --targeted need a mongos, so
+    shards found before the first mongos are held until the plan is made.
+    Mongos are warmed up once every shard is done.
+    """
+    patterns = args.namespace or [NAMESPACE]
+    needs_mongos = args.targeted or any(pattern.endswith('.*') for pattern in patterns)
 
+    print(f"\nStreaming flush of {', '.join(patterns)}: shards are flushed as they are discovered")
+    if not args.yes and not wait_for_confirmation():
+        logger.info("Operation cancelled by user")
+        return False
+    logger.info(f"Run ID: {JOURNAL.run_id}")
+
+    cached_topology = get_cached_topology(args.topology_ttl, TOPOLOGY_MAX_INVALID_RATIO)
+    mongos_nodes, shard_primaries, shard_members, shard_namespaces = [], {}, {}, {}
+    plan = {}
+    discovery_errors = []
+
+    def make_plan():
+        namespaces = resolve_namespaces(patterns, mongos_nodes)
+        if not namespaces:
+            raise RuntimeError("No namespaces to flush")
+        targets = None
+        if args.targeted:
+            try:
+                targets = run_on_any_mongos(mongos_nodes, lambda client: plan_targeted_flush(
+                    client, namespaces, args.include_donors), "read chunk ownership")
+            except RuntimeError as e:
+                logger.warning(f"{e}, flushing every shard")
+        plan.update(namespaces=namespaces, targets=targets)
+        print(f"\nNamespaces to flush ({len(namespaces)}): {', '.join(namespaces)}")
+        JOURNAL.record('run', JOURNAL.run_id, 'started', namespaces=namespaces, shards={}, mongos=[], streaming=True,
+                       persistent_user=FLUSH_USER.enabled)
+        RESULTS.emit('run', JOURNAL.run_id, state='started', namespaces=namespaces)
+
+    def discover() -> Iterator[Tuple[str, str, Dict]]:
+        known = cached_topology
+        if not known and args.seed_mongos:
+            discovered = seed_topology(args.seed_mongos)
+            if discovered:
+                known = discovered[:2]
+                shard_members.update(discovered[2])
+        if known:
+            for mongos in known[0]:
+                yield 'mongos', None, mongos
+            for shard_name, primary in known[1].items():
+                yield 'primary', shard_name, primary
+            return
+
+        start = time.monotonic()
+        for host in iter_discovered_hosts(shard_members, discovery_errors):
+            kind, shard_name, node = classify_host(host)
+            if kind:
+                yield kind, shard_name, node
+        METRICS.record('discovery', 'cloud_manager', time.monotonic() - start)
+
+    def schedule(shard_names: List[str]) -> Iterator[Tuple[str, Dict]]:
+        for shard_name in shard_names:
+            namespaces = plan['namespaces'] if plan['targets'] is None else plan['targets'].get(shard_name)
+            if not namespaces:
+                continue
+            shard_namespaces[shard_name] = namespaces
+            JOURNAL.record('shard', shard_name, PLANNED, namespaces=namespaces)
+            yield shard_name, shard_primaries[shard_name]
+
+    def discovered_shards() -> Iterator[Tuple[str, Dict]]:
+        held = []
+        for kind, shard_name, node in discover():
+            if kind == 'mongos':
+                mongos_nodes.append(node)
+            else:
+                shard_primaries[shard_name] = node
+                held.append(shard_name)
+
+            if not plan and (mongos_nodes or not needs_mongos):
+                make_plan()
+            if plan:
+                yield from schedule(held)
+                held.clear()
+
+        if not plan:
+            if needs_mongos:
+                raise RuntimeError("No mongos nodes found to resolve the namespaces")
+            make_plan()
+        yield from schedule(held)
+
+    shard_successes = process_all_shards(discovered_shards(), shard_namespaces, args)
+    if not shard_primaries:
+        logger.error("No shard primaries found")
+        return False
+    if args.targeted:
+        print(f"Targeted flush: {len(shard_namespaces)} shard(s) own chunks, "
+              f"{len(shard_primaries) - len(shard_namespaces)} skipped")
+
+    # Journaled only now: the run record written by make_plan() starts with no mongos
+    for mongos in mongos_nodes:
+        JOURNAL.record('mongos', f"{mongos['hostname']}:{mongos['port']}", PLANNED)
+    mongos_successes = warm_up_all_mongos(mongos_nodes, plan['namespaces'], args) if mongos_nodes else 0
+
+    # A truncated listing would pass validation on the next runs and hide the missing shards
+    if discovery_errors:
+        logger.error("Discovery was incomplete, the topology is not cached and unlisted shards were not flushed")
+    elif not cached_topology and mongos_nodes:
+        save_topology_info(mongos_nodes, shard_primaries, shard_members)
+
+    return report_results(args, plan['namespaces'], len(shard_namespaces), shard_successes,
+                          len(mongos_nodes), mongos_successes,
+                          discovery_error='; '.join(discovery_errors) or None)
+
+def plan_target(target: Dict, args) -> Dict:
+    """Discover one --targets cluster and plan its flush.
+
+    Uses the cluster's own topology cache, then its seed mongos, then Cloud Manager.
+    """
+    topology_path = f"cluster_topology.{target['name']}.json"
+    cached_topology = get_cached_topology(args.topology_ttl, TOPOLOGY_MAX_INVALID_RATIO, path=topology_path)
+    if cached_topology:
+        mongos_nodes, shard_primaries = cached_topology
+    else:
+        discovered = seed_topology(target['seed_mongos']) if target['seed_mongos'] else None
+        if discovered:
+            mongos_nodes, shard_primaries, shard_members = discovered
+        else:
+            with METRICS.timed('discovery', f"cloud_manager {target['name']}"):
+                all_hosts = get_all_hosts(target['project'], target['cluster'])
+            mongos_nodes, shard_primaries = get_cluster_topology(all_hosts)
+            shard_members = shard_members_from_hosts(all_hosts)
+        if not shard_primaries or not mongos_nodes:
+            raise RuntimeError("no shard primaries or mongos found")
+        save_topology(mongos_nodes, shard_primaries, shard_members, topology_path)
+
+    namespaces = resolve_namespaces(target['namespaces'], mongos_nodes)
+    if not namespaces:
+        raise RuntimeError("no namespaces to flush")
+    if args.targeted:
+        shard_namespaces = plan_targeted_shards(mongos_nodes, shard_primaries, namespaces, args.include_donors)
+    else:
+        shard_namespaces = {shard_name: namespaces for shard_name in shard_primaries}
+
+    logger.info(f"Cluster {target['name']}: {len(shard_namespaces)} shard(s), {len(mongos_nodes)} mongos, "
+                f"namespaces {', '.join(namespaces)}")
+    return {'mongos': mongos_nodes, 'primaries': shard_primaries, 'namespaces': namespaces,
+            'shard_namespaces': shard_namespaces}
+
+def run_fleet(args) -> bool:
+    """Flush every cluster listed in --targets in one run.
+
+    All clusters are discovered at the same time, then their shards share one
+    pool: at most --concurrency shards are in flight overall and at most the
+    cluster's limit per cluster, so the run takes about as long as the largest
+    cluster. Shards are journaled as <cluster name>/<shard>.
+    """
+    targets = load_targets(args.targets, args.namespace or [NAMESPACE])
+
+    print(f"\nFleet flush of {len(targets)} cluster(s):")
+    for target in targets:
+        print(f"- {target['name']} (project {target['project']}): {', '.join(target['namespaces'])}")
+    if not args.yes and not wait_for_confirmation():
+        logger.info("Operation cancelled by user")
+        return False
+    logger.info(f"Run ID: {JOURNAL.run_id}")
+
+    # Discover and plan every cluster at the same time
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {target['name']: executor.submit(plan_target, target, args) for target in targets}
+    clusters = {}
+    for name, future in futures.items():
         try:
-            # Create role
-            admin_db.command('createRole', 'flush_routing_table_cache_updates',
-                           privileges=[{
-                               'resource': {'cluster': True},
-                               'actions': ['internal']
-                           }],
-                           roles=[])
-            logger.info(f"Created role flush_routing_table_cache_updates")
+            clusters[name] = future.result()
         except Exception as e:
-            if 'already exists' not in str(e):
-                raise
-            logger.info(f"Role already exists")
+            logger.error(f"Skipping cluster {name}: {e}")
+            RESULTS.emit('cluster', name, ok=False, reason=str(e))
+
+    shard_namespaces = {f"{name}/{shard_name}": namespaces for name, cluster in clusters.items()
+                        for shard_name, namespaces in cluster['shard_namespaces'].items()}
+    JOURNAL.record('run', JOURNAL.run_id, 'started', namespaces=sorted({namespace for cluster in clusters.values()
+                                                                        for namespace in cluster['namespaces']}),
+                   shards=shard_namespaces, clusters=list(clusters), persistent_user=FLUSH_USER.enabled,
+                   mongos=[f"{mongos['hostname']}:{mongos['port']}"
+                           for cluster in clusters.values() for mongos in cluster['mongos']])
 
-        # Grant role
-        admin_db.command('grantRolesToUser', NEW_USER, 
-                        roles=['flush_routing_table_cache_updates'])
-        logger.info(f"Granted role to user {NEW_USER}")
+    bucket = TokenBucket(args.rate, capacity=max(args.concurrency, 1))
+    gate = make_health_gate(args)
+    pending = [] if args.defer_verify else None
+    start = time.monotonic()
+    finished_at = {}
 
-        # 3. Perform flush using new user
-        flush_client = None
+    def run(name: str, item: Tuple[str, Dict]) -> bool:
+        shard_name, primary = item
+        qualified_name = f"{name}/{shard_name}"
+        if gate:
+            gate.limiter.acquire()
         try:
-            flush_client = MongoClient(f'mongodb://{NEW_USER}:{NEW_USER_PASSWORD}@{primary["hostname"]}:{primary["port"]}/admin',
-                                     directConnection=True,
-                                     connectTimeoutMS=5000,
-                                     serverSelectionTimeoutMS=5000)
-            
-            result = flush_client.admin.command({
-                '_flushRoutingTableCacheUpdatesWithWriteConcern': NAMESPACE,
-                'writeConcern': {'w': 'majority'}
-            })
+            bucket.acquire()
+            logger.info(f"Processing shard: {qualified_name}")
+            ok = run_steps(process_shard(qualified_name, primary, shard_namespaces[qualified_name], pending, gate,
+                                         args.shard_budget), CLIENTS)
+            RESULTS.emit('shard', qualified_name, ok=ok, cluster=name, host=f"{primary['hostname']}:{primary['port']}",
+                         namespaces=len(shard_namespaces[qualified_name]), verify_deferred=pending is not None)
+            return ok
         finally:
-            if flush_client:
-                flush_client.close()
+            if gate:
+                gate.limiter.release()
+            finished_at[name] = max(finished_at.get(name, 0.0), time.monotonic() - start)
 
-        # Small delay to ensure metrics are updated
-        time.sleep(0.2)
+    limits = {target['name']: target['concurrency'] or args.cluster_concurrency for target in targets}
+    results = run_with_budgets({name: [(shard_name, cluster['primaries'][shard_name])
+                                       for shard_name in cluster['shard_namespaces']]
+                                for name, cluster in clusters.items()},
+                               run, args.concurrency, limits)
+    shard_successes = {name: sum(1 for ok in oks if ok) for name, oks in results.items()}
+    for qualified_name in run_steps(retry_stragglers(pending, args), CLIENTS):
+        shard_successes[qualified_name.split('/', 1)[0]] += 1
 
-        # 4. Verify flush success using metrics
-        status = admin_db.command('serverStatus')
-        after_metrics = status.get('metrics', {}).get('commands', {}).get('_flushRoutingTableCacheUpdatesWithWriteConcern', {})
-        logger.info(f"Post-flush metrics on {primary['hostname']}: {after_metrics}")
+    if pending:
+        for name in clusters:
+            deferred = [entry for entry in pending if entry[0].startswith(f"{name}/")]
+            if deferred:
+                shard_successes[name] -= len(deferred) - run_steps(verify_deferred(deferred, args.concurrency), CLIENTS)
+    if gate:
+        logger.info(f"Adaptive concurrency finished at {int(gate.limiter.limit)} shard(s) in flight")
 
-        total_increase = int(after_metrics.get('total', 0)) - int(before_metrics.get('total', 0))
-        failed_increase = int(after_metrics.get('failed', 0)) - int(before_metrics.get('failed', 0))
+    # Each cluster warms up its own mongos with its own fan-out
+    with ThreadPoolExecutor(max_workers=max(len(clusters), 1)) as executor:
+        mongos_successes = dict(zip(clusters, executor.map(
+            lambda cluster: warm_up_all_mongos(cluster['mongos'], cluster['namespaces'], args), clusters.values())))
 
-        if result.get('ok') != 1 or total_increase == 0 or failed_increase > 0:
-            logger.error(f"Flush verification failed on {primary['hostname']}")
-            return False
+    print("\n=== Per-Cluster Summary ===")
+    print(f"{'cluster':<30} {'shards ok':>10} {'mongos ok':>10} {'shards done':>12}")
+    for target in targets:
+        name = target['name']
+        if name not in clusters:
+            print(f"{name:<30} {'discovery failed':>34}")
+            continue
+        cluster = clusters[name]
+        shards_ok = f"{shard_successes[name]}/{len(cluster['shard_namespaces'])}"
+        mongos_ok = f"{mongos_successes[name]}/{len(cluster['mongos'])}"
+        print(f"{name:<30} {shards_ok:>10} {mongos_ok:>10} {finished_at.get(name, 0.0):>11.1f}s")
+        RESULTS.emit('cluster', name, ok=shard_successes[name] == len(cluster['shard_namespaces']),
+                     shards={'attempted': len(cluster['shard_namespaces']), 'succeeded': shard_successes[name]},
+                     mongos={'attempted': len(cluster['mongos']), 'succeeded': mongos_successes[name]},
+                     shards_done_seconds=finished_at.get(name))
+    print(f"Clusters discovered: {len(clusters)}/{len(targets)}")
 
-        # 5. Cleanup
-        admin_db.command('revokeRolesFromUser', NEW_USER,
-                        roles=['flush_routing_table_cache_updates'])
-        admin_db.command('dropUser', NEW_USER)
-        admin_db.command('dropRole', 'flush_routing_table_cache_updates')
-        logger.info(f"Cleaned up user and role on {primary['hostname']}")
+    ok = report_results(args, sorted({namespace for cluster in clusters.values() for namespace in cluster['namespaces']}),
+                        len(shard_namespaces), sum(shard_successes.values()),
+                        sum(len(cluster['mongos']) for cluster in clusters.values()), sum(mongos_successes.values()),
+                        resumable=False)
+    return ok and len(clusters) == len(targets)
 
-        return True
+def run_daemon(args) -> bool:
+    """Keep flushing the shards that migrations, splits and merges touch, until stopped.
 
-    except Exception as e:
-        logger.error(f"Error processing shard {shard_name} on {primary['hostname']}: {e}")
+    Every DAEMON_POLL_INTERVAL seconds, new chunk events are read from
+    config.changelog through any mongos. They are coalesced per namespace in
+    a bounded ChangeQueue, and once a namespace has been quiet for --debounce
+    seconds only the donor and recipient shards of its changes are flushed.
+    SIGTERM or Ctrl-C flushes whatever is still queued and stops.
+
+    Phase metrics are exported (with --metrics-json/--metrics-prom) and reset
+    every DAEMON_METRICS_INTERVAL seconds, so they cover a window rather
+    than growing with every command for as long as the daemon runs.
+    """
+    topology = discover_topology(args)
+    if topology is None:
         return False
-    finally:
-        if admin_client:
-            admin_client.close()
+    mongos_nodes, shard_primaries = topology
+    display_topology(mongos_nodes, shard_primaries)
+
+    patterns = args.namespace or []
+    print(f"\nWatching config.changelog for {', '.join(patterns) or 'every namespace'}; changed shards are "
+          f"flushed after {args.debounce:g}s without further changes")
+    if not args.yes and not wait_for_confirmation():
+        logger.info("Operation cancelled by user")
+        return False
+
+    JOURNAL.record('run', JOURNAL.run_id, 'started', namespaces=patterns, shards={}, mongos=[], daemon=True,
+                   persistent_user=FLUSH_USER.enabled)
+    RESULTS.emit('run', JOURNAL.run_id, state='started', namespaces=patterns, daemon=True)
+    logger.info(f"Run ID: {JOURNAL.run_id}")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    tail = ChangelogTail(DAEMON_LOOKBACK)
+    queue = ChangeQueue(args.debounce, DAEMON_MAX_DELAY, DAEMON_MAX_PENDING)
+    replica_sets = {}
+    flushed_namespaces = set()
+    shard_total = shard_successes = 0
 
-def main():
+    def read_changes():
+        """Queue the chunk events logged since the last poll."""
+        try:
+            events = [event for event in run_on_any_mongos(mongos_nodes, tail.poll, "read config.changelog")
+                      if event.get('ns') and namespace_selected(event['ns'], patterns)]
+            if any(shard not in replica_sets for event in events for shard in involved_shards(event)):
+                replica_sets.update(run_on_any_mongos(mongos_nodes, shard_replica_sets, "read config.shards"))
+        except RuntimeError as e:
+            logger.warning(f"{e}, retrying in {DAEMON_POLL_INTERVAL:g}s")
+            return
+        for event in events:
+            shards = {replica_sets.get(shard, shard) for shard in involved_shards(event)}
+            logger.info(f"{event['what']} on {event['ns']} touched {', '.join(sorted(shards))}")
+            queue.add(event['ns'], shards)
+
+    def flush(batch: Dict[str, List[str]]) -> int:
+        """Flush each shard of the batch for its changed namespaces. Returns success count."""
+        unknown = sorted(shard_name for shard_name in batch if shard_name not in shard_primaries)
+        if unknown:
+            logger.error(f"Changed shards have no known primary and will not be flushed: {', '.join(unknown)}")
+        shards = [(shard_name, shard_primaries[shard_name]) for shard_name in batch if shard_name in shard_primaries]
+        namespaces = sorted({namespace for shard_namespaces in batch.values() for namespace in shard_namespaces})
+        logger.info(f"Flushing {len(shards)} shard(s) for {len(namespaces)} changed namespace(s)")
+        RESULTS.emit('changes', JOURNAL.run_id, shards=sorted(batch), namespaces=namespaces)
+        flushed_namespaces.update(namespaces)
+        return process_all_shards(shards, batch, args) if shards else 0
+
+    next_poll = time.monotonic()
+    next_refresh = next_poll + DAEMON_TOPOLOGY_REFRESH
+    next_export = next_poll + DAEMON_METRICS_INTERVAL
     try:
-        logger.info("Fetching cluster hosts...")
-        all_hosts = get_all_hosts()
-        
-        # Get and display cluster topology
-        mongos_nodes, shard_primaries = get_cluster_topology(all_hosts)
-        
-        if not shard_primaries:
-            logger.error("No shard primaries found")
+        while not stop.is_set():
+            now = time.monotonic()
+            if now >= next_export:
+                export_metrics(args)
+                METRICS.reset()
+                next_export = now + DAEMON_METRICS_INTERVAL
+            if now >= next_refresh:
+                # Follow failovers and added shards; the old topology is kept if discovery fails
+                mongos_nodes, shard_primaries = discover_topology(args) or (mongos_nodes, shard_primaries)
+                next_refresh = now + DAEMON_TOPOLOGY_REFRESH
+            if now >= next_poll:
+                read_changes()
+                next_poll = now + DAEMON_POLL_INTERVAL
+
+            batch = queue.take_due()
+            if batch:
+                shard_total += len(batch)
+                shard_successes += flush(batch)
+                continue
+
+            stop.wait(max(min(next_poll, next_export, queue.next_due() or next_poll) - time.monotonic(), 0))
+    except KeyboardInterrupt:
+        pass
+
+    logger.info(f"Stopping; flushing {len(queue)} queued namespace(s)")
+    batch = queue.take_due(everything=True)
+    if batch:
+        shard_total += len(batch)
+        shard_successes += flush(batch)
+
+    return report_results(args, sorted(flushed_namespaces), shard_total, shard_successes, 0, 0)
+
+def discover_topology(args) -> Optional[Tuple[List[Dict], Dict]]:
+    """Return (mongos_nodes, shard_primaries) from the topology cache, the seed mongos or Cloud Manager.
+
+    Returns None if no shard primary or mongos was found.
+    """
+    cached_topology = get_cached_topology(args.topology_ttl, TOPOLOGY_MAX_INVALID_RATIO)
+    discovered = seed_topology(args.seed_mongos) if args.seed_mongos and not cached_topology else None
+    if cached_topology:
+        return cached_topology
+    if discovered:
+        mongos_nodes, shard_primaries, shard_members = discovered
+        save_topology_info(mongos_nodes, shard_primaries, shard_members)
+        return mongos_nodes, shard_primaries
+
+    logger.info("Fetching cluster hosts...")
+    with METRICS.timed('discovery', 'cloud_manager'):
+        all_hosts = asyncio.run(get_all_hosts_async()) if args.use_async else get_all_hosts()
+
+    # Get cluster topology
+    mongos_nodes, shard_primaries = get_cluster_topology(all_hosts)
+
+    if not shard_primaries:
+        logger.error("No shard primaries found")
+        return None
+
+    if not mongos_nodes:
+        logger.error("No mongos nodes found")
+        return None
+
+    save_topology_info(mongos_nodes, shard_primaries, shard_members_from_hosts(all_hosts))
+    return mongos_nodes, shard_primaries
+
+def drop_flush_user(shard_primaries: Dict, args) -> bool:
+    """Drop the persistent flush user and its role from every shard primary.
+
+    The bulk counterpart of the per-shard cleanup that --persistent-user runs
+    skip; shards are cleaned up --concurrency at a time.
+    """
+    print(f"\nDropping user {FLUSH_USER.username} and role {FLUSH_USER.role} from {len(shard_primaries)} shard(s)")
+    if not args.yes and not wait_for_confirmation():
+        logger.info("Operation cancelled by user")
+        return False
+
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        outcomes = dict(zip(shard_primaries, executor.map(
+            lambda item: cleanup_shard(item[0], item[1], FLUSH_USER.username, FLUSH_USER.role),
+            shard_primaries.items())))
+
+    failed = [shard_name for shard_name, ok in outcomes.items() if not ok]
+    print(f"\nDropped the flush user on {len(outcomes) - len(failed)}/{len(outcomes)} shard(s)")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    return not failed
+
+def export_metrics(args):
+    """Write the phase metrics to the --metrics-json and --metrics-prom files, if given."""
+    if args.metrics_json:
+        METRICS.export_json(args.metrics_json, JOURNAL.run_id)
+        logger.info(f"Phase metrics written to {args.metrics_json}")
+    if args.metrics_prom:
+        METRICS.export_prometheus(args.metrics_prom)
+        logger.info(f"Prometheus metrics written to {args.metrics_prom}")
+
+def report_results(args, namespaces: List[str], shard_total: int, shard_successes: int,
+                   mongos_total: int, mongos_successes: int, cleanup_total: int = 0, cleanup_successes: int = 0,
+                   discovery_error: str = None, resumable: bool = True) -> bool:
+    """Print the operation summary and phase latencies, export metrics and emit the final NDJSON record.
+
+    A `discovery_error` means the cluster was only partly listed, so the run
+    fails whatever the counts of the nodes it did find say. Runs that are not
+    `resumable` (--targets) get no --resume hint.
+    """
+    # Calculate totals
+    total_operations = shard_total + cleanup_total + mongos_total
+    successful_operations = shard_successes + cleanup_successes + mongos_successes
+    failed_operations = total_operations - successful_operations
+    
+    # Display final summary
+    print("\n=== Operation Summary ===")
+    if discovery_error:
+        print(f"Discovery incomplete, only the nodes found are counted below: {discovery_error}")
+    print(f"Total operations attempted: {total_operations}")
+    print(f"Successful operations: {successful_operations}")
+    print(f"Failed operations: {failed_operations}")
+    print(f"Success rate: {(successful_operations/max(total_operations, 1))*100:.2f}%")
+    print("\nBreakdown:")
+    print(f"- Shard operations (setup + flush): {shard_successes}/{shard_total} successful")
+    if cleanup_total:
+        print(f"- Leftover cleanups: {cleanup_successes}/{cleanup_total} successful")
+    print(f"- Mongos verify: {mongos_successes}/{mongos_total} successful")
+    print(f"- Namespaces in batch: {len(namespaces)}")
+    if resumable:
+        print(f"\nRun ID: {JOURNAL.run_id} (rerun with --resume {JOURNAL.run_id} to retry unfinished work)")
+    else:
+        print(f"\nRun ID: {JOURNAL.run_id} (run --targets again to retry unfinished work)")
+
+    METRICS.print_summary()
+    STRAGGLERS.print_report(METRICS)
+    print()
+    export_metrics(args)
+
+    RESULTS.emit('run', JOURNAL.run_id, state='finished', attempted=total_operations,
+                 succeeded=successful_operations, failed=failed_operations,
+                 shards={'attempted': shard_total, 'succeeded': shard_successes},
+                 mongos={'attempted': mongos_total, 'succeeded': mongos_successes},
+                 cleanups={'attempted': cleanup_total, 'succeeded': cleanup_successes},
+                 discovery_error=discovery_error)
+    
+    logger.info("All operations completed")
+    return successful_operations > 0 and not discovery_error
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Flush routing table cache updates on all shard primaries.")
+    parser.add_argument('--concurrency', type=int, default=FLUSH_CONCURRENCY,
+                        help="Maximum number of shards processed at the same time")
+    parser.add_argument('--rate', type=float, default=FLUSH_RATE,
+                        help="Maximum shards started per second (0 disables rate limiting)")
+    parser.add_argument('--targets', metavar='PATH',
+                        help="Flush every cluster in this JSON list of {project, cluster, namespaces} targets, "
+                             "with --concurrency as the global limit")
+    parser.add_argument('--cluster-concurrency', type=int, default=CLUSTER_CONCURRENCY,
+                        help="With --targets, maximum shards in flight per cluster (0 = only the global limit)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Adapt the shards in flight (up to --concurrency) to replication lag, queued "
+                             "operations and flush latency, pausing shards whose primary is unhealthy")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Run discovery, flush and mongos verification on a single asyncio event loop")
+    parser.add_argument('--mongos-fanout', type=int, default=MONGOS_FANOUT,
+                        help="Maximum number of mongos warmed up at the same time")
+    parser.add_argument('--probe-timeout', type=float, default=MONGOS_PROBE_TIMEOUT,
+                        help="Seconds before a mongos probe is cancelled")
+    parser.add_argument('--flush-router-config', action='store_true',
+                        help="Run flushRouterConfig for each namespace on every mongos before probing it")
+    parser.add_argument('--namespace', action='append',
+                        help="Namespace to flush; repeat for a batch, or use 'db.*' for every sharded "
+                             f"collection of a database (default: {NAMESPACE})")
+    parser.add_argument('--targeted', action='store_true',
+                        help="Only flush shards that own chunks of the namespaces (read from config.chunks)")
+    parser.add_argument('--include-donors', type=float, default=0, metavar='SECONDS',
+                        help="With --targeted, also flush shards that donated chunks in the last SECONDS")
+    parser.add_argument('--shard-budget', type=float, default=SHARD_BUDGET, metavar='SECONDS',
+                        help="Wall-clock budget per shard; commands get a maxTimeMS and the flush a wtimeout from what "
+                             "is left, and shards that run out are retried at the end (0 = no limit)")
+    parser.add_argument('--straggler-rounds', type=int, default=STRAGGLER_ROUNDS,
+                        help=f"End-of-run retries of shards that ran out of budget, each with a "
+                             f"{STRAGGLER_BUDGET_FACTOR:g}x longer budget")
+    parser.add_argument('--defer-verify', action='store_true',
+                        help="Verify the flush counters of all shards in one batch at the end of the run")
+    parser.add_argument('--resume', nargs='?', const='latest', metavar='RUN_ID',
+                        help=f"Resume a run from {JOURNAL_FILE}, redoing only unfinished shards and mongos "
+                             "(default: the latest run)")
+    parser.add_argument('--stream', action='store_true',
+                        help="Start flushing shards while Cloud Manager pages are still arriving "
+                             "(confirmation is asked before discovery)")
+    parser.add_argument('--yes', action='store_true',
+                        help="Do not ask for confirmation, for non-interactive runs")
+    parser.add_argument('--ndjson', metavar='PATH',
+                        help="Stream one JSON record per finished shard, mongos and run to PATH ('-' for stdout)")
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="Write per-phase latency samples and percentiles to a JSON file")
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help="Write per-phase latency percentiles as a Prometheus textfile")
+    parser.add_argument('--persistent-user', action='store_true',
+                        help=f"Flush as a long-lived user ({PERSISTENT_FLUSH_USER}) holding only the flush role, created "
+                             f"once and given a new password every {FLUSH_USER_ROTATION_DAYS:g} days, instead of "
+                             "creating and dropping a user and role on every shard")
+    parser.add_argument('--drop-flush-user', action='store_true',
+                        help="Only drop the persistent flush user and the flush role from every shard primary, "
+                             "--concurrency at a time")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Run until stopped, tailing config.changelog and flushing only the donor and recipient "
+                             "shards of recent migrations, splits and merges (--namespace filters the namespaces)")
+    parser.add_argument('--debounce', type=float, default=DAEMON_DEBOUNCE, metavar='SECONDS',
+                        help="With --daemon, flush a namespace once it has seen no changes for this long")
+    parser.add_argument('--seed-mongos', default=SEED_MONGOS, metavar='HOST:PORT',
+                        help="Discover shards and routers through this mongos (listShards, config.mongos) "
+                             "and use Cloud Manager only if that fails")
+    parser.add_argument('--topology-ttl', type=float, default=TOPOLOGY_CACHE_TTL,
+                        help="Reuse cluster_topology.json if younger than this many seconds (0 = always rediscover)")
+    return parser.parse_args()
+
+def main(args):
+    try:
+        if args.use_async and (httpx is None or AsyncMongoClient is None):
+            logger.error("Async mode requires httpx and either pymongo>=4.13 or motor")
             return False
 
-        if not mongos_nodes:
-            logger.error("No mongos nodes found")
+        if RECOMMENDED:
+            logger.info(f"Using {LATENCY_MAP_FILE} defaults: concurrency {RECOMMENDED['concurrency']}, "
+                        f"node timeout {RECOMMENDED['node_timeout']}s (flags and environment variables take precedence)")
+
+        RESULTS.open(args.ndjson, JOURNAL.run_id)
+        FLUSH_USER.enabled = args.persistent_user
+        if args.drop_flush_user and (args.targets or args.stream or args.resume):
+            logger.error("--drop-flush-user cannot be combined with --targets, --stream or --resume")
             return False
-        
-        # Save and display topology
-        save_topology_info(mongos_nodes, shard_primaries)
+        if args.daemon:
+            if args.use_async or args.resume or args.stream or args.targets or args.drop_flush_user:
+                logger.error("--daemon cannot be combined with --async, --resume, --stream, --targets "
+                             "or --drop-flush-user")
+                return False
+            return run_daemon(args)
+        if args.targets:
+            if args.use_async or args.resume or args.stream:
+                logger.error("--targets cannot be combined with --async, --resume or --stream")
+                return False
+            return run_fleet(args)
+        if args.stream:
+            if args.use_async or args.resume:
+                logger.error("--stream cannot be combined with --async or --resume")
+                return False
+            return run_streaming(args)
+
+        run = None
+        if args.resume:
+            run = load_run(JOURNAL_FILE, None if args.resume == 'latest' else args.resume)
+            if run is None:
+                logger.error(f"No run to resume in {JOURNAL_FILE}")
+                return False
+            if run['clusters']:
+                # Its shards are journaled as <cluster>/<shard>, which no single-cluster topology contains
+                logger.error(f"Run {run['run_id']} flushed clusters {', '.join(run['clusters'])} with --targets "
+                             "and cannot be resumed; run --targets again instead")
+                return False
+
+        topology = discover_topology(args)
+        if topology is None:
+            return False
+        mongos_nodes, shard_primaries = topology
+
         display_topology(mongos_nodes, shard_primaries)
+
+        if args.drop_flush_user:
+            return drop_flush_user(shard_primaries, args)
+
+        cleanup_primaries = {}
+        if run:
+            # Only schedule the shards and mongos the journal does not show as finished
+            JOURNAL.run_id = RESULTS.run_id = run['run_id']
+            FLUSH_USER.enabled = FLUSH_USER.enabled or run['persistent_user']
+            namespaces = run['namespaces']
+            redo_shards = shards_to_redo(run)
+            cleanup_shards = shards_needing_cleanup(run)
+            missing = [shard_name for shard_name in redo_shards + cleanup_shards if shard_name not in shard_primaries]
+            if missing:
+                logger.error(f"Shards from run {run['run_id']} not found in the current topology: {', '.join(missing)}")
+
+            shard_namespaces = {shard_name: run['shard_namespaces'][shard_name]
+                                for shard_name in redo_shards if shard_name in shard_primaries}
+            cleanup_primaries = {shard_name: shard_primaries[shard_name]
+                                 for shard_name in cleanup_shards if shard_name in shard_primaries}
+            shard_primaries = {shard_name: shard_primaries[shard_name] for shard_name in shard_namespaces}
+            remaining_mongos = set(mongos_to_redo(run))
+            mongos_nodes = [mongos for mongos in mongos_nodes
+                            if f"{mongos['hostname']}:{mongos['port']}" in remaining_mongos]
+
+            print(f"\nResuming run {run['run_id']}: {len(shard_primaries)} shard(s) to flush, "
+                  f"{len(cleanup_primaries)} to clean up, {len(mongos_nodes)} mongos to verify")
+            if not shard_primaries and not cleanup_primaries and not mongos_nodes:
+                if missing:
+                    logger.error(f"Run {run['run_id']} has unfinished shards that are not in the current topology")
+                    return False
+                logger.info(f"Run {run['run_id']} has no unfinished work")
+                return True
+        else:
+            namespaces = resolve_namespaces(args.namespace or [NAMESPACE], mongos_nodes)
+            if not namespaces:
+                logger.error("No namespaces to flush")
+                return False
+            print(f"\nNamespaces to flush ({len(namespaces)}): {', '.join(namespaces)}")
+
+            # Only flush shards that own chunks of the batch when targeting is enabled
+            if args.targeted:
+                shard_namespaces = plan_targeted_shards(mongos_nodes, shard_primaries, namespaces, args.include_donors)
+                skipped_shards = len(shard_primaries) - len(shard_namespaces)
+                shard_primaries = {shard_name: shard_primaries[shard_name] for shard_name in shard_namespaces}
+                print(f"Targeted flush: {len(shard_primaries)} shard(s) own chunks, {skipped_shards} skipped")
+            else:
+                shard_namespaces = {shard_name: namespaces for shard_name in shard_primaries}
         
         # Wait for user confirmation
-        if not wait_for_confirmation():
+        if not args.yes and not wait_for_confirmation():
             logger.info("Operation cancelled by user")
             return False
+
+        if not args.resume:
+            JOURNAL.record('run', JOURNAL.run_id, 'started', namespaces=namespaces, shards=shard_namespaces,
+                           mongos=[f"{mongos['hostname']}:{mongos['port']}" for mongos in mongos_nodes],
+                           persistent_user=FLUSH_USER.enabled)
+        logger.info(f"Run ID: {JOURNAL.run_id}")
         
         # Setup tracking variables
-        total_operations = len(shard_primaries) + len(mongos_nodes)
-        shard_successes = 0
         mongos_successes = 0
 
-        # Process each shard
-        for idx, (shard_name, primary) in enumerate(shard_primaries.items(), 1):
-            logger.info(f"Processing shard: {shard_name} ({idx}/{len(shard_primaries)})")
-            
-            if process_shard(shard_name, primary):
-                shard_successes += 1
-            
-            time.sleep(0.2)
-            
-            if idx % 10 == 0:
-                completion_rate = (idx / len(shard_primaries)) * 100
-                logger.info(f"Progress: {completion_rate:.1f}% ({idx}/{len(shard_primaries)} shards)")
-
-        # Verify mongos nodes
-        if mongos_nodes:
-            logger.info("Verifying mongos nodes...")
-            for idx, mongos in enumerate(mongos_nodes, 1):
-                if perform_findAll_on_allMongos([mongos], NAMESPACE):
-                    mongos_successes += 1
-                time.sleep(0.2)
-                
-                if idx % 10 == 0:
-                    logger.info(f"Completed mongos verification: {idx}/{len(mongos_nodes)}")
-        
-        # Calculate totals
-        successful_operations = shard_successes + mongos_successes
-        failed_operations = total_operations - successful_operations
-        
-        # Display final summary
-        print("\n=== Operation Summary ===")
-        print(f"Total operations attempted: {total_operations}")
-        print(f"Successful operations: {successful_operations}")
-        print(f"Failed operations: {failed_operations}")
-        print(f"Success rate: {(successful_operations/total_operations)*100:.2f}%")
-        print("\nBreakdown:")
-        print(f"- Shard operations (setup + flush): {shard_successes}/{len(shard_primaries)} successful")
-        print(f"- Mongos verify: {mongos_successes}/{len(mongos_nodes)} successful\n")
+        # Leftover users and roles from a crashed run
+        cleanup_successes = 0
+        if cleanup_primaries:
+            with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+                cleanup_successes = sum(1 for ok in executor.map(lambda item: cleanup_shard(*item),
+                                                                  cleanup_primaries.items()) if ok)
+
+        if args.use_async:
+            shard_successes, mongos_successes = asyncio.run(
+                process_all_async(shard_primaries, mongos_nodes, shard_namespaces, namespaces, args))
+        else:
+            # Process shards with bounded concurrency
+            shard_successes = process_all_shards(shard_primaries.items(), shard_namespaces, args)
+
+            # Verify mongos nodes
+            if mongos_nodes:
+                mongos_successes = warm_up_all_mongos(mongos_nodes, namespaces, args)
         
-        logger.info("All operations completed")
-        return successful_operations > 0
+        return report_results(args, namespaces, len(shard_primaries), shard_successes, len(mongos_nodes),
+                              mongos_successes, len(cleanup_primaries), cleanup_successes)
         
     except Exception as err:
         logger.error(f"Script failed: {err}")
         return False
+    finally:
+        JOURNAL.close()
+        RESULTS.close()
+        CLIENTS.close_all()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.ndjson == '-':
+        # Keep stdout for the NDJSON records; the human-readable output goes to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            main(args)
+    else:
+        main(args)
\ No newline at end of file
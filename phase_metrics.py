@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+from pymongo import monitoring
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class PhaseMetrics:
+    """Thread-safe collection of (phase, node, seconds) latency samples for one run."""
+
+    def __init__(self):
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, node: str, seconds: float):
+        with self._lock:
+            self._samples.append((phase, node, seconds))
+
+    @contextmanager
+    def timed(self, phase: str, node: str):
+        """Record how long the enclosed block took, whether or not it raised."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, node, time.monotonic() - start)
+
+    def stopwatch(self, node: str) -> 'Stopwatch':
+        return Stopwatch(self, node)
+
+    def reset(self):
+        """Drop every sample, e.g. once a long-running process has exported them."""
+        with self._lock:
+            self._samples = []
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return list(self._samples)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per-phase count, p50, p95, p99, max and sum in seconds."""
+        by_phase = {}
+        for phase, _, seconds in self.samples():
+            by_phase.setdefault(phase, []).append(seconds)
+
+        summary = {}
+        for phase, values in sorted(by_phase.items()):
+            values.sort()
+            summary[phase] = {
+                'count': len(values),
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+                'sum': sum(values)
+            }
+        return summary
+
+    def slowest(self, phase: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """The `limit` nodes with the longest samples for `phase`."""
+        samples = [(node, seconds) for sample_phase, node, seconds in self.samples() if sample_phase == phase]
+        return sorted(samples, key=lambda sample: sample[1], reverse=True)[:limit]
+
+    def print_summary(self, slowest_phase: str = 'shard'):
+        summary = self.summary()
+        if not summary:
+            return
+
+        print("\n=== Phase Latency (seconds) ===")
+        print(f"{'phase':<40} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for phase, stats in summary.items():
+            print(f"{phase:<40} {stats['count']:>6} {stats['p50']:>8.3f} {stats['p95']:>8.3f} "
+                  f"{stats['p99']:>8.3f} {stats['max']:>8.3f}")
+
+        slowest = self.slowest(slowest_phase)
+        if slowest:
+            print(f"\nSlowest {slowest_phase}s:")
+            for node, seconds in slowest:
+                print(f"- {node}: {seconds:.3f}s")
+
+    def export_json(self, path: str, run_id: str):
+        with open(path, 'w') as f:
+            json.dump({
+                'run_id': run_id,
+                'summary': self.summary(),
+                'samples': [{'phase': phase, 'node': node, 'seconds': seconds}
+                            for phase, node, seconds in self.samples()]
+            }, f, indent=2)
+
+    def export_prometheus(self, path: str):
+        """Write a node_exporter textfile; written to a temp file and renamed so scrapes never see a partial file."""
+        lines = [
+            '# HELP mongo_cache_flush_last_run_timestamp_seconds When the last mongo-cache-flush run finished.',
+            '# TYPE mongo_cache_flush_last_run_timestamp_seconds gauge',
+            f'mongo_cache_flush_last_run_timestamp_seconds {time.time():.0f}',
+            '# HELP mongo_cache_flush_phase_seconds Per-phase latency of the last mongo-cache-flush run.',
+            '# TYPE mongo_cache_flush_phase_seconds summary'
+        ]
+        for phase, stats in self.summary().items():
+            labels = f'phase="{phase}"'
+            for quantile in ('p50', 'p95', 'p99'):
+                lines.append(f'mongo_cache_flush_phase_seconds{{{labels},quantile="0.{quantile[1:]}"}} {stats[quantile]:.6f}')
+            lines.append(f'mongo_cache_flush_phase_seconds_sum{{{labels}}} {stats["sum"]:.6f}')
+            lines.append(f'mongo_cache_flush_phase_seconds_count{{{labels}}} {stats["count"]}')
+        lines.append('# HELP mongo_cache_flush_phase_max_seconds Slowest sample per phase of the last run.')
+        lines.append('# TYPE mongo_cache_flush_phase_max_seconds gauge')
+        for phase, stats in self.summary().items():
+            lines.append(f'mongo_cache_flush_phase_max_seconds{{phase="{phase}"}} {stats["max"]:.6f}')
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+class Stopwatch:
+    """Records consecutive phases of one node's work: each lap() closes the phase since the previous lap."""
+
+    def __init__(self, metrics: PhaseMetrics, node: str):
+        self.metrics = metrics
+        self.node = node
+        self.start = self._last = time.monotonic()
+
+    def lap(self, phase: str) -> float:
+        """Record and return the seconds since the previous lap."""
+        now = time.monotonic()
+        seconds = now - self._last
+        self.metrics.record(phase, self.node, seconds)
+        self._last = now
+        return seconds
+
+    def total(self, phase: str):
+        """Record the time since the stopwatch was created."""
+        self.metrics.record(phase, self.node, time.monotonic() - self.start)
+
+
+class CommandTimingListener(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """Feeds every command's round trip, and each new connection's connect + auth time, into PhaseMetrics."""
+
+    def __init__(self, metrics: PhaseMetrics):
+        self.metrics = metrics
+
+    def _node(self, event) -> str:
+        return f"{event.connection_id[0]}:{event.connection_id[1]}" if event.connection_id else 'unknown'
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.record(f'command:{event.command_name}', self._node(event), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.record(f'command:{event.command_name}', self._node(event), event.duration_micros / 1e6)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        # duration (connect, TLS and authentication) is reported by PyMongo 4.7+
+        duration = getattr(event, 'duration', None)
+        if duration is not None:
+            self.metrics.record('connect+auth', f"{event.address[0]}:{event.address[1]}", duration)
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
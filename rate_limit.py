@@ -0,0 +1,128 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Iterator, Optional
+
+
+def jittered_backoff(retries: int, initial: float = 1.0, maximum: float = 15.0) -> Iterator[float]:
+    """Yield `retries` delays that double from `initial` up to `maximum`, each scaled by a random 50-100%.
+
+    The jitter keeps shards that failed over together from retrying in lockstep.
+    """
+    delay = initial
+    for _ in range(retries):
+        yield delay * random.uniform(0.5, 1.0)
+        delay = min(delay * 2, maximum)
+
+
+class RetryLater(Exception):
+    """Raised by a task that cannot make progress yet; the scheduler runs it again after `delay` seconds."""
+
+    def __init__(self, message: str, delay: float):
+        super().__init__(message)
+        self.delay = delay
+
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace operations against the cluster.
+
+    `rate` tokens are added per second up to `capacity`. A rate of 0 or less
+    disables limiting entirely.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _reserve(self) -> float:
+        """Take a token if one is available, otherwise return seconds to wait."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available."""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait on the event loop until a token is available."""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+class AIMDLimiter:
+    """Thread-safe adaptive cap on operations in flight (additive increase, multiplicative decrease).
+
+    The limit starts at `initial` and stays between `minimum` and `maximum`.
+    Each healthy report raises it by 1/limit, so it grows by about one per
+    round of completions. An unhealthy report multiplies it by `backoff`, at
+    most once per `cooldown` seconds so a single burst of bad samples counts
+    as one congestion event.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: Optional[int] = None,
+                 backoff: float = 0.5, cooldown: float = 2.0):
+        self.maximum = max(maximum, 1)
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.limit = float(min(max(initial or self.minimum, self.minimum), self.maximum))
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self) -> bool:
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Block until fewer than `limit` operations are in flight."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def acquire_async(self, poll_interval: float = 0.05):
+        """Wait on the event loop until fewer than `limit` operations are in flight."""
+        while not self._try_acquire():
+            await asyncio.sleep(poll_interval)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def report(self, healthy: bool):
+        """Feed back the outcome of one operation and adjust the limit."""
+        with self._condition:
+            if healthy:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            elif time.monotonic() - self._last_decrease >= self.cooldown:
+                self.limit = max(self.limit * self.backoff, self.minimum)
+                self._last_decrease = time.monotonic()
+            self._condition.notify_all()
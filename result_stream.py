@@ -0,0 +1,44 @@
+import json
+import sys
+import threading
+import time
+from typing import Optional
+
+
+class ResultStream:
+    """Emit one NDJSON record per finished shard, mongos and run as results come in.
+
+    Does nothing until open() is given a path; '-' writes to the stdout the
+    process started with. Each record is flushed immediately so a consumer
+    (e.g. `tail -f` or `jq`) sees it without waiting for the end of the run.
+    """
+
+    def __init__(self):
+        self.run_id = None
+        self._file = None
+        self._owned = False
+        self._lock = threading.Lock()
+
+    def open(self, path: Optional[str], run_id: str):
+        self.run_id = run_id
+        if path == '-':
+            self._file = sys.__stdout__
+        elif path:
+            self._file = open(path, 'a')
+            self._owned = True
+
+    def emit(self, kind: str, name: str, **fields):
+        if self._file is None:
+            return
+        record = json.dumps({'ts': time.time(), 'run_id': self.run_id, 'kind': kind, 'name': name, **fields},
+                            default=str)
+        with self._lock:
+            self._file.write(record + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._owned:
+                self._file.close()
+            self._file = None
+            self._owned = False
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'flush_journal.ndjson'
+
+# States recorded for each shard and mongos, in the order they normally happen.
+# PLANNED is only journaled by --stream runs, where nodes are scheduled as
+# they are discovered rather than listed up front in the 'run' record.
+PLANNED = 'planned'
+PROVISIONED = 'provisioned'
+FLUSHED = 'flushed'
+VERIFIED = 'verified'
+CLEANED_UP = 'cleaned_up'
+FAILED = 'failed'
+
+
+class RunJournal:
+    """Append-only NDJSON journal of per-node outcomes, keyed by run ID.
+
+    Records are buffered and written with a single fsync once `batch_size`
+    records are pending or `sync_interval` seconds have passed, so a crash loses
+    at most the last unsynced batch; those nodes are simply redone on resume.
+    """
+
+    def __init__(self, path: str = JOURNAL_FILE, batch_size: int = 32, sync_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.run_id = uuid.uuid4().hex[:12]
+        self._buffer = []
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, name: str, state: str, **details):
+        """Record that node `name` of `kind` ('run', 'shard' or 'mongos') reached `state`."""
+        entry = {'run_id': self.run_id, 'ts': time.time(), 'kind': kind, 'name': name, 'state': state, **details}
+        with self._lock:
+            self._buffer.append(json.dumps(entry, default=str))
+            if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        """Write and fsync the buffered records. Caller holds the lock."""
+        if not self._buffer:
+            return
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(self._buffer) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer.clear()
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+
+
+def load_run(path: str = JOURNAL_FILE, run_id: Optional[str] = None) -> Optional[Dict]:
+    """Rebuild the state of a run from the journal.
+
+    Uses the most recent run when `run_id` is None. Returns None if the run is
+    not found, otherwise a dict with the run's 'run_id', 'namespaces', the
+    planned 'shard_namespaces' (shard name -> namespaces) and 'mongos_names',
+    whether it used the 'persistent_user', the 'clusters' of a --targets run,
+    and the set of states reached per node under 'shards' and 'mongos'.
+    """
+    if not os.path.exists(path):
+        return None
+
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A torn last line from a crash mid-write
+                continue
+
+    if run_id is None:
+        starts = [entry for entry in entries if entry['kind'] == 'run']
+        if not starts:
+            return None
+        run_id = starts[-1]['run_id']
+
+    run = {'run_id': run_id, 'namespaces': [], 'shard_namespaces': {}, 'mongos_names': [], 'shards': {}, 'mongos': {},
+           'persistent_user': False, 'clusters': []}
+    found = False
+    for entry in entries:
+        if entry['run_id'] != run_id:
+            continue
+        found = True
+        if entry['kind'] == 'run':
+            run['persistent_user'] = entry.get('persistent_user', run['persistent_user'])
+            run['clusters'] = entry.get('clusters', run['clusters'])
+            run['namespaces'] = entry.get('namespaces', run['namespaces'])
+            run['shard_namespaces'] = entry.get('shards', run['shard_namespaces'])
+            run['mongos_names'] = entry.get('mongos', run['mongos_names'])
+        elif entry['state'] == PLANNED:
+            if entry['kind'] == 'shard':
+                run['shard_namespaces'][entry['name']] = entry.get('namespaces', run['namespaces'])
+            elif entry['name'] not in run['mongos_names']:
+                run['mongos_names'].append(entry['name'])
+        else:
+            nodes = run['shards' if entry['kind'] == 'shard' else 'mongos']
+            nodes.setdefault(entry['name'], set()).add(entry['state'])
+
+    return run if found else None
+
+
+def shards_needing_cleanup(run: Dict) -> List[str]:
+    """Shards that were verified but whose flush user/role cleanup never completed.
+
+    Always empty for runs that used the persistent flush user, which is left
+    in place on purpose.
+    """
+    if run.get('persistent_user'):
+        return []
+    return [name for name in run['shard_namespaces']
+            if VERIFIED in run['shards'].get(name, set()) and CLEANED_UP not in run['shards'].get(name, set())]
+
+
+def shards_to_redo(run: Dict) -> List[str]:
+    """Shards that never reached a verified flush."""
+    return [name for name in run['shard_namespaces'] if VERIFIED not in run['shards'].get(name, set())]
+
+
+def mongos_to_redo(run: Dict) -> List[str]:
+    return [name for name in run['mongos_names'] if VERIFIED not in run['mongos'].get(name, set())]
@@ -0,0 +1,104 @@
+import logging
+from typing import Dict, Optional
+
+from flush_verify import EXCLUDED_SECTIONS, backoff_delays
+from rate_limit import AIMDLimiter, RetryLater
+from step_runner import Command, Steps
+
+logger = logging.getLogger(__name__)
+
+# serverStatus with only globalLock, for the queued operation count
+HEALTH_SECTIONS = {**{section: 0 for section in EXCLUDED_SECTIONS if section != 'globalLock'}, 'metrics': 0}
+
+
+def replication_lag(status: Dict) -> float:
+    """Seconds the furthest-behind healthy secondary trails the primary, from a replSetGetStatus reply."""
+    primary, secondaries = None, []
+    for member in status.get('members', []):
+        if not member.get('health', 1) or not member.get('optimeDate'):
+            continue
+        if member.get('stateStr') == 'PRIMARY':
+            primary = member['optimeDate']
+        elif member.get('stateStr') == 'SECONDARY':
+            secondaries.append(member['optimeDate'])
+    if primary is None or not secondaries:
+        return 0.0
+    return max((primary - min(secondaries)).total_seconds(), 0.0)
+
+
+def queued_operations(status: Dict) -> int:
+    """Readers and writers waiting for a lock, from a serverStatus reply."""
+    return int(status.get('globalLock', {}).get('currentQueue', {}).get('total', 0))
+
+
+def read_health(admin_db) -> Steps:
+    """Sample replication lag and queued operations on a shard primary."""
+    return {'lag': replication_lag((yield Command(admin_db, 'replSetGetStatus'))),
+            'queued': queued_operations((yield Command(admin_db, 'serverStatus', 1, **HEALTH_SECTIONS)))}
+
+
+class HealthGate:
+    """Holds back shards whose primary is lagging or queueing and drives an AIMDLimiter.
+
+    Before a shard is flushed, check() samples its health. While replication
+    lag exceeds `max_lag` seconds or more than `max_queued` operations are
+    queued, the shard is paused for up to `max_pause` seconds: check() raises
+    RetryLater with a backoff delay, and the caller gives up the shard's limiter
+    slot and worker and runs it again once the delay has passed, so healthy
+    shards keep flowing. Every unhealthy sample, and every flush slower than
+    `max_flush_latency` seconds per namespace, shrinks the limiter; healthy
+    shards grow it.
+    """
+
+    def __init__(self, limiter: AIMDLimiter, max_lag: float = 10.0, max_queued: int = 50,
+                 max_flush_latency: float = 2.0, max_pause: float = 60.0):
+        self.limiter = limiter
+        self.max_lag = max_lag
+        self.max_queued = max_queued
+        self.max_flush_latency = max_flush_latency
+        self.max_pause = max_pause
+        self._paused = {}
+
+    def _problem(self, health: Optional[Dict[str, float]]) -> Optional[str]:
+        if health is None:
+            return None
+        if health['lag'] > self.max_lag:
+            return f"replication lag {health['lag']:.1f}s"
+        if health['queued'] > self.max_queued:
+            return f"{health['queued']} queued operations"
+        return None
+
+    def _sample(self, admin_db, shard_name: str) -> Steps:
+        try:
+            return (yield from read_health(admin_db))
+        except Exception as e:
+            # Health is advisory: a shard whose signals cannot be read is not held back
+            logger.warning(f"Could not read health of shard {shard_name}: {e}")
+            return None
+
+    def check(self, admin_db, shard_name: str) -> Steps:
+        """Return None if the shard is healthy, or the problem once it has been paused for `max_pause` seconds.
+
+        Raises RetryLater while the shard is paused.
+        """
+        problem = self._problem((yield from self._sample(admin_db, shard_name)))
+        delays = self._paused.get(shard_name)
+        if not problem:
+            if delays is not None:
+                del self._paused[shard_name]
+                logger.info(f"Shard {shard_name} recovered, resuming")
+            return None
+
+        self.limiter.report(False)
+        if delays is None:
+            logger.warning(f"Pausing shard {shard_name}: {problem}")
+            delays = self._paused[shard_name] = backoff_delays(self.max_pause, initial=0.5, maximum=5.0)
+        delay = next(delays, None)
+        if delay is None:
+            del self._paused[shard_name]
+            return problem
+        raise RetryLater(f"shard {shard_name} paused: {problem}", delay)
+
+    def flushed(self, seconds: float, namespaces: int):
+        """Report a finished flush; slow flushes count as congestion."""
+        self.limiter.report(seconds / max(namespaces, 1) <= self.max_flush_latency)
@@ -0,0 +1,71 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Set
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+# config.changelog events that name a chunk donor in details.from
+MIGRATION_EVENTS = ['moveChunk.start', 'moveChunk.commit']
+
+
+def shard_replica_sets(client: MongoClient) -> Dict[str, str]:
+    """Map each shard id in config.shards to its replica set name."""
+    return {shard['_id']: shard['host'].split('/')[0]
+            for shard in client.config.shards.find({}, {'_id': 1, 'host': 1})}
+
+
+def chunk_counts(client: MongoClient, namespace: str) -> Dict[str, int]:
+    """Count the chunks of `namespace` owned by each shard id.
+
+    Unsharded namespaces live on their database's primary shard, which is
+    returned with a count of 0.
+    """
+    collection = client.config.collections.find_one({'_id': namespace})
+    if collection is None or collection.get('dropped'):
+        database = client.config.databases.find_one({'_id': namespace.split('.', 1)[0]})
+        return {database['primary']: 0} if database else {}
+
+    # Chunks are keyed by collection uuid since 5.0 and by ns before that
+    match = {'$or': [{'uuid': collection['uuid']}, {'ns': namespace}]} if 'uuid' in collection else {'ns': namespace}
+    return {doc['_id']: doc['chunks'] for doc in client.config.chunks.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$shard', 'chunks': {'$sum': 1}}}
+    ])}
+
+
+def recent_donors(client: MongoClient, namespace: str, window_seconds: float) -> Set[str]:
+    """Shard ids that donated chunks of `namespace` in the last `window_seconds`."""
+    since = datetime.now(timezone.utc) - timedelta(seconds=window_seconds)
+    return {event['details']['from'] for event in client.config.changelog.find(
+        {'ns': namespace, 'what': {'$in': MIGRATION_EVENTS}, 'time': {'$gte': since}},
+        {'details.from': 1})
+        if event.get('details', {}).get('from')}
+
+
+def plan_targeted_flush(client: MongoClient, namespaces: List[str],
+                        donor_window_seconds: float = 0) -> Dict[str, List[str]]:
+    """Return replica set name -> namespaces it owns chunks of (plus recent donors).
+
+    `client` must be connected to a mongos.
+    """
+    replica_sets = shard_replica_sets(client)
+    plan = {}
+
+    for namespace in namespaces:
+        owners = chunk_counts(client, namespace)
+        shard_ids = set(owners)
+        if donor_window_seconds > 0:
+            donors = recent_donors(client, namespace, donor_window_seconds) - shard_ids
+            if donors:
+                logger.info(f"Including recent donors of {namespace}: {', '.join(sorted(donors))}")
+            shard_ids |= donors
+
+        logger.info(f"{namespace}: chunks on {len(owners)} shard(s) "
+                    f"({', '.join(f'{shard}={count}' for shard, count in sorted(owners.items()))})")
+
+        for shard_id in shard_ids:
+            plan.setdefault(replica_sets.get(shard_id, shard_id), []).append(namespace)
+
+    return plan
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, ExitStack
+from typing import Any, Callable, Generator, List
+
+from connection_registry import ClientRegistry, close_client
+
+# A command sequence written once as a generator: it yields the steps below
+# and gets each step's result sent back, so run_steps() can drive it with
+# blocking calls and run_steps_async() on an event loop.
+Steps = Generator[Any, Any, Any]
+
+
+class Command:
+    """db.command(*args, **kwargs); the reply is sent back."""
+
+    def __init__(self, db, *args, **kwargs):
+        self.db = db
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Lease:
+    """Lease the registry's client for a node and credential until the run ends; the client is sent back."""
+
+    def __init__(self, hostname: str, port: int, username: str = None, password: str = None):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+
+
+class Discard:
+    """Remove a node's client from the registry and close it."""
+
+    def __init__(self, hostname: str, port: int, username: str = None):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+
+
+class Sleep:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+
+class Blocking:
+    """Call fn(*args), on a worker thread when running on an event loop; its result is sent back."""
+
+    def __init__(self, fn: Callable, *args):
+        self.fn = fn
+        self.args = args
+
+
+class Parallel:
+    """Run several step generators, at most `concurrency` at a time; their results are sent back in order."""
+
+    def __init__(self, steps: List[Steps], concurrency: int):
+        self.steps = steps
+        self.concurrency = max(concurrency, 1)
+
+
+def run_steps(steps: Steps, registry: ClientRegistry):
+    """Drive a step generator with blocking calls and return its result."""
+    with ExitStack() as leases:
+        reply, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                reply, error = _run_step(step, registry, leases), None
+            except Exception as e:
+                reply, error = None, e
+
+
+def _run_step(step, registry: ClientRegistry, leases: ExitStack):
+    if isinstance(step, Command):
+        return step.db.command(*step.args, **step.kwargs)
+    if isinstance(step, Lease):
+        return leases.enter_context(registry.client(step.hostname, step.port, step.username, step.password))
+    if isinstance(step, Discard):
+        client = registry.discard(step.hostname, step.port, step.username)
+        if client:
+            client.close()
+        return None
+    if isinstance(step, Sleep):
+        time.sleep(max(step.seconds, 0))
+        return None
+    if isinstance(step, Blocking):
+        return step.fn(*step.args)
+    if isinstance(step, Parallel):
+        if not step.steps:
+            return []
+        with ThreadPoolExecutor(max_workers=min(step.concurrency, len(step.steps))) as executor:
+            return list(executor.map(lambda steps: run_steps(steps, registry), step.steps))
+    raise TypeError(f"Unknown step {step!r}")
+
+
+async def run_steps_async(steps: Steps, registry: ClientRegistry):
+    """Async variant of run_steps, for a registry of async clients."""
+    async with AsyncExitStack() as leases:
+        reply, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                reply, error = await _run_step_async(step, registry, leases), None
+            except Exception as e:
+                reply, error = None, e
+
+
+async def _run_step_async(step, registry: ClientRegistry, leases: AsyncExitStack):
+    if isinstance(step, Command):
+        return await step.db.command(*step.args, **step.kwargs)
+    if isinstance(step, Lease):
+        return await leases.enter_async_context(
+            registry.aclient(step.hostname, step.port, step.username, step.password))
+    if isinstance(step, Discard):
+        client = registry.discard(step.hostname, step.port, step.username)
+        if client:
+            await close_client(client)
+        return None
+    if isinstance(step, Sleep):
+        await asyncio.sleep(max(step.seconds, 0))
+        return None
+    if isinstance(step, Blocking):
+        return await asyncio.to_thread(step.fn, *step.args)
+    if isinstance(step, Parallel):
+        semaphore = asyncio.Semaphore(step.concurrency)
+
+        async def run(steps: Steps):
+            async with semaphore:
+                return await run_steps_async(steps, registry)
+
+        return list(await asyncio.gather(*(run(steps) for steps in step.steps)))
+    raise TypeError(f"Unknown step {step!r}")
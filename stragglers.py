@@ -0,0 +1,51 @@
+import threading
+from typing import Dict, List, Tuple
+
+from phase_metrics import PhaseMetrics, percentile
+
+
+class StragglerQueue:
+    """Shards that ran out of their time budget, to be retried with longer budgets at the end of the run.
+
+    Every attempt of a shard that timed out at least once is kept as
+    (budget, seconds, outcome), so the summary can show how far into the
+    tail the stragglers were compared to the typical shard.
+    """
+
+    def __init__(self):
+        self.attempts: Dict[str, List[Tuple[float, float, str]]] = {}
+        self._queue = []
+        self._lock = threading.Lock()
+
+    def add(self, shard_name: str, primary: Dict, namespaces: List[str]):
+        with self._lock:
+            self._queue.append((shard_name, primary, namespaces))
+
+    def take(self) -> List[Tuple[str, Dict, List[str]]]:
+        """Return the queued stragglers and empty the queue."""
+        with self._lock:
+            queue, self._queue = self._queue, []
+        return queue
+
+    def record(self, shard_name: str, budget: float, seconds: float, outcome: str):
+        """Keep an attempt ('ok', 'failed' or 'timeout') of a shard that has timed out at least once."""
+        with self._lock:
+            if outcome == 'timeout' or shard_name in self.attempts:
+                self.attempts.setdefault(shard_name, []).append((budget, seconds, outcome))
+
+    def print_report(self, metrics: PhaseMetrics):
+        if not self.attempts:
+            return
+
+        typical = metrics.summary().get('shard', {}).get('p50')
+        print("\n=== Stragglers ===")
+        for shard_name, attempts in sorted(self.attempts.items(), key=lambda item: -item[1][-1][1]):
+            history = ', '.join(f"{seconds:.1f}s of {budget:.0f}s {outcome}" for budget, seconds, outcome in attempts)
+            print(f"- {shard_name}: {history}")
+
+        # The time each straggler took in the end, including every attempt
+        totals = sorted(sum(seconds for _, seconds, _ in attempts) for attempts in self.attempts.values())
+        recovered = sum(1 for attempts in self.attempts.values() if attempts[-1][2] == 'ok')
+        print(f"Recovered {recovered}/{len(totals)}; time per straggler p50 {percentile(totals, 0.5):.1f}s, "
+              f"p95 {percentile(totals, 0.95):.1f}s, max {totals[-1]:.1f}s"
+              + (f" (typical shard p50 {typical:.1f}s)" if typical else ""))
@@ -1,12 +1,18 @@
 import os
-from requests.auth import HTTPDigestAuth
 import requests
-from pymongo import MongoClient
 import logging
 from typing import List, Dict, Tuple
 from getpass import getpass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import socket
 import time
 
+from cloud_manager import create_session, fetch_all_hosts
+from cluster_discovery import discover_from_seed
+from connection_registry import ClientRegistry
+from latency_map import LATENCY_MAP_FILE, build_latency_map, save_latency_map
+from topology_cache import get_cached_topology, save_topology, shard_members_from_hosts, split_host
+
 # Configuration
 PUBLIC_KEY = os.environ.get('PUBLIC_KEY')
 PRIVATE_KEY = os.environ.get('PRIVATE_KEY')
@@ -18,8 +24,20 @@ MONGO_ADMIN_USER = 'binoymdb'
 MONGO_ADMIN_PASSWORD = getpass("Enter MongoDB admin password: ")
 
 # API Setup
-BASE_URL = 'https://cloud.mongodb.com/api/public/v1.0'
-DIGEST_AUTH = HTTPDigestAuth(PUBLIC_KEY, PRIVATE_KEY)
+BASE_URL = os.environ.get('CM_BASE_URL', 'https://cloud.mongodb.com/api/public/v1.0')  # Overridden by the offline benchmark
+CM_PAGE_SIZE = int(os.environ.get('CM_PAGE_SIZE', '200'))  # Hosts per page (Cloud Manager allows up to 500)
+CM_MAX_WORKERS = int(os.environ.get('CM_MAX_WORKERS', '8'))  # Pages fetched in parallel
+CM_MAX_RETRIES = int(os.environ.get('CM_MAX_RETRIES', '5'))  # Retries for 429/5xx responses
+
+# Topology cache config
+SEED_MONGOS = os.environ.get('SEED_MONGOS')  # host:port of a mongos to discover from (Cloud Manager is the fallback)
+TOPOLOGY_CACHE_TTL = float(os.environ.get('TOPOLOGY_CACHE_TTL', '900'))  # Seconds (0 = always rediscover)
+TOPOLOGY_MAX_INVALID_RATIO = float(os.environ.get('TOPOLOGY_MAX_INVALID_RATIO', '0.25'))  # Stale primaries tolerated
+
+# Connectivity sweep config
+SWEEP_CONCURRENCY = int(os.environ.get('SWEEP_CONCURRENCY', '32'))  # Nodes tested at the same time
+SWEEP_NODE_TIMEOUT = float(os.environ.get('SWEEP_NODE_TIMEOUT', '10'))  # Seconds to connect to a node
+RTT_SAMPLES = int(os.environ.get('RTT_SAMPLES', '3'))  # hello round trips per node
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,57 +45,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def test_node_connectivity(node: Dict) -> bool:
-    """Test connectivity to a MongoDB node and get server status."""
-    client = None
+# Shared clients, keyed by host:port and user, closed at the end of main()
+CLIENTS = ClientRegistry(connectTimeoutMS=int(SWEEP_NODE_TIMEOUT * 1000),
+                         serverSelectionTimeoutMS=int(SWEEP_NODE_TIMEOUT * 1000),
+                         maxPoolSize=1)  # Limit connection pool
+
+def test_node_connectivity(node: Dict) -> Dict:
+    """Measure TCP connect, handshake + auth and hello RTT latency of one node.
+
+    Returns {'ok', 'error', 'connect', 'auth', 'rtt'} with latencies in seconds;
+    'rtt' is the median of RTT_SAMPLES hello round trips on the authenticated connection.
+    """
+    result = {'ok': False, 'error': None, 'connect': 0.0, 'auth': 0.0, 'rtt': 0.0}
     try:
-        client_url = f'mongodb://{MONGO_ADMIN_USER}:{MONGO_ADMIN_PASSWORD}@{node["hostname"]}:{node["port"]}/admin'
-        client = MongoClient(client_url, 
-                           directConnection=True,
-                           connectTimeoutMS=10000,           # Increased timeout
-                           serverSelectionTimeoutMS=10000,   # Increased timeout
-                           maxPoolSize=1,                    # Limit connection pool
-                           minPoolSize=0)                    # Don't keep connections
-        
-        # Get basic server status without full details
-        server_status = client.admin.command('serverStatus', {'recordStats': 0, 'metrics': 0})
-        
-        # Log minimal information
-        logger.info(f"Connected to {node['hostname']}:{node['port']} - version: {server_status['version']}")
-        return True
+        start = time.monotonic()
+        with socket.create_connection((node['hostname'], node['port']), timeout=SWEEP_NODE_TIMEOUT):
+            result['connect'] = time.monotonic() - start
+
+        # Each node is swept once, so this first command pays for the handshake and authentication
+        with CLIENTS.client(node['hostname'], node['port'], MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD) as client:
+            start = time.monotonic()
+            client.admin.command('ping')
+            result['auth'] = time.monotonic() - start
+
+            round_trips = []
+            for _ in range(max(RTT_SAMPLES, 1)):
+                start = time.monotonic()
+                client.admin.command('hello')
+                round_trips.append(time.monotonic() - start)
+            result['rtt'] = sorted(round_trips)[len(round_trips) // 2]
+
+        result['ok'] = True
+        logger.info(f"Connected to {node['hostname']}:{node['port']} - connect {result['connect'] * 1000:.1f}ms, "
+                    f"auth {result['auth'] * 1000:.1f}ms, rtt {result['rtt'] * 1000:.1f}ms")
 
     except Exception as e:
+        result['error'] = str(e)[:200]
         logger.error(f"Failed to connect to {node['hostname']}:{node['port']}: {str(e)[:100]}...")  # Truncate long error messages
-        return False
-    finally:
-        if client:
-            client.close()
+
+    return result
 
 def get_all_hosts() -> List[Dict]:
     """Get MongoDB hosts from the specified project and cluster with pagination."""
     try:
         logger.info("Testing MongoDB Atlas API connectivity...")
-        all_hosts = []
-        page_num = 1
-        items_per_page = 200
-        
-        while True:
-            host_url = f'{BASE_URL}/groups/{PROJECT_ID}/hosts?clusterId={CLUSTER_ID}&pageNum={page_num}&itemsPerPage={items_per_page}'
-            host_response = requests.get(host_url, auth=DIGEST_AUTH)
-            host_response.raise_for_status()
-            
-            response_data = host_response.json()
-            hosts = response_data['results']
-            all_hosts.extend(hosts)
-            
-            total_count = response_data.get('totalCount', 0)
-            logger.info(f"Fetched page {page_num}, got {len(hosts)} hosts (Total: {len(all_hosts)}/{total_count})")
-            
-            if len(all_hosts) >= total_count:
-                break
-                
-            page_num += 1
-            
+        with create_session(PUBLIC_KEY, PRIVATE_KEY, pool_size=CM_MAX_WORKERS, max_retries=CM_MAX_RETRIES) as session:
+            all_hosts = fetch_all_hosts(session, BASE_URL, PROJECT_ID, CLUSTER_ID,
+                                        items_per_page=CM_PAGE_SIZE, max_workers=CM_MAX_WORKERS)
+
         logger.info(f"Found total of {len(all_hosts)} hosts in project")
         return all_hosts
 
@@ -118,54 +133,83 @@ def get_cluster_topology(hosts: List[Dict]) -> tuple:
     return mongos_nodes, shard_primaries, config_servers
 
 def display_topology(mongos_nodes: List[Dict], shard_primaries: Dict, config_servers: List[Dict]) -> Tuple[int, int]:
-    """Display cluster topology and connection test results. Returns (success_count, failure_count)."""
-    success_count = 0
-    failure_count = 0
-    
+    """Display cluster topology, sweep every node concurrently and write the latency map.
+
+    Returns (success_count, failure_count).
+    """
     print(f"\n=== Testing Cluster with {len(mongos_nodes)} mongos, {len(shard_primaries)} shards ===")
     
     # Get user confirmation before proceeding
     input(f"\nAbout to test {len(mongos_nodes)} mongos and {len(shard_primaries)} shard primaries. Press Enter to continue...")
-    
-    print("\nTesting Mongos Routers...")
-    for idx, mongos in enumerate(mongos_nodes, 1):
-        if test_node_connectivity(mongos):
-            success_count += 1
-        else:
-            failure_count += 1
-        time.sleep(0.5)  # Add delay between tests
-        
-        # Progress indicator every 10 nodes
-        if idx % 10 == 0:
-            print(f"Completed testing {idx}/{len(mongos_nodes)} mongos nodes")
-    
-    print("\nTesting Shard Primaries...")
-    total_shards = len(shard_primaries)
-    for idx, (shard_name, primary) in enumerate(shard_primaries.items(), 1):
-        if test_node_connectivity(primary):
-            success_count += 1
-        else:
-            failure_count += 1
-        time.sleep(0.2)  # Add delay between tests
-        
-        # Progress indicator every 10 shards
-        if idx % 10 == 0:
-            print(f"Completed testing {idx}/{total_shards} shard primaries")
-    
-    return success_count, failure_count
+
+    targets = [('mongos', f"mongos {idx}", mongos) for idx, mongos in enumerate(mongos_nodes, 1)]
+    targets += [('shard', shard_name, primary) for shard_name, primary in shard_primaries.items()]
+
+    print(f"\nTesting {len(targets)} nodes, {SWEEP_CONCURRENCY} at a time...")
+    nodes = {}
+    with ThreadPoolExecutor(max_workers=max(SWEEP_CONCURRENCY, 1)) as executor:
+        futures = {executor.submit(test_node_connectivity, node): (role, name, node) for role, name, node in targets}
+        for done, future in enumerate(as_completed(futures), 1):
+            role, name, node = futures[future]
+            nodes[f"{node['hostname']}:{node['port']}"] = {'name': name, 'role': role, **future.result()}
+
+            # Progress indicator every 10 nodes
+            if done % 10 == 0:
+                print(f"Completed testing {done}/{len(targets)} nodes")
+
+    latency_map = build_latency_map(nodes, SWEEP_CONCURRENCY)
+    save_latency_map(latency_map, LATENCY_MAP_FILE)
+    display_latency_map(latency_map)
+
+    success_count = sum(1 for node in nodes.values() if node['ok'])
+    return success_count, len(nodes) - success_count
+
+def display_latency_map(latency_map: Dict):
+    """Print the latency percentiles, outliers and the recommendation for mongo-cache-flush.py."""
+    print("\n=== Latency (ms) ===")
+    print(f"{'phase':<10} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for phase, stats in latency_map['percentiles'].items():
+        print(f"{phase:<10} {stats['p50'] * 1000:>8.1f} {stats['p95'] * 1000:>8.1f} "
+              f"{stats['p99'] * 1000:>8.1f} {stats['max'] * 1000:>8.1f}")
+
+    if latency_map['outliers']:
+        print(f"\nOutliers ({len(latency_map['outliers'])}):")
+        for outlier in latency_map['outliers'][:10]:
+            print(f"- {outlier['name']} ({outlier['node']}): slow {', '.join(outlier['phases'])}, "
+                  f"total {outlier['total'] * 1000:.1f}ms")
+
+    recommendation = latency_map['recommendation']
+    print(f"\nRecommended for mongo-cache-flush.py: concurrency {recommendation['concurrency']}, "
+          f"per-node timeout {recommendation['node_timeout']:.1f}s")
+    print(f"Latency map written to {LATENCY_MAP_FILE}")
 
 def main():
     try:
         logger.info("Starting cluster connectivity test...")
         
-        # Get all hosts from Atlas API
-        all_hosts = get_all_hosts()
-        if not all_hosts:
-            logger.error("Failed to fetch hosts from Atlas API")
-            return False
-        
-        # Get cluster topology
-        mongos_nodes, shard_primaries, config_servers = get_cluster_topology(all_hosts)
+        cached_topology = get_cached_topology(TOPOLOGY_CACHE_TTL, TOPOLOGY_MAX_INVALID_RATIO)
+        discovered = (discover_from_seed(SEED_MONGOS, CLIENTS, MONGO_ADMIN_USER, MONGO_ADMIN_PASSWORD,
+                                         timeout_ms=int(SWEEP_NODE_TIMEOUT * 1000), max_workers=SWEEP_CONCURRENCY)
+                      if SEED_MONGOS and not cached_topology else None)
+        if cached_topology:
+            mongos_nodes, shard_primaries = cached_topology
+            config_servers = []
+        elif discovered:
+            # listShards does not list the config servers, so they are not tested
+            mongos_nodes, shard_primaries, shard_members = discovered
+            config_servers = []
+            save_topology(mongos_nodes, shard_primaries, shard_members)
+        else:
+            # Get all hosts from Atlas API
+            all_hosts = get_all_hosts()
+            if not all_hosts:
+                logger.error("Failed to fetch hosts from Atlas API")
+                return False
+
+            # Get cluster topology
+            mongos_nodes, shard_primaries, config_servers = get_cluster_topology(all_hosts)
+            if shard_primaries and mongos_nodes:
+                save_topology(mongos_nodes, shard_primaries, shard_members_from_hosts(all_hosts))
         
         if not shard_primaries:
             logger.error("No shard primaries found")
@@ -192,6 +236,8 @@ def main():
     except Exception as err:
         logger.error(f"Script failed: {err}")
         return False
+    finally:
+        CLIENTS.close_all()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+TOPOLOGY_FILE = 'cluster_topology.json'
+
+
+def shard_members_from_hosts(hosts: List[Dict]) -> Dict[str, List[str]]:
+    """Map each shard replica set to the host:port of all its members."""
+    shard_members = {}
+    for host in hosts:
+        type_name = host.get('typeName', '')
+        if 'MONGOS' in type_name or 'CONFIG' in type_name or not host.get('replicaSetName'):
+            continue
+        shard_members.setdefault(host['replicaSetName'], []).append(f"{host['hostname']}:{host['port']}")
+    return shard_members
+
+
+def save_topology(mongos_nodes: List[Dict], shard_primaries: Dict,
+                  shard_members: Optional[Dict[str, List[str]]] = None, path: str = TOPOLOGY_FILE,
+                  saved_at: Optional[float] = None):
+    """Write the topology to `path` with permissions 640.
+
+    `saved_at` defaults to now; pass the original discovery time when only
+    re-resolved primaries are being written back, so the TTL is not extended.
+    """
+    topology = {
+        'saved_at': saved_at or time.time(),
+        'mongos_routers': mongos_nodes,
+        'shard_primaries': shard_primaries,
+        'shard_members': shard_members or {}
+    }
+
+    with open(path, 'w') as f:
+        json.dump(topology, f, indent=2)
+    os.chmod(path, 0o640)
+
+
+def load_topology(ttl: float, path: str = TOPOLOGY_FILE) -> Optional[Dict]:
+    """Return the saved topology if it is younger than `ttl` seconds, otherwise None."""
+    if ttl <= 0 or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            topology = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable topology cache {path}: {e}")
+        return None
+
+    age = time.time() - topology.get('saved_at', os.path.getmtime(path))
+    if age > ttl:
+        logger.info(f"Topology cache is {age:.0f}s old (TTL {ttl:.0f}s), rediscovering")
+        return None
+
+    if not topology.get('shard_primaries') or not topology.get('mongos_routers'):
+        return None
+
+    logger.info(f"Loaded topology cache from {path} ({age:.0f}s old)")
+    return topology
+
+
+def load_shard_members(path: str = TOPOLOGY_FILE) -> Dict[str, List[str]]:
+    """Replica set members recorded by the last discovery, whatever the cache's age."""
+    try:
+        with open(path) as f:
+            return json.load(f).get('shard_members', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def hello(hostname: str, port: int, timeout_ms: int = 2000) -> Optional[Dict]:
+    """Run an unauthenticated `hello` against a single node. Returns None if unreachable."""
+    client = None
+    try:
+        client = MongoClient(host=hostname, port=int(port),
+                             directConnection=True,
+                             connectTimeoutMS=timeout_ms,
+                             serverSelectionTimeoutMS=timeout_ms,
+                             socketTimeoutMS=timeout_ms)
+        return client.admin.command('hello')
+    except Exception as e:
+        logger.debug(f"hello failed on {hostname}:{port}: {e}")
+        return None
+    finally:
+        if client:
+            client.close()
+
+
+def split_host(address: str) -> Dict:
+    hostname, _, port = address.rpartition(':')
+    return {'hostname': hostname, 'port': int(port)}
+
+
+def resolve_primary(shard_name: str, cached: Dict, members: List[str],
+                    timeout_ms: int = 2000) -> Tuple[Optional[Dict], bool]:
+    """Check the cached primary of one shard and re-resolve it if it is stale.
+
+    Returns (primary, changed). primary is None when no member could tell us
+    the current primary.
+    """
+    candidates = [cached] + [split_host(m) for m in members
+                             if m != f"{cached['hostname']}:{cached['port']}"]
+
+    for candidate in candidates:
+        reply = hello(candidate['hostname'], candidate['port'], timeout_ms)
+        if reply is None:
+            continue
+        if reply.get('setName') not in (None, shard_name):
+            logger.warning(f"{candidate['hostname']}:{candidate['port']} now belongs to "
+                           f"{reply.get('setName')}, not {shard_name}")
+            continue
+
+        if reply.get('isWritablePrimary') and candidate is cached:
+            return cached, False
+        if reply.get('primary'):
+            primary = split_host(reply['primary'])
+            return {**cached, **primary}, True
+
+    return None, True
+
+
+def validate_topology(topology: Dict, timeout_ms: int = 2000,
+                      max_workers: int = 32) -> Tuple[List[Dict], Dict, int, List[str], List[str]]:
+    """Validate every cached mongos and shard primary with a `hello` call.
+
+    Returns (mongos_nodes, shard_primaries, changed_count, unresolved_shards,
+    unreachable_mongos). unresolved_shards lists the shards whose primary
+    could not be confirmed or re-resolved. unreachable_mongos lists the
+    routers that did not answer as a mongos; they are still in mongos_nodes.
+    """
+    mongos_nodes = topology['mongos_routers']
+    cached_primaries = topology['shard_primaries']
+    shard_members = topology.get('shard_members', {})
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        mongos_replies = list(executor.map(
+            lambda node: hello(node['hostname'], node['port'], timeout_ms), mongos_nodes))
+        shard_results = list(executor.map(
+            lambda item: resolve_primary(item[0], item[1], shard_members.get(item[0], []), timeout_ms),
+            cached_primaries.items()))
+
+    unreachable_mongos = [f"{node['hostname']}:{node['port']}"
+                          for node, reply in zip(mongos_nodes, mongos_replies)
+                          if reply is None or reply.get('msg') != 'isdbgrid']
+    unresolved_shards = []
+
+    shard_primaries = {}
+    changed_count = 0
+    for shard_name, (primary, changed) in zip(cached_primaries, shard_results):
+        if primary is None:
+            unresolved_shards.append(shard_name)
+            continue
+        if changed:
+            changed_count += 1
+            logger.info(f"Primary of {shard_name} moved to {primary['hostname']}:{primary['port']}")
+        shard_primaries[shard_name] = primary
+
+    return mongos_nodes, shard_primaries, changed_count, unresolved_shards, unreachable_mongos
+
+
+def get_cached_topology(ttl: float, max_invalid_ratio: float = 0.25, timeout_ms: int = 2000,
+                        path: str = TOPOLOGY_FILE) -> Optional[Tuple[List[Dict], Dict]]:
+    """Return (mongos_nodes, shard_primaries) from a fresh, validated cache.
+
+    Returns None when the cache is missing or expired, when a shard has no
+    reachable primary, or when more than `max_invalid_ratio` of the shard
+    primaries had moved or of the mongos did not answer; callers should then
+    run a full discovery. Fewer unreachable mongos are only logged and kept,
+    as a rediscovery would list them again: their probe reports them as failed.
+    """
+    topology = load_topology(ttl, path)
+    if topology is None:
+        return None
+
+    mongos_nodes, shard_primaries, changed_count, unresolved_shards, unreachable_mongos = \
+        validate_topology(topology, timeout_ms)
+
+    if unresolved_shards:
+        logger.info(f"Topology cache has no reachable primary for {len(unresolved_shards)} shard(s) "
+                    f"({', '.join(unresolved_shards[:5])}), rediscovering")
+        return None
+
+    if changed_count > max_invalid_ratio * len(shard_primaries):
+        logger.info(f"{changed_count}/{len(shard_primaries)} cached primaries were stale, rediscovering")
+        return None
+
+    if len(unreachable_mongos) > max_invalid_ratio * len(mongos_nodes):
+        logger.info(f"{len(unreachable_mongos)}/{len(mongos_nodes)} cached mongos did not answer, rediscovering")
+        return None
+    if unreachable_mongos:
+        logger.warning(f"Cached mongos did not answer and are kept as listed: {', '.join(unreachable_mongos[:5])}")
+
+    if changed_count:
+        save_topology(mongos_nodes, shard_primaries, topology.get('shard_members'), path,
+                      saved_at=topology.get('saved_at'))
+
+    logger.info(f"Using cached topology: {len(mongos_nodes)} mongos, {len(shard_primaries)} shards "
+                f"({changed_count} primaries re-resolved)")
+    return mongos_nodes, shard_primaries